@@ -0,0 +1,76 @@
+#
+# Baseline comparison shared by the benchmarks.
+#
+# Each benchmark measures a set of metrics per case (e.g. per script), and compares them against a JSON file of
+# baselines: {case: {metric: value}}. A metric regresses when it's worse than the baseline by more than the
+# threshold (in percent) and by more than its absolute slack, so that noise on tiny values doesn't count.
+#
+# The baselines depend on the machine, so they aren't committed. A case without a baseline is recorded as the
+# baseline, with a warning, so the first run on a machine (e.g. a clean checkout) sets them up.
+#
+import argparse
+import json
+import os
+import sys
+from typing import Callable, Dict, Iterable, List
+
+
+def add_arguments(parser: argparse.ArgumentParser, baselines_file: str, threshold: float) -> None:
+    parser.add_argument('--threshold', type=float, default=threshold, metavar='PCT',
+                        help='Fail when a metric is this much worse than the baseline')
+    parser.add_argument('--baselines', default=baselines_file, metavar='FILE')
+    parser.add_argument('--update-baselines', action='store_true',
+                        help='Record the results as the new baselines instead of comparing')
+
+
+def find_regressions(case: str, result: Dict[str, float], baseline: Dict[str, float],
+                     metrics: Dict[str, float], threshold: float) -> List[str]:
+    regressions = []
+    for metric, slack in metrics.items():
+        if metric not in baseline:
+            continue
+        base = baseline[metric]
+        value = result[metric]
+        if value > base * (1 + threshold) and value - base > slack:
+            regressions.append(f'{case}: {metric} {value:.4g} > baseline {base:.4g}')
+    return regressions
+
+
+def run(args, cases: Iterable[str], measure: Callable[[str], Dict[str, float]], metrics: Dict[str, float],
+        header: str, format_row: Callable[[str, Dict[str, float]], str]) -> int:
+    """Measure each case, print the results, and compare them against (or record them as) the baselines.
+
+    `metrics` maps each metric to its absolute slack. Returns the exit status: 1 if any case regressed.
+    """
+    baselines = {}
+    if os.path.exists(args.baselines):
+        with open(args.baselines) as f:
+            baselines = json.load(f)
+
+    print(header)
+    regressions = []
+    missing = []
+    results = {}
+    for case in cases:
+        result = results[case] = measure(case)
+        print(format_row(case, result))
+        if args.update_baselines:
+            baselines[case] = result
+        elif case in baselines:
+            regressions += find_regressions(case, result, baselines[case], metrics, args.threshold / 100)
+        else:
+            missing.append(case)
+
+    for case in missing:
+        print(f'WARNING: No baseline for {case}; recording this result as its baseline', file=sys.stderr)
+        baselines[case] = results[case]
+
+    if args.update_baselines or missing:
+        with open(args.baselines, 'w') as f:
+            json.dump(baselines, f, indent=2, sort_keys=True)
+            f.write('\n')
+        print(f'Baselines written to {args.baselines}')
+
+    for r in regressions:
+        print('REGRESSION: ' + r, file=sys.stderr)
+    return 1 if regressions else 0
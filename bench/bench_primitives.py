@@ -0,0 +1,247 @@
+#!/usr/bin/python3
+#
+# Microbenchmarks for the code every key stroke goes through, with a fake uinput device.
+#
+# For each case, reports:
+#   ns_per_op:       Best of --repeat runs of --number operations.
+#   alloc_peak_b:    Peak memory allocated (and freed) while running an operation, traced with tracemalloc.
+#   retained_blocks: Memory blocks left allocated per operation (should be 0).
+#
+# "synced_write_contended" runs the same writes as "synced_write" while another thread writes to the same
+# SyncedUinput in a loop (like main-keyboard-remapper.py's Wheeler, without its delays), and fails if that
+# thread didn't write anything while the case ran. Its memory metrics include that thread's allocations.
+#
+# The results are compared against bench/baselines-primitives.json, and the exit status is 1 if any of them
+# regressed more than --threshold. Cases without a baseline record one (see _baseline.py); run with
+# --update-baselines to record new baselines.
+#
+# Usage: bench/bench_primitives.py [-c CASE ...] [--threshold PCT] [--update-baselines]
+#
+import argparse
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from typing import Callable, Dict, List, Tuple
+
+BENCH_PATH = os.path.dirname(os.path.realpath(__file__))
+REPO_PATH = os.path.dirname(BENCH_PATH)
+BASELINES_FILE = os.path.join(BENCH_PATH, 'baselines-primitives.json')
+
+sys.path.insert(0, REPO_PATH)
+
+import evdev
+from evdev import ecodes, InputEvent
+
+import key_remapper
+
+import _baseline
+
+ALPHABET_KEYS = tuple(range(ecodes.KEY_Q, ecodes.KEY_P + 1)) + tuple(range(ecodes.KEY_A, ecodes.KEY_L + 1)) \
+                + tuple(range(ecodes.KEY_Z, ecodes.KEY_M + 1))
+
+# metric -> absolute slack, so that noise on tiny values doesn't count as a regression.
+METRICS = {
+    'ns_per_op': 50,
+    'alloc_peak_b': 64,
+    'retained_blocks': 0.01,
+}
+
+
+class FakeUInput:
+    """Stands in for evdev.UInput, and discards the events."""
+    fd = -1
+
+    def write_event(self, ev: InputEvent) -> None:
+        pass
+
+    def write(self, type: int, code: int, value: int) -> None:
+        pass
+
+    def syn(self) -> None:
+        pass
+
+    def close(self) -> None:
+        pass
+
+
+class FakeDevice:
+    """Stands in for evdev.InputDevice. read() returns the given reads in turn."""
+    def __init__(self, reads: List[List[InputEvent]]):
+        self.path = '/dev/input/bench'
+        self.name = 'bench'
+        self.__reads = reads
+        self.__next = 0
+
+    def read(self) -> List[InputEvent]:
+        events = self.__reads[self.__next]
+        self.__next = (self.__next + 1) % len(self.__reads)
+        return events
+
+
+class Remapper(key_remapper.BaseRemapper):
+    """Passes the keys through, like the end of main-keyboard-remapper.py's handler."""
+    def on_handle_event(self, device: evdev.InputDevice, ev: InputEvent):
+        if ev.type != ecodes.EV_KEY:
+            return
+        self.send_ievent(ev)
+
+
+def new_remapper() -> Remapper:
+    remapper = Remapper('bench', '', '', headless=True)
+    remapper.uinput = key_remapper.SyncedUinput(FakeUInput())
+    remapper.rel_coalesce_lag_ms = 0  # The fake events get old during the benchmark.
+    return remapper
+
+
+def key_frame(key: int, value: int) -> List[InputEvent]:
+    sec, usec = divmod(time.time_ns() // 1000, 1_000_000)
+    return [InputEvent(sec, usec, ecodes.EV_MSC, ecodes.MSC_SCAN, 0x70004),
+            InputEvent(sec, usec, ecodes.EV_KEY, key, value),
+            InputEvent(sec, usec, ecodes.EV_SYN, ecodes.SYN_REPORT, 0)]
+
+
+# Each case returns (operation, cleanup).
+def case_synced_write():
+    uinput = key_remapper.SyncedUinput(FakeUInput())
+    press = InputEvent(0, 0, ecodes.EV_KEY, ecodes.KEY_A, 1)
+    release = InputEvent(0, 0, ecodes.EV_KEY, ecodes.KEY_A, 0)
+
+    def op():
+        uinput.write(press)
+        uinput.write(release)
+    return op, None
+
+
+def case_synced_write_contended():
+    uinput = key_remapper.SyncedUinput(FakeUInput())
+    press = InputEvent(0, 0, ecodes.EV_KEY, ecodes.KEY_A, 1)
+    release = InputEvent(0, 0, ecodes.EV_KEY, ecodes.KEY_A, 0)
+    stop = threading.Event()
+    writes = 0  # By the other thread.
+    writes_at_start = None
+
+    def hammer():
+        nonlocal writes
+        other_press = InputEvent(0, 0, ecodes.EV_KEY, ecodes.KEY_B, 1)
+        other_release = InputEvent(0, 0, ecodes.EV_KEY, ecodes.KEY_B, 0)
+        while not stop.is_set():
+            uinput.write(other_press)
+            uinput.write(other_release)
+            writes += 2
+    thread = threading.Thread(target=hammer, daemon=True)
+    thread.start()
+
+    def op():
+        nonlocal writes_at_start
+        if writes_at_start is None:
+            writes_at_start = writes
+        uinput.write(press)
+        uinput.write(release)
+
+    def cleanup():
+        stop.set()
+        thread.join()
+        if writes_at_start is None or writes == writes_at_start:
+            raise RuntimeError('The contending thread did not write anything while the case ran')
+    return op, cleanup
+
+
+def case_check_modifiers():
+    remapper = new_remapper()
+    return (lambda: remapper.check_modifiers('cs')), None
+
+
+def case_matches_key_int():
+    remapper = new_remapper()
+    ev = InputEvent(0, 0, ecodes.EV_KEY, ecodes.KEY_A, 1)
+    return (lambda: remapper.matches_key(ev, ecodes.KEY_A, 1, '')), None
+
+
+def case_matches_key_iterable():
+    remapper = new_remapper()
+    ev = InputEvent(0, 0, ecodes.EV_KEY, ecodes.KEY_M, 1)
+    return (lambda: remapper.matches_key(ev, ALPHABET_KEYS, (1, 2), 'e')), None
+
+
+def case_press_key():
+    remapper = new_remapper()
+    return (lambda: remapper.press_key(ecodes.KEY_A, 'c')), None
+
+
+def case_on_input_event():
+    remapper = new_remapper()
+    device = FakeDevice([key_frame(ecodes.KEY_A, 1), key_frame(ecodes.KEY_A, 0)])
+    on_input_event = remapper._BaseRemapper__on_input_event
+
+    def op():
+        on_input_event(device, None)
+        on_input_event(device, None)
+    return op, None
+
+
+CASES: Dict[str, Callable[[], Tuple[Callable[[], None], Callable[[], None]]]] = {
+    'synced_write': case_synced_write,
+    'synced_write_contended': case_synced_write_contended,
+    'check_modifiers': case_check_modifiers,
+    'matches_key_int': case_matches_key_int,
+    'matches_key_iterable': case_matches_key_iterable,
+    'press_key': case_press_key,
+    'on_input_event': case_on_input_event,
+}
+
+
+def run_case(name: str, number: int, repeat: int) -> Dict[str, float]:
+    op, cleanup = CASES[name]()
+    try:
+        for _ in range(min(number, 1000)):  # Warm up, and fill the trace buffers and such.
+            op()
+
+        best = None
+        for _ in range(repeat):
+            start = time.perf_counter_ns()
+            for _ in range(number):
+                op()
+            elapsed = (time.perf_counter_ns() - start) / number
+            best = elapsed if best is None else min(best, elapsed)
+
+        blocks = sys.getallocatedblocks()
+        for _ in range(number):
+            op()
+        retained = (sys.getallocatedblocks() - blocks) / number
+
+        tracemalloc.start()
+        try:
+            op()
+            tracemalloc.reset_peak()
+            current = tracemalloc.get_traced_memory()[0]
+            op()
+            peak = tracemalloc.get_traced_memory()[1] - current
+        finally:
+            tracemalloc.stop()
+    finally:
+        if cleanup:
+            cleanup()
+
+    return {'ns_per_op': best, 'alloc_peak_b': peak, 'retained_blocks': max(0.0, retained)}
+
+
+def main(args):
+    parser = argparse.ArgumentParser(description='Microbenchmarks for the per-key code paths')
+    parser.add_argument('-c', '--case', action='append', choices=list(CASES),
+                        help='Run only this case (can be repeated)')
+    parser.add_argument('--number', type=int, default=20000, metavar='N', help='Operations per run')
+    parser.add_argument('--repeat', type=int, default=5, metavar='N', help='Runs per case; the best is used')
+    _baseline.add_arguments(parser, BASELINES_FILE, threshold=25)
+    args = parser.parse_args(args)
+
+    return _baseline.run(
+        args, args.case or list(CASES), lambda name: run_case(name, args.number, args.repeat), METRICS,
+        f'{"case":<26} {"ns_per_op":>10} {"alloc_peak_b":>13} {"retained_blocks":>16}',
+        lambda name, result: f'{name:<26} {result["ns_per_op"]:>10.0f} {result["alloc_peak_b"]:>13.0f} '
+                             f'{result["retained_blocks"]:>16.3f}')
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
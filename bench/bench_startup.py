@@ -0,0 +1,229 @@
+#!/usr/bin/python3
+#
+# Startup benchmark for the remapper scripts.
+#
+# Starts each script in --headless mode against a fake input device created with uinput, and measures:
+#   import_s:      Time to import the script (key_remapper, GTK, evdev, ...), without the interpreter startup.
+#   first_event_s: Time from starting the process to the first remapped event coming out of its uinput device.
+#   rss_kb:        VmRSS while idle after startup.
+#   wakeups_per_s: Context switches per second of all the threads while idle.
+#
+# The results (medians of --runs runs) are compared against bench/baselines-startup.json, and the exit status
+# is 1 if any of them regressed more than --threshold. Scripts without a baseline record one (see _baseline.py);
+# run with --update-baselines to record new baselines.
+#
+# Needs the same permissions as the remappers themselves (/dev/uinput and /dev/input/*).
+#
+# Usage: bench/bench_startup.py [-s SCRIPT ...] [--runs N] [--threshold PCT] [--update-baselines]
+#
+import argparse
+import os
+import re
+import select
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, List, Tuple
+
+import evdev
+from evdev import ecodes, UInput
+
+import _baseline
+
+BENCH_PATH = os.path.dirname(os.path.realpath(__file__))
+REPO_PATH = os.path.dirname(BENCH_PATH)
+BASELINES_FILE = os.path.join(BENCH_PATH, 'baselines-startup.json')
+
+UINPUT_DEVICE_NAME = 'key-remapper-uinput'  # Same as key_remapper.UINPUT_DEVICE_NAME
+FAKE_DEVICE_PREFIX = 'key-remapper-bench-'  # Must not start with UINPUT_DEVICE_NAME.
+
+TIMEOUT = 30
+INJECT_INTERVAL = 0.005
+
+
+def key_press(*keys: int) -> List[Tuple[int, int, int]]:
+    return [(ecodes.EV_KEY, k, 1) for k in keys] + [(ecodes.EV_KEY, k, 0) for k in reversed(keys)]
+
+
+# script -> (fake device capabilities, events to inject until something comes out, extra arguments)
+SCRIPTS = {
+    'main-keyboard-remapper.py': (
+        {ecodes.EV_KEY: list(range(ecodes.KEY_ESC, ecodes.KEY_MICMUTE + 1))},
+        key_press(ecodes.KEY_A),
+        []),
+    'satechi-remapper.py': (
+        {ecodes.EV_KEY: [ecodes.KEY_VOLUMEUP, ecodes.KEY_VOLUMEDOWN, ecodes.KEY_PLAYPAUSE,
+                         ecodes.KEY_PREVIOUSSONG, ecodes.KEY_NEXTSONG]},
+        key_press(ecodes.KEY_VOLUMEUP),
+        []),
+    'shortcut-remote-remapper.py': (
+        {ecodes.EV_KEY: [ecodes.KEY_M, ecodes.KEY_P, ecodes.KEY_U, ecodes.KEY_B, ecodes.KEY_ENTER, ecodes.KEY_Z,
+                         ecodes.KEY_V, ecodes.KEY_I, ecodes.KEY_SPACE, ecodes.KEY_KPMINUS, ecodes.KEY_KPPLUS,
+                         ecodes.KEY_LEFTSHIFT]},
+        key_press(ecodes.KEY_M),
+        []),
+    'shuttlex-remapper.py': (
+        {ecodes.EV_KEY: [ecodes.BTN_4, ecodes.BTN_5, ecodes.BTN_6, ecodes.BTN_7, ecodes.BTN_8]},
+        key_press(ecodes.BTN_6),
+        []),
+    'trackpoint-speedup.py': (
+        {ecodes.EV_KEY: [ecodes.BTN_LEFT, ecodes.BTN_RIGHT, ecodes.BTN_MIDDLE],
+         ecodes.EV_REL: [ecodes.REL_X, ecodes.REL_Y]},
+        [(ecodes.EV_REL, ecodes.REL_X, 3)],
+        []),
+    'ilebygo-touchpad.py': (
+        {ecodes.EV_KEY: [ecodes.KEY_LEFTSHIFT, ecodes.KEY_LEFTALT, ecodes.KEY_TAB]},
+        key_press(ecodes.KEY_LEFTSHIFT, ecodes.KEY_LEFTALT, ecodes.KEY_TAB),
+        ['-i', '']),
+}
+
+# metric -> absolute slack, so that noise on tiny values doesn't count as a regression.
+METRICS = {
+    'import_s': 0.02,
+    'first_event_s': 0.05,
+    'rss_kb': 2048,
+    'wakeups_per_s': 2,
+}
+
+
+def script_stem(script: str) -> str:
+    return re.sub(r'\..*?$', '', script)
+
+
+def measure_import(script: str) -> float:
+    code = ('import runpy, sys, time\n'
+            't = time.perf_counter()\n'
+            'runpy.run_path(sys.argv[1], run_name="bench")\n'
+            'print(time.perf_counter() - t)\n')
+    env = dict(os.environ, PYTHONPATH=REPO_PATH)
+    out = subprocess.check_output([sys.executable, '-c', code, os.path.join(REPO_PATH, script)],
+                                  cwd=REPO_PATH, env=env)
+    return float(out.decode().strip().splitlines()[-1])
+
+
+def find_device(name: str, deadline: float) -> evdev.InputDevice:
+    while time.monotonic() < deadline:
+        for path in evdev.list_devices():
+            try:
+                device = evdev.InputDevice(path)
+            except OSError:
+                continue
+            if device.name == name:
+                return device
+            device.close()
+        time.sleep(INJECT_INTERVAL)
+    raise TimeoutError(f'uinput device "{name}" not found')
+
+
+def count_context_switches(pid: int) -> int:
+    total = 0
+    for tid in os.listdir(f'/proc/{pid}/task'):
+        try:
+            with open(f'/proc/{pid}/task/{tid}/status') as f:
+                for line in f:
+                    if line.startswith(('voluntary_ctxt_switches:', 'nonvoluntary_ctxt_switches:')):
+                        total += int(line.split()[1])
+        except FileNotFoundError:
+            pass  # The thread has finished.
+    return total
+
+
+def read_rss_kb(pid: int) -> int:
+    with open(f'/proc/{pid}/status') as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1])
+    return 0
+
+
+def run_once(script: str, settle_s: float, idle_s: float) -> Dict[str, float]:
+    caps, inject, extra_args = SCRIPTS[script]
+    stem = script_stem(script)
+    instance = 'bench-' + stem
+    fake_name = FAKE_DEVICE_PREFIX + stem
+
+    fake = UInput(events=caps, name=fake_name)
+    stderr = tempfile.TemporaryFile()
+    try:
+        start = time.monotonic()
+        proc = subprocess.Popen(
+            [sys.executable, os.path.join(REPO_PATH, script), '--headless', '-q', '--instance', instance,
+             '-m', '^' + re.escape(fake_name) + '$'] + extra_args,
+            cwd=REPO_PATH, stdout=subprocess.DEVNULL, stderr=stderr)
+        try:
+            deadline = start + TIMEOUT
+            output = find_device(f'{UINPUT_DEVICE_NAME}-{instance}', deadline)
+
+            # Keep injecting until the remapper has grabbed the fake device and something comes out.
+            first_event = None
+            while first_event is None:
+                if proc.poll() is not None:
+                    raise RuntimeError(f'{script} exited with {proc.returncode}')
+                if time.monotonic() > deadline:
+                    raise TimeoutError(f'{script} did not send any events')
+                for type, code, value in inject:
+                    fake.write(type, code, value)
+                    fake.syn()
+                if select.select([output], [], [], INJECT_INTERVAL)[0]:
+                    if any(ev.type != ecodes.EV_SYN for ev in output.read()):
+                        first_event = time.monotonic() - start
+
+            time.sleep(settle_s)
+            while select.select([output], [], [], 0)[0]:
+                output.read()
+
+            switches = count_context_switches(proc.pid)
+            time.sleep(idle_s)
+            wakeups = (count_context_switches(proc.pid) - switches) / idle_s
+            rss = read_rss_kb(proc.pid)
+            output.close()
+        except:
+            stderr.seek(0)
+            sys.stderr.write(stderr.read().decode(errors='replace'))
+            raise
+        finally:
+            proc.terminate()
+            try:
+                proc.wait(5)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+                proc.wait()
+    finally:
+        stderr.close()
+        fake.close()
+
+    return {'first_event_s': first_event, 'rss_kb': rss, 'wakeups_per_s': wakeups}
+
+
+def benchmark(script: str, runs: int, settle_s: float, idle_s: float) -> Dict[str, float]:
+    samples: Dict[str, List[float]] = {m: [] for m in METRICS}
+    for _ in range(runs):
+        samples['import_s'].append(measure_import(script))
+        for k, v in run_once(script, settle_s, idle_s).items():
+            samples[k].append(v)
+    return {m: statistics.median(v) for m, v in samples.items()}
+
+
+def main(args):
+    parser = argparse.ArgumentParser(description='Startup time and memory benchmark for the remapper scripts')
+    parser.add_argument('-s', '--script', action='append', choices=sorted(SCRIPTS),
+                        help='Benchmark only this script (can be repeated)')
+    parser.add_argument('--runs', type=int, default=5, metavar='N', help='Runs per script; medians are used')
+    parser.add_argument('--settle', type=float, default=1, metavar='SEC',
+                        help='Wait this long after the first event before measuring idle behavior')
+    parser.add_argument('--idle', type=float, default=3, metavar='SEC', help='Idle measurement period')
+    _baseline.add_arguments(parser, BASELINES_FILE, threshold=20)
+    args = parser.parse_args(args)
+
+    return _baseline.run(
+        args, args.script or sorted(SCRIPTS), lambda script: benchmark(script, args.runs, args.settle, args.idle),
+        METRICS,
+        f'{"script":<30} {"import_s":>9} {"first_event_s":>14} {"rss_kb":>8} {"wakeups_per_s":>14}',
+        lambda script, result: f'{script:<30} {result["import_s"]:>9.3f} {result["first_event_s"]:>14.3f} '
+                               f'{result["rss_kb"]:>8.0f} {result["wakeups_per_s"]:>14.1f}')
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
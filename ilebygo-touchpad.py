@@ -21,34 +21,22 @@ ID_REGEX = "^v0c45 p8101"
 
 class Remapper(key_remapper.BaseRemapper):
     def __init__(self):
-        super().__init__(NAME, ICON, DEFAULT_DEVICE_NAME, id_regex=ID_REGEX)
-        self.lshift = True
-        self.lalt = True
+        super().__init__(NAME, ICON, DEFAULT_DEVICE_NAME, id_regex=ID_REGEX,
+                         uinput_events=key_remapper.key_events_for([ecodes.KEY_BACK, ecodes.KEY_FORWARD],
+                                                                   modifiers=False),
+                         input_events={ecodes.EV_KEY: (ecodes.KEY_LEFTSHIFT, ecodes.KEY_LEFTALT, ecodes.KEY_TAB)})
+
+        # 3 finger swipes send SHIFT+ALT+TAB (left) or ALT+TAB (right), then more TABs while the fingers
+        # move. (See the event dumps at the bottom.) Everything else is dropped.
+        self.add_sequence([(ecodes.EV_KEY, ecodes.KEY_LEFTSHIFT, 1),
+                           (ecodes.EV_KEY, ecodes.KEY_LEFTALT, 1),
+                           (ecodes.EV_KEY, ecodes.KEY_TAB, 1)], ecodes.KEY_BACK, timeout_ms=100)
+        self.add_sequence([(ecodes.EV_KEY, ecodes.KEY_LEFTALT, 1),
+                           (ecodes.EV_KEY, ecodes.KEY_TAB, 1)], ecodes.KEY_FORWARD, timeout_ms=100)
 
     def on_device_detected(self, devices: List[evdev.InputDevice]):
         super().on_device_detected(devices)
 
-    def on_handle_event(self, device: evdev.InputDevice, ev: evdev.InputEvent):
-        if ev.type != ecodes.EV_KEY:
-            return
-
-        if ev.code == ecodes.KEY_TAB and ev.value == 1:
-            if self.lalt:
-                if self.lshift:
-                    self.press_key(ecodes.KEY_BACK)
-                else:
-                    self.press_key(ecodes.KEY_FORWARD)
-            self.lshift = False
-            self.lalt = False
-            return
-
-        if ev.code == ecodes.KEY_LEFTSHIFT and ev.value == 1:
-            self.lshift = True
-            return
-        if ev.code == ecodes.KEY_LEFTALT and ev.value == 1:
-            self.lalt = True
-            return
-
 
 def main(args):
     remapper = Remapper()
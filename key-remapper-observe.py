@@ -0,0 +1,65 @@
+#!/usr/bin/python3
+#
+# Follows the events and states a remapper started with --observe publishes. (See key_remapper.ObserverRing.)
+#
+# Usage: key-remapper-observe.py main-keyboard-remapper [--states]
+#
+import argparse
+import os
+import sys
+import time
+
+from evdev import ecodes
+
+import key_remapper
+
+KIND_NAMES = {
+    key_remapper.OBSERVE_INPUT: 'in ',
+    key_remapper.OBSERVE_OUTPUT: 'out',
+    key_remapper.OBSERVE_STATE: 'state',
+}
+
+
+def format_record(rec: key_remapper.ObserverRecord) -> str:
+    t = time.strftime('%H:%M:%S', time.localtime(rec.time_ns / 1e9)) + f'.{rec.time_ns // 1000 % 1_000_000:06d}'
+    kind = KIND_NAMES.get(rec.kind, str(rec.kind))
+    if rec.kind == key_remapper.OBSERVE_STATE:
+        return f'{t} {kind} {rec.text}'
+    type_name = ecodes.EV.get(rec.type, rec.type)
+    code_name = ecodes.bytype.get(rec.type, {}).get(rec.code, rec.code)
+    if isinstance(code_name, list):
+        code_name = code_name[0]
+    return f'{t} {kind} {type_name} {code_name} {rec.value}'
+
+
+def main(args):
+    parser = argparse.ArgumentParser(description='Follow a remapper started with --observe')
+    parser.add_argument('remapper', help='The remapper name (e.g. main-keyboard-remapper) or the ring file path')
+    parser.add_argument('--states', action='store_true', help='Show only the state changes')
+    parser.add_argument('--interval', type=float, default=10, metavar='MS', help='Polling interval')
+    args = parser.parse_args(args)
+
+    path = args.remapper
+    if not os.path.exists(path):
+        path = key_remapper.observer_ring_path(args.remapper)
+    reader = key_remapper.ObserverReader(path)
+
+    lost = 0
+    try:
+        while True:
+            for rec in reader.read():
+                # State records have type 0, so check the kind first.
+                if rec.kind == key_remapper.OBSERVE_STATE or (not args.states and rec.type != ecodes.EV_SYN):
+                    print(format_record(rec), flush=True)
+            if reader.lost_count != lost:
+                print(f'# {reader.lost_count - lost} records lost', file=sys.stderr)
+                lost = reader.lost_count
+            time.sleep(args.interval / 1000)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        reader.close()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -1,14 +1,31 @@
 #!/usr/bin/python3
 import argparse
 import collections
+import contextlib
+import ctypes
+import ctypes.util
 import fcntl
+import gc
+import hashlib
+import heapq
+import itertools
+import json
+import math
+import mmap
 import os
+import pickle
 import random
 import re
+import resource
+import select
+import signal
+import socket
+import struct
 import sys
 import threading
+import time
 import traceback
-from typing import Optional, Dict, List, TextIO, Tuple, Union, Iterable, Callable
+from typing import Optional, Dict, List, TextIO, Tuple, Union, Iterable, Callable, Deque, FrozenSet
 
 import evdev
 import gi
@@ -24,12 +41,16 @@ from gi.repository import Wnck as wnck
 from gi.repository import GLib as glib
 from gi.repository import AppIndicator3 as appindicator
 
-debug = False
+debug = False  # Set by -d and the "debug" control command; scripts read key_remapper.debug too.
 quiet = False
 
 # Uinput device name used by this instance.
 UINPUT_DEVICE_NAME = 'key-remapper-uinput'
 
+# Environment variable used to pass grabbed devices, uinput devices and states to the
+# re-executed process. See BaseRemapper.restart().
+HANDOFF_ENV = 'KEY_REMAPPER_HANDOFF'
+
 
 MAIN_FILE_NANE = re.sub('''\..*?$''', "", os.path.basename(sys.argv[0]))
 
@@ -70,68 +91,504 @@ def ensure_singleton(global_lock_name):
         raise SystemExit(f'Unable to obtain file lock {file}. Previous process running.')
 
 
+class SystemClock:
+    """The real clock, and GLib timers on the main loop. See set_clock()."""
+    def time(self) -> float:
+        return time.time()
+
+    def monotonic(self) -> float:
+        return time.monotonic()
+
+    def sleep(self, seconds: float) -> None:
+        time.sleep(seconds)
+
+    def wait(self, event: threading.Event, timeout: Optional[float] = None) -> bool:
+        """event.wait(timeout)."""
+        return event.wait(timeout)
+
+    def call_later(self, delay_ms: float, callback: Callable[[], bool], priority: Optional[int] = None) -> int:
+        """Call `callback` on the main loop after `delay_ms`, and again every `delay_ms` while it returns True.
+        Returns a tag for cancel()."""
+        if priority is None:
+            return glib.timeout_add(int(delay_ms), callback)
+        return glib.timeout_add(int(delay_ms), callback, priority=priority)
+
+    def cancel(self, tag: int) -> None:
+        glib.source_remove(tag)
+
+
+class VirtualClock(SystemClock):
+    """A clock that only moves when advance() is called, for tests and replays.
+
+    time() and monotonic() return the virtual time. sleep() and wait() block the calling thread until
+    advance() moves the time past their timeout (or the event is set), and call_later() callbacks are
+    called by advance() itself, in time order. advance() steps from one deadline to the next, and at each
+    one waits until the threads it woke are blocked on the clock again, so e.g. a thread repeating
+    something every 20 ms runs exactly 3000 times in advance(60), in however long that takes.
+
+    Threads are known to the clock from their first sleep() / wait(). advance() stops waiting for a thread
+    that doesn't come back to the clock within `settle_timeout` real seconds, e.g. because it's blocked
+    on something else.
+    """
+    def __init__(self, start: float = 0.0, settle_timeout: float = 1.0):
+        self.settle_timeout = settle_timeout
+        self.__now = start
+        self.__cond = threading.Condition()
+        self.__threads: Dict[int, threading.Thread] = {}  # ident -> thread, of the threads using the clock
+        self.__blocked: Dict[int, Tuple[Optional[float], Optional[threading.Event]]] = {}  # ident -> (due, event)
+        self.__timers: List[Tuple[float, int, float, Callable[[], bool]]] = []  # heap of (due, tag, delay, callback)
+        self.__tags = itertools.count(1)
+        self.__cancelled = set()
+
+    def time(self) -> float:
+        return self.__now
+
+    def monotonic(self) -> float:
+        return self.__now
+
+    def sleep(self, seconds: float) -> None:
+        with self.__cond:
+            self.__block(self.__now + seconds, None)
+
+    def wait(self, event: threading.Event, timeout: Optional[float] = None) -> bool:
+        with self.__cond:
+            return self.__block(None if timeout is None else self.__now + timeout, event)
+
+    def __block(self, due: Optional[float], event: Optional[threading.Event]) -> bool:
+        ident = threading.get_ident()
+        self.__threads[ident] = threading.current_thread()
+        self.__blocked[ident] = (due, event)
+        self.__cond.notify_all()
+        try:
+            while True:
+                if event is not None and event.is_set():
+                    return True
+                if due is not None and self.__now >= due:
+                    return event is None
+                # Event.set() doesn't notify us, so poll when waiting for one.
+                self.__cond.wait(0.001 if event is not None else None)
+        finally:
+            del self.__blocked[ident]
+
+    def call_later(self, delay_ms: float, callback: Callable[[], bool], priority: Optional[int] = None) -> int:
+        with self.__cond:
+            tag = next(self.__tags)
+            heapq.heappush(self.__timers, (self.__now + delay_ms / 1000, tag, delay_ms / 1000, callback))
+            return tag
+
+    def cancel(self, tag: int) -> None:
+        with self.__cond:
+            self.__cancelled.add(tag)
+
+    def advance(self, seconds: float) -> None:
+        """Move the time forward, running the timers and the sleeping threads due on the way."""
+        with self.__cond:
+            end = self.__now + seconds
+            while True:
+                self.__settle()
+                due = [d for d, _ in self.__blocked.values() if d is not None]
+                if self.__timers:
+                    due.append(self.__timers[0][0])
+                next_due = min(due, default=None)
+                if next_due is None or next_due > end:
+                    break
+                self.__now = max(self.__now, next_due)
+                self.__cond.notify_all()
+                self.__run_timers()
+            self.__now = end
+            self.__cond.notify_all()
+            self.__settle()
+
+    def __run_timers(self):
+        while self.__timers and self.__timers[0][0] <= self.__now:
+            _, tag, delay, callback = heapq.heappop(self.__timers)
+            if tag in self.__cancelled:
+                self.__cancelled.discard(tag)
+                continue
+            self.__cond.release()
+            try:
+                repeat = callback()
+            finally:
+                self.__cond.acquire()
+            if repeat:
+                heapq.heappush(self.__timers, (self.__now + delay, tag, delay, callback))
+
+    def __settle(self):
+        """Wait until all the threads using the clock are blocked on it with nothing to do."""
+        deadline = time.monotonic() + self.settle_timeout
+        while time.monotonic() < deadline:
+            busy = False
+            for ident, thread in list(self.__threads.items()):
+                if not thread.is_alive():
+                    del self.__threads[ident]
+                    continue
+                blocked = self.__blocked.get(ident)
+                if blocked is None:
+                    busy = True
+                    break
+                due, event = blocked
+                if (event is not None and event.is_set()) or (due is not None and due <= self.__now):
+                    busy = True
+                    break
+            if not busy:
+                return
+            self.__cond.wait(0.001)
+
+
+_clock: SystemClock = SystemClock()
+
+
+def get_clock() -> SystemClock:
+    """The clock used by the framework's timers, repeat threads and timestamps. See set_clock()."""
+    return _clock
+
+
+def set_clock(clock: SystemClock) -> None:
+    """Replace the clock, e.g. with a VirtualClock in tests. Call it before starting the remapper."""
+    global _clock
+    _clock = clock
+
+
 def is_syn(ev: evdev.InputEvent) -> bool:
     """Returns if an event is a SYN event.
     """
     return ev and ev.type == ecodes.EV_SYN and ev.code == ecodes.SYN_REPORT and ev.value == 0
 
 
+def split_frames(events: Iterable[evdev.InputEvent]) -> List[List[evdev.InputEvent]]:
+    """Split events into frames at SYN_REPORT. The SYN_REPORT events themselves are not included.
+    """
+    frames = []
+    frame = []
+    for ev in events:
+        if ev.type == ecodes.EV_SYN and ev.code == ecodes.SYN_REPORT:
+            frames.append(frame)
+            frame = []
+        else:
+            frame.append(ev)
+    if frame:
+        frames.append(frame)
+    return frames
+
+
+class _FrameAssembler:
+    """Only passes through complete SYN_REPORT-terminated frames read from a device.
+
+    A frame split across reads is held until its SYN_REPORT arrives. On SYN_DROPPED, the events
+    since the last SYN_REPORT and up to and including the next SYN_REPORT are discarded, as described
+    in the kernel's Documentation/input/event-codes.rst, and `resync_needed` is set; the caller should
+    then query the device state and clear it.
+    """
+    def __init__(self):
+        self.__partial: List[evdev.InputEvent] = []
+        self.__dropping = False
+        self.dropped_count = 0  # Number of SYN_DROPPEDs seen.
+        self.resync_needed = False
+
+    def feed(self, events: Iterable[evdev.InputEvent]) -> List[evdev.InputEvent]:
+        out = []
+        for ev in events:
+            if ev.type == ecodes.EV_SYN:
+                if ev.code == ecodes.SYN_DROPPED:
+                    self.__partial.clear()
+                    self.__dropping = True
+                    self.dropped_count += 1
+                    continue
+                if ev.code == ecodes.SYN_REPORT:
+                    if not self.__dropping:
+                        out.extend(self.__partial)
+                        out.append(ev)
+                    else:
+                        self.resync_needed = True
+                    self.__partial.clear()
+                    self.__dropping = False
+                    continue
+            if not self.__dropping:
+                self.__partial.append(ev)
+        return out
+
+
+def coalesce_rel_events(events: Iterable[evdev.InputEvent]) -> List[evdev.InputEvent]:
+    """Merge relative motion / wheel deltas across frames.
+
+    Consecutive frames with only EV_REL events (and MSC_TIMESTAMP) are merged into one frame, with the deltas
+    summed up per code and the latest MSC_TIMESTAMP, so the merged motion still ends at the right time. Any
+    other frame (keys, buttons, other EV_MSC, EV_ABS, ...) is kept as is, and pending deltas are sent before
+    it, so the order between motion and the other events is kept.
+    """
+    out = []
+    pending: Dict[int, int] = collections.OrderedDict()
+    timestamp: Optional[evdev.InputEvent] = None  # The latest MSC_TIMESTAMP of the merged frames.
+    sec = usec = 0  # Merged events get the timestamp of the latest frame.
+    frame: List[evdev.InputEvent] = []
+
+    def flush():
+        nonlocal timestamp
+        rels = [evdev.InputEvent(sec, usec, ecodes.EV_REL, code, value) for code, value in pending.items() if value]
+        if rels or timestamp:
+            out.extend(rels)
+            if timestamp:
+                out.append(timestamp)
+            out.append(evdev.InputEvent(sec, usec, ecodes.EV_SYN, ecodes.SYN_REPORT, 0))
+        pending.clear()
+        timestamp = None
+
+    def end_frame(syn: Optional[evdev.InputEvent]):
+        nonlocal sec, usec, timestamp
+        if syn is None:
+            syn = evdev.InputEvent(frame[-1].sec, frame[-1].usec, ecodes.EV_SYN, ecodes.SYN_REPORT, 0)
+        if all(ev.type == ecodes.EV_REL or (ev.type == ecodes.EV_MSC and ev.code == ecodes.MSC_TIMESTAMP)
+               for ev in frame):
+            for ev in frame:
+                if ev.type == ecodes.EV_REL:
+                    pending[ev.code] = pending.get(ev.code, 0) + ev.value
+                else:
+                    timestamp = ev
+            sec, usec = syn.sec, syn.usec
+        else:
+            flush()
+            out.extend(frame)
+            out.append(syn)
+        frame.clear()
+
+    for ev in events:
+        if is_syn(ev):
+            if frame:
+                end_frame(ev)
+        elif ev.type != ecodes.EV_SYN:
+            frame.append(ev)
+    if frame:
+        end_frame(None)
+    flush()
+    return out
+
+
+class OutputQueueFullError(RuntimeError):
+    """Raised by SyncedUinput.write() when the output queue is full and the queue policy is 'error'."""
+
+
+_INPUT_EVENT = struct.Struct('llHHi')  # struct input_event
+
+
 class SyncedUinput:
     """Thread safe wrapper for uinput.
+
+    By default, write() writes to the device on the calling thread. With `queue_policy`, write() only updates
+    the key states and queues the frames, and a writer thread writes them to the device in batches, so the
+    callers never wait for the device. When `queue_size` frames are pending, the policy decides:
+        'block': Wait for the writer.
+        'drop-coalesce': Merge relative motion into the last pending frame, and drop other frames, except
+            the ones with EV_KEY, which are always queued so that the key states stay consistent.
+        'error': Raise OutputQueueFullError.
     """
+    QUEUE_POLICIES = ('block', 'drop-coalesce', 'error')
+
     wrapped: evdev.uinput
     __lock: threading.RLock
     __key_states: Dict[int, int]
 
-    def __init__(self, uinput: evdev.UInput):
+    def __init__(self, uinput: evdev.UInput, events: Optional[Dict[int, Iterable[int]]] = None, *,
+                 queue_policy: Optional[str] = None, queue_size=256):
+        """events: The capabilities the device was created with. None means the default (all keys)."""
+        if queue_policy is not None and queue_policy not in self.QUEUE_POLICIES:
+            raise ValueError(f'Unknown queue policy: {queue_policy}')
         self.wrapped = uinput
+        self.capabilities = {t: frozenset(codes) for t, codes in events.items()} if events is not None else None
         self.__lock = threading.RLock()
         self.__key_states = collections.defaultdict(int)
-
-    def write(self, *events: evdev.InputEvent):
+        self.events_written = 0
+        self.frames_written = 0
+
+        self.queue_policy = queue_policy
+        self.queue_size = queue_size
+        self.queue_max_depth = 0
+        self.queue_dropped_count = 0
+        self.queue_coalesced_count = 0
+        self.batches_written = 0
+        self.observer: Optional['ObserverRing'] = None  # Gets the written events, if set.
+        self.__queue: Deque[List[evdev.InputEvent]] = collections.deque()  # Pending frames.
+        self.__queue_cond = threading.Condition(threading.Lock())  # Guards __queue; held only briefly.
+        self.__writing = False
+        self.__closing = False
+        self.__writer = None
+        if queue_policy:
+            self.__writer = threading.Thread(name='uinput-writer-thread', target=self.__run_writer, daemon=True)
+            self.__writer.start()
+
+    def write(self, *events: evdev.InputEvent, coalesce_rel=False):
+        """Write events, followed by a SYN_REPORT unless the last event is one.
+
+        If coalesce_rel is true, relative motion is merged with coalesce_rel_events().
+        """
+        if coalesce_rel:
+            events = coalesce_rel_events(events)
         with self.__lock:
-            last_event = None
-            for ev in events:
-                if is_syn(ev) and is_syn(last_event):
-                    # Don't send syn twice in a row.
-                    # (Not sure if it matters but just in case.)
-                    continue
+            if self.queue_policy and not self.__make_room(events):
+                return
+            frames = self.__filter(events)
+            if frames:
+                if self.observer:
+                    self.observer.publish_events(OBSERVE_OUTPUT, itertools.chain.from_iterable(frames))
+                self._emit(frames)
+
+    def __filter(self, events: Iterable[evdev.InputEvent]) -> List[List[evdev.InputEvent]]:
+        """Drop the key events that don't make sense given the key states, update the key states, and split
+        the rest into frames, each of which ends with a SYN_REPORT.
+        """
+        frames = []
+        frame = []
+        last_event = None
+        keys_in_frame = set()
+        for ev in events:
+            if is_syn(ev) and is_syn(last_event):
+                # Don't send syn twice in a row.
+                # (Not sure if it matters but just in case.)
+                continue
 
-                # When sending a KEY event, only send what'd make sense given the
-                # current key state.
-                if ev.type == ecodes.EV_KEY:
-                    old_state = self.__key_states[ev.code]
-                    if ev.value == 0:
-                        if old_state == 0:  # Don't send if already released.
-                            continue
-                    elif ev.value == 1:
-                        if old_state > 0:  # Don't send if already pressed.
-                            continue
-                    elif ev.value == 2:
-                        if old_state == 0:  # Don't send if not pressed.
-                            continue
-
-                    self.__key_states[ev.code] = ev.value
-
-                self.wrapped.write_event(ev)
-                last_event = ev
-
-            # If any event was written, and the last event isn't a syn, send one.
-            if last_event and not is_syn(last_event):
-                self.wrapped.syn()
+            # When sending a KEY event, only send what'd make sense given the
+            # current key state.
+            if ev.type == ecodes.EV_KEY:
+                old_state = self.__key_states[ev.code]
+                if ev.value == 0:
+                    if old_state == 0:  # Don't send if already released.
+                        continue
+                elif ev.value == 1:
+                    if old_state > 0:  # Don't send if already pressed.
+                        continue
+                elif ev.value == 2:
+                    if old_state == 0:  # Don't send if not pressed.
+                        continue
+
+                self.__key_states[ev.code] = ev.value
+
+                # Two transitions of the same key in one frame would be lost, so split the frame.
+                if ev.code in keys_in_frame:
+                    frame.append(evdev.InputEvent(ev.sec, ev.usec, ecodes.EV_SYN, ecodes.SYN_REPORT, 0))
+                    frames.append(frame)
+                    frame = []
+                    self.frames_written += 1
+                    keys_in_frame.clear()
+                keys_in_frame.add(ev.code)
+
+            frame.append(ev)
+            self.events_written += 1
+            if is_syn(ev):
+                self.frames_written += 1
+                frames.append(frame)
+                frame = []
+                keys_in_frame.clear()
+            last_event = ev
+
+        # If any event was written, and the last event isn't a syn, send one.
+        if frame:
+            frame.append(evdev.InputEvent(last_event.sec, last_event.usec, ecodes.EV_SYN, ecodes.SYN_REPORT, 0))
+            frames.append(frame)
+            self.frames_written += 1
+        return frames
+
+    def _emit(self, frames: List[List[evdev.InputEvent]]) -> None:
+        """Send filtered frames to the device. Called with the lock held."""
+        if not self.queue_policy:
+            for frame in frames:
+                for ev in frame:
+                    self.wrapped.write_event(ev)
+            return
+        with self.__queue_cond:
+            self.__queue.extend(frames)
+            self.queue_max_depth = max(self.queue_max_depth, len(self.__queue))
+            self.__queue_cond.notify_all()
+
+    def __make_room(self, events: Iterable[evdev.InputEvent]) -> bool:
+        """Apply the queue policy if the queue is full. Returns False if the events are dropped or merged."""
+        with self.__queue_cond:
+            if len(self.__queue) < self.queue_size:
+                return True
+            if self.queue_policy == 'error':
+                raise OutputQueueFullError(f'{len(self.__queue)} frames pending on {self.wrapped}')
+            if self.queue_policy == 'block':
+                while len(self.__queue) >= self.queue_size and not self.__closing:
+                    self.__queue_cond.wait()
+                return True
+
+            # 'drop-coalesce'
+            if any(ev.type == ecodes.EV_KEY for ev in events):
+                return True  # Never drop keys; go over the limit instead.
+            tail = self.__queue[-1]
+            if all(ev.type in (ecodes.EV_REL, ecodes.EV_SYN) for ev in itertools.chain(tail, events)):
+                self.__queue[-1] = coalesce_rel_events(list(itertools.chain(tail, events)))
+                self.queue_coalesced_count += 1
+            else:
+                self.queue_dropped_count += 1
+            return False
+
+    def __run_writer(self):
+        while True:
+            with self.__queue_cond:
+                while not self.__queue and not self.__closing:
+                    self.__queue_cond.wait()
+                if not self.__queue:
+                    return
+                frames = list(self.__queue)
+                self.__queue.clear()
+                self.__writing = True
+                self.__queue_cond.notify_all()  # Wake up the blocked writers.
+            try:
+                self._write_batch(frames)
+            except OSError:
+                if debug: traceback.print_exc()
+            finally:
+                with self.__queue_cond:
+                    self.__writing = False
+                    self.__queue_cond.notify_all()
+
+    def _write_batch(self, frames: List[List[evdev.InputEvent]]):
+        """Write the frames taken from the queue at once. Called on the writer thread."""
+        # The kernel takes any number of events in one write().
+        data = memoryview(b''.join(_INPUT_EVENT.pack(ev.sec, ev.usec, ev.type, ev.code, ev.value)
+                                   for frame in frames for ev in frame))
+        while data:
+            data = data[os.write(self.wrapped.fd, data):]
+        self.batches_written += 1
+
+    def queue_depth(self) -> int:
+        return len(self.__queue)
+
+    def flush(self, timeout: float = 1) -> bool:
+        """Wait until the writer thread has written all the pending frames. Returns False on timeout."""
+        if not self.__writer:
+            return True
+        with self.__queue_cond:
+            return self.__queue_cond.wait_for(lambda: not self.__queue and not self.__writing, timeout)
+
+    def supports(self, type: int, code: int) -> bool:
+        if self.capabilities is None:
+            return type == ecodes.EV_KEY
+        return code in self.capabilities.get(type, ())
 
     def get_key_state(self, key: int):
         with self.__lock:
             return self.__key_states[key]
 
+    def get_key_states(self) -> Dict[int, int]:
+        """Return a copy of the output key states."""
+        with self.__lock:
+            return {k: v for k, v in self.__key_states.items() if v > 0}
+
+    def restore_key_states(self, key_states: Dict[int, int]) -> None:
+        """Set the output key states without sending any events. Used after restart()."""
+        with self.__lock:
+            self.__key_states.clear()
+            self.__key_states.update(key_states)
+
     def reset(self):
         # Release all pressed keys.
         with self.__lock:
             try:
-                for key, value in self.__key_states.items():
-                    if value > 0:
-                        self.wrapped.write(ecodes.EV_KEY, key, 0)
-                        self.wrapped.syn()
+                frames = [[evdev.InputEvent(0, 0, ecodes.EV_KEY, key, 0),
+                           evdev.InputEvent(0, 0, ecodes.EV_SYN, ecodes.SYN_REPORT, 0)]
+                          for key, value in self.__key_states.items() if value > 0]
+                if frames:
+                    self._emit(frames)
             except:
                 pass  # ignore any exception
             finally:
@@ -140,6 +597,13 @@ class SyncedUinput:
     def close(self):
         with self.__lock:
             self.reset()
+            if self.__writer:
+                self.flush()
+                with self.__queue_cond:
+                    self.__closing = True
+                    self.__queue_cond.notify_all()
+                self.__writer.join(1)
+                self.__writer = None
             if self.wrapped:
                 self.wrapped.close()
                 self.wrapped = None
@@ -151,6 +615,1182 @@ class SyncedUinput:
         with self.__lock:
             self.write(evdev.InputEvent(0, 0, type, key, value))
 
+
+class LatencyHistogram:
+    """Histogram of durations with power-of-two microsecond buckets.
+
+    Bucket i counts durations in [2^i, 2^(i+1)) microseconds. It can be updated from any thread (e.g. device
+    lanes); readers don't lock, so they may see a sample half-recorded.
+    """
+    NUM_BUCKETS = 24  # Up to ~16 seconds.
+
+    def __init__(self, name: str):
+        self.name = name
+        self.__lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.__lock:
+            self.buckets = [0] * self.NUM_BUCKETS
+            self.count = 0
+            self.total = 0.0
+            self.max = 0.0
+
+    def record(self, seconds: float) -> None:
+        us = int(seconds * 1_000_000)
+        with self.__lock:
+            self.buckets[min(max(us, 1).bit_length() - 1, self.NUM_BUCKETS - 1)] += 1
+            self.count += 1
+            self.total += seconds
+            if seconds > self.max:
+                self.max = seconds
+
+    def percentile(self, p: float) -> float:
+        """Return the upper bound of the bucket containing the p-th percentile, in seconds."""
+        if self.count == 0:
+            return 0.0
+        threshold = self.count * p / 100
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if seen >= threshold:
+                return (1 << (i + 1)) / 1_000_000
+        return self.max
+
+    def format(self) -> str:
+        if self.count == 0:
+            return f'{self.name}: no samples'
+        lines = [f'{self.name}: count={self.count} avg={self.total / self.count * 1000:.3f}ms '
+                 f'p50<{self.percentile(50) * 1000:.3f}ms p99<{self.percentile(99) * 1000:.3f}ms '
+                 f'max={self.max * 1000:.3f}ms']
+        for i, n in enumerate(self.buckets):
+            if n:
+                lines.append(f'  < {(1 << (i + 1)) / 1000:10.3f}ms: {n}')
+        return '\n'.join(lines)
+
+
+Combo = collections.namedtuple('Combo', 'keys output window')  # window is in seconds.
+
+
+class ComboEngine:
+    """Detects keys pressed together ("chords"), e.g. J and K pressed within 30 ms -> ESC.
+
+    Presses of keys that may start a combo are held back. As soon as all the keys of a combo are down, the
+    held events are replaced with a press of the combo's output key, which is released when any of the keys
+    is released. As soon as the held keys can no longer become a combo (another key, a release, or the
+    window expired), they're replayed as they were. So only the keys that start a combo are delayed, and
+    only until that is decided; expire() is needed only when nothing else comes in time.
+
+    Every subset of the combos' keys is indexed, so an event costs a dict lookup no matter how many combos
+    there are. Each instance handles one device, from one thread.
+    """
+    def __init__(self, combos: Iterable[Combo], latency: LatencyHistogram):
+        self.latency = latency  # How long the held keys were delayed, per resolution.
+        self.fired_count = 0
+        self.replayed_count = 0
+        self.timeout_count = 0
+        self.deadline: Optional[float] = None  # get_clock().monotonic() by which the held keys expire.
+
+        # Subset of keys -> [the combo with exactly these keys or None, whether a larger combo has them too,
+        # the longest window of the combos that have them].
+        self.__index: Dict[FrozenSet[int], List] = {}
+        for combo in combos:
+            keys = sorted(combo.keys)
+            for n in range(1, len(keys) + 1):
+                for subset in itertools.combinations(keys, n):
+                    entry = self.__index.setdefault(frozenset(subset), [None, False, 0.0])
+                    if n == len(keys):
+                        entry[0] = combo
+                    else:
+                        entry[1] = True
+                    entry[2] = max(entry[2], combo.window)
+
+        self.__held_keys: FrozenSet[int] = frozenset()
+        self.__held_events: List[evdev.InputEvent] = []
+        self.__hold_start = 0.0
+        self.__last_press = 0.0
+        self.__engaged: Dict[int, Combo] = {}  # Key -> the combo it fired, until the key is released.
+        self.__output_down: set = set()  # Fired combos whose output key is still pressed.
+
+    def feed(self, events: Iterable[evdev.InputEvent], now: float) -> List[evdev.InputEvent]:
+        """Return the events to handle now, in place of `events`. `now` is get_clock().monotonic()."""
+        out = []
+        for ev in events:
+            if ev.type != ecodes.EV_KEY:
+                (self.__held_events if self.__held_keys else out).append(ev)
+                continue
+            combo = self.__engaged.get(ev.code)
+            if combo:
+                self.__handle_engaged(ev, combo, out)
+                continue
+            if self.__held_keys:
+                if ev.value == 2 and ev.code in self.__held_keys:
+                    self.__held_events.append(ev)
+                    continue
+                if ev.value == 1 and self.__extend(ev, now, out):
+                    continue
+                self.__resolve(now, out)
+            if ev.value == 1 and self.__extend(ev, now, out):
+                continue
+            out.append(ev)
+        return out
+
+    def expire(self, now: float) -> List[evdev.InputEvent]:
+        """Resolve the held keys if the window is over."""
+        if self.deadline is None or now < self.deadline:
+            return []
+        self.timeout_count += 1
+        out = []
+        if self.__resolve(now, out):
+            last = out[-1]
+            out.append(evdev.InputEvent(last.sec, last.usec, ecodes.EV_SYN, ecodes.SYN_REPORT, 0))
+        return out
+
+    def reset(self) -> None:
+        """Forget the held and fired keys, without sending anything. Used when events were lost."""
+        self.__held_keys = frozenset()
+        self.__held_events = []
+        self.deadline = None
+        self.__engaged.clear()
+        self.__output_down.clear()
+
+    def __extend(self, ev: evdev.InputEvent, now: float, out: List[evdev.InputEvent]) -> bool:
+        """Add a press to the held keys, if it may still make a combo, and fire it if it's complete."""
+        keys = self.__held_keys | {ev.code}
+        entry = self.__index.get(keys)
+        if not self.__held_keys:
+            self.__hold_start = now
+        if not entry or now - self.__hold_start > entry[2]:
+            return False
+        self.__held_keys = keys
+        self.__held_events.append(ev)
+        self.__last_press = now
+        self.deadline = self.__hold_start + entry[2]
+        exact, extendable = entry[0], entry[1]
+        if exact and not extendable:
+            self.__resolve(now, out)
+        return True
+
+    def __resolve(self, now: float, out: List[evdev.InputEvent]) -> bool:
+        """Fire the combo the held keys make, or replay them. Returns whether a combo fired."""
+        entry = self.__index[self.__held_keys]
+        combo = entry[0]
+        fired = combo is not None and self.__last_press - self.__hold_start <= combo.window
+        if fired:
+            last = self.__held_events[-1]
+            out.append(evdev.InputEvent(last.sec, last.usec, ecodes.EV_KEY, combo.output, 1))
+            for key in combo.keys:
+                self.__engaged[key] = combo
+            self.__output_down.add(combo)
+            self.fired_count += 1
+        else:
+            out.extend(self.__held_events)
+            self.replayed_count += 1
+        self.latency.record(now - self.__hold_start)
+        self.__held_keys = frozenset()
+        self.__held_events = []
+        self.deadline = None
+        return fired
+
+    def __handle_engaged(self, ev: evdev.InputEvent, combo: Combo, out: List[evdev.InputEvent]):
+        if ev.value == 0:
+            del self.__engaged[ev.code]
+        if combo not in self.__output_down or ev.value == 1:
+            return
+        if ev.value == 0:
+            self.__output_down.discard(combo)
+        out.append(evdev.InputEvent(ev.sec, ev.usec, ecodes.EV_KEY, combo.output, ev.value))
+
+
+Sequence = collections.namedtuple('Sequence', 'events action timeout')  # timeout is in seconds.
+
+
+class _SequenceNode:
+    __slots__ = ('children', 'sequence', 'timeout')
+
+    def __init__(self):
+        self.children: Dict[Tuple[int, int, int], '_SequenceNode'] = {}
+        self.sequence: Optional[Sequence] = None  # The sequence ending here.
+        self.timeout = 0.0  # The longest timeout of the sequences going through here.
+
+
+class SequenceMatcher:
+    """Matches sequences of events, e.g. a leader key followed by other keys, or the key strokes a device sends
+    for a gesture, and replaces them with actions.
+
+    The sequences' (type, code, value)s are compiled into a trie, which is advanced by one lookup per event no
+    matter how many sequences there are. Matching events are held back. When a sequence completes and no
+    longer sequence can follow, its action fires right away; otherwise it fires when the next event doesn't
+    continue it, or on the timeout. When the held events turn out not to be a sequence, they're replayed as
+    they were. Events of types no sequence uses (e.g. SYN and MSC) are held along to keep the order, and
+    dropped when a sequence fires. Each instance handles one device, from one thread.
+    """
+    def __init__(self, sequences: Iterable[Sequence]):
+        self.matched_count = 0
+        self.replayed_count = 0
+        self.timeout_count = 0
+        self.deadline: Optional[float] = None  # get_clock().monotonic() by which the held events expire.
+
+        self.__root = _SequenceNode()
+        self.__types = set()
+        for sequence in sequences:
+            node = self.__root
+            for key in sequence.events:
+                self.__types.add(key[0])
+                node = node.children.setdefault(tuple(key), _SequenceNode())
+                node.timeout = max(node.timeout, sequence.timeout)
+            node.sequence = sequence
+
+        self.__node = self.__root
+        self.__held: List[evdev.InputEvent] = []
+        self.__start = 0.0
+
+    def feed(self, events: Iterable[evdev.InputEvent], now: float) \
+            -> List[Tuple[Optional[Sequence], List[evdev.InputEvent]]]:
+        """Return what to do with `events` now, as a list of (matched sequence, its events), or (None, events
+        to pass through). `now` is get_clock().monotonic().
+        """
+        out = []
+        for ev in events:
+            if self.deadline is not None and now >= self.deadline:
+                self.timeout_count += 1
+                self.__resolve(out)
+            if ev.type not in self.__types:
+                if self.__node is self.__root:
+                    self.__pass(ev, out)
+                else:
+                    self.__held.append(ev)
+                continue
+            key = (ev.type, ev.code, ev.value)
+            child = self.__node.children.get(key)
+            if child is None and self.__node is not self.__root:
+                self.__resolve(out)
+                child = self.__root.children.get(key)
+            if child is None:
+                self.__pass(ev, out)
+                continue
+            if self.__node is self.__root:
+                self.__start = now
+            self.__node = child
+            self.__held.append(ev)
+            self.deadline = self.__start + child.timeout
+            if not child.children:
+                self.__resolve(out)
+        return out
+
+    def expire(self, now: float) -> List[Tuple[Optional[Sequence], List[evdev.InputEvent]]]:
+        """Resolve the held events if the timeout is over."""
+        if self.deadline is None or now < self.deadline:
+            return []
+        self.timeout_count += 1
+        out = []
+        self.__resolve(out)
+        return out
+
+    def reset(self) -> None:
+        """Forget the held events, without passing them. Used when events were lost."""
+        self.__node = self.__root
+        self.__held = []
+        self.deadline = None
+
+    @staticmethod
+    def __pass(ev: evdev.InputEvent, out: List[Tuple[Optional[Sequence], List[evdev.InputEvent]]]):
+        if out and out[-1][0] is None:
+            out[-1][1].append(ev)
+        else:
+            out.append((None, [ev]))
+
+    def __resolve(self, out: List[Tuple[Optional[Sequence], List[evdev.InputEvent]]]):
+        sequence = self.__node.sequence
+        if sequence:
+            out.append((sequence, self.__held))
+            self.matched_count += 1
+        else:
+            for ev in self.__held:
+                self.__pass(ev, out)
+            self.replayed_count += 1
+        self.__node = self.__root
+        self.__held = []
+        self.deadline = None
+
+
+class RuleProfiler:
+    """Attributes handler time to matches_key() call sites. Enabled with --profile.
+
+    For each call site, it records the number of evaluations and matches, the time spent evaluating the
+    rule (including the predicate), the time spent in the predicate alone, and the action time, which
+    is the time from a match until the next rule evaluation or the end of the handler.
+    """
+    EVALS, MATCHES, EVAL_TIME, PREDICATE_TIME, ACTION_TIME = range(5)
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__stats: Dict[Tuple[str, int, str], List] = {}
+        self.__pending = threading.local()  # The last matched site and the time, per handler thread.
+
+    def __close_action(self, now: float):
+        pending = getattr(self.__pending, 'site', None)
+        if pending:
+            self.__pending.site = None
+            site, start = pending
+            with self.__lock:
+                stats = self.__stats.get(site)
+                if stats is not None:  # None if reset() was called since the match.
+                    stats[self.ACTION_TIME] += now - start
+
+    def profile(self, frame, func: Callable[..., bool], ev: evdev.InputEvent, expected_keys, expected_values,
+                expected_modifiers, predecate, ignore_other_modifiers) -> bool:
+        """Call func (the actual matches_key()) for the call site in `frame` and record the stats."""
+        start = time.perf_counter()
+        self.__close_action(start)
+
+        predicate_time = 0.0
+        timed_predecate = None
+        if predecate:
+            def timed_predecate():
+                nonlocal predicate_time
+                t = time.perf_counter()
+                try:
+                    return predecate()
+                finally:
+                    predicate_time += time.perf_counter() - t
+
+        matched = func(ev, expected_keys, expected_values, expected_modifiers, timed_predecate,
+                       ignore_other_modifiers=ignore_other_modifiers)
+        end = time.perf_counter()
+
+        site = (frame.f_code.co_filename, frame.f_lineno, frame.f_code.co_name)
+        with self.__lock:
+            stats = self.__stats.get(site)
+            if stats is None:
+                stats = self.__stats[site] = [0, 0, 0.0, 0.0, 0.0]
+            stats[self.EVALS] += 1
+            stats[self.EVAL_TIME] += end - start
+            stats[self.PREDICATE_TIME] += predicate_time
+            if matched:
+                stats[self.MATCHES] += 1
+        if matched:
+            self.__pending.site = (site, end)
+        return matched
+
+    def end_handler(self):
+        """Called at the end of each handler call, to close the action time of the last matched rule."""
+        self.__close_action(time.perf_counter())
+
+    def reset(self):
+        with self.__lock:
+            self.__stats.clear()
+
+    def report(self) -> str:
+        with self.__lock:
+            items = [(site, list(stats)) for site, stats in self.__stats.items()]
+        items.sort(key=lambda t: t[1][self.EVAL_TIME] + t[1][self.ACTION_TIME], reverse=True)
+
+        lines = ['Rule profile (sorted by eval + action time):',
+                 f'{"total ms":>10} {"eval ms":>10} {"pred ms":>10} {"action ms":>10} '
+                 f'{"evals":>8} {"matches":>8} {"eval us":>8}  site']
+        for (file, line, func), st in items:
+            total = st[self.EVAL_TIME] + st[self.ACTION_TIME]
+            lines.append(f'{total * 1000:10.3f} {st[self.EVAL_TIME] * 1000:10.3f} '
+                         f'{st[self.PREDICATE_TIME] * 1000:10.3f} {st[self.ACTION_TIME] * 1000:10.3f} '
+                         f'{st[self.EVALS]:8} {st[self.MATCHES]:8} '
+                         f'{st[self.EVAL_TIME] / st[self.EVALS] * 1_000_000:8.2f}  '
+                         f'{os.path.basename(file)}:{line} ({func})')
+        return '\n'.join(lines)
+
+
+class NotificationDispatcher:
+    """Shows notifications from a background thread, so input handlers never wait for D-Bus.
+
+    Only the latest pending message is shown (rapid updates are merged), and at most one
+    notification is shown per `min_interval_ms`.
+    """
+    coalesced_count: int  # Messages replaced by a newer one before being shown.
+    dropped_count: int  # Messages that failed to show.
+    shown_count: int
+
+    def __init__(self, title: str, min_interval_ms=100):
+        self.title = title
+        self.min_interval = min_interval_ms / 1000
+        self.coalesced_count = 0
+        self.dropped_count = 0
+        self.shown_count = 0
+
+        self.__lock = threading.Lock()
+        self.__posted = threading.Event()  # Set while there's a pending message. (An Event, for Clock.wait().)
+        self.__pending: Optional[Tuple[str, int]] = None
+        self.__notification = None
+        self.__thread = threading.Thread(name='notification-thread', target=self.__run)
+        self.__thread.setDaemon(True)
+
+    def start(self):
+        self.__thread.start()
+
+    def post(self, message: str, timeout_ms: int) -> None:
+        """Queue a message. Never blocks on the notification daemon."""
+        with self.__lock:
+            if self.__pending is not None:
+                self.coalesced_count += 1
+            self.__pending = (message, timeout_ms)
+            self.__posted.set()
+
+    def queue_depth(self) -> int:
+        with self.__lock:
+            return 0 if self.__pending is None else 1
+
+    def __show(self, message: str, timeout_ms: int):
+        if not self.__notification:
+            self.__notification = notify2.Notification(self.title, '')
+            self.__notification.set_urgency(notify2.URGENCY_NORMAL)
+        self.__notification.update(self.title, message)
+        self.__notification.set_timeout(timeout_ms)
+        self.__notification.show()
+
+    def __run(self):
+        last_shown = -math.inf
+        while True:
+            get_clock().wait(self.__posted)
+
+            # Rate limit. Messages posted while we're waiting replace the pending one.
+            delay = last_shown + self.min_interval - get_clock().monotonic()
+            if delay > 0:
+                get_clock().sleep(delay)
+
+            with self.__lock:
+                message, timeout_ms = self.__pending
+                self.__pending = None
+                self.__posted.clear()
+
+            try:
+                self.__show(message, timeout_ms)
+                self.shown_count += 1
+            except:
+                self.dropped_count += 1
+                if debug: traceback.print_exc()
+            last_shown = get_clock().monotonic()
+
+
+def format_prometheus(metrics: Iterable[Tuple[str, str, Dict[str, str], float]]) -> str:
+    """Format (name, type, labels, value) tuples in the Prometheus text format."""
+    lines = []
+    last_name = None
+    for name, type, labels, value in metrics:
+        base_name = re.sub('_(bucket|sum|count)$', '', name) if type == 'histogram' else name
+        if base_name != last_name:
+            lines.append(f'# TYPE {base_name} {type}')
+            last_name = base_name
+        if labels:
+            label_text = ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                                  for k, v in labels.items())
+            lines.append(f'{name}{{{label_text}}} {value}')
+        else:
+            lines.append(f'{name} {value}')
+    return '\n'.join(lines) + '\n'
+
+
+class UnixCommandServer:
+    """Serves line-based commands on a Unix-domain socket, with a thread per connection.
+
+    `handler(line)` returns the response text, which is terminated with an empty line. A request starting
+    with "GET " is answered as HTTP/1.0 using `http_handler(path)`, which returns (status, body), so that
+    e.g. `curl --unix-socket SOCKET http://localhost/metrics` works.
+    """
+    def __init__(self, path: str, handler: Callable[[str], str],
+                 http_handler: Optional[Callable[[str], Tuple[int, str]]] = None):
+        self.path = path
+        self.handler = handler
+        self.http_handler = http_handler
+
+        os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+        try:
+            os.unlink(path)  # We hold the singleton lock, so it must be stale.
+        except FileNotFoundError:
+            pass
+        self.__socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.__socket.bind(path)
+        os.chmod(path, 0o600)
+        self.__socket.listen(8)
+
+        th = threading.Thread(name=f'server-{os.path.basename(path)}', target=self.__accept)
+        th.setDaemon(True)
+        th.start()
+
+    def __accept(self):
+        while True:
+            try:
+                conn, _ = self.__socket.accept()
+            except OSError:
+                return  # Closed.
+            th = threading.Thread(name='server-connection', target=self.__serve, args=(conn,))
+            th.setDaemon(True)
+            th.start()
+
+    def __serve(self, conn: socket.socket):
+        try:
+            with conn, conn.makefile('rwb') as f:
+                for raw in f:
+                    line = raw.decode(errors='replace').strip()
+                    if not line:
+                        continue
+                    if line.startswith('GET ') and self.http_handler:
+                        while f.readline().strip():
+                            pass  # Skip the headers.
+                        status, body = self.http_handler(line.split()[1])
+                        f.write(f'HTTP/1.0 {status} {"OK" if status == 200 else "Error"}\r\n'
+                                f'Content-Type: text/plain; version=0.0.4\r\n'
+                                f'Content-Length: {len(body.encode())}\r\n\r\n{body}'.encode())
+                        f.flush()
+                        return
+                    try:
+                        reply = self.handler(line)
+                    except Exception as ex:
+                        reply = f'error: {ex!r}'
+                    f.write(reply.rstrip('\n').encode() + b'\n\n')
+                    f.flush()
+        except OSError:
+            pass  # Client went away.
+
+    def close(self):
+        self.__socket.close()
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+
+def runtime_socket_path(name: str) -> str:
+    """Return the path for a Unix-domain socket of a remapper."""
+    runtime_dir = os.environ.get('XDG_RUNTIME_DIR') or f'/tmp/key-remapper-{os.getuid()}'
+    return os.path.join(runtime_dir, 'key-remapper', f'{name}.sock')
+
+
+BROKER_NAME = 'uinput-broker'
+
+
+def broker_socket_path() -> str:
+    """Return the path of the uinput-broker.py socket."""
+    return runtime_socket_path(BROKER_NAME)
+
+
+def inject_socket_path(name: str) -> str:
+    """Return the path of the injection socket of a remapper. See BaseRemapper.inject_events()."""
+    return runtime_socket_path(name + '-inject')
+
+
+def _event_code(name: str, default_prefix: str = '') -> int:
+    """Resolve an event type or code, given as a name (e.g. EV_KEY, KEY_A, or A or 1 with default_prefix='KEY_')
+    or a number."""
+    code = ecodes.ecodes.get(name.upper())
+    if code is None and default_prefix:
+        code = ecodes.ecodes.get(default_prefix + name.upper())
+    if code is not None:
+        return code
+    try:
+        return int(name, 0)
+    except ValueError:
+        raise ValueError(f'Unknown event type or code: {name}') from None
+
+
+def pack_events(events: Iterable[evdev.InputEvent]) -> bytes:
+    return b''.join(_INPUT_EVENT.pack(ev.sec, ev.usec, ev.type, ev.code, ev.value) for ev in events)
+
+
+def unpack_events(data: bytes) -> List[evdev.InputEvent]:
+    """Raises struct.error if the data isn't whole events."""
+    return [evdev.InputEvent(*values) for values in _INPUT_EVENT.iter_unpack(data)]
+
+
+# Frames sent to the broker are split into messages of up to this size, at frame boundaries.
+BROKER_MAX_MESSAGE = 4096 * _INPUT_EVENT.size
+
+
+class _BrokerConnection:
+    """Stands in for the uinput device of a BrokerUinput."""
+    def __init__(self, sock: socket.socket):
+        self.socket = sock
+        self.fd = sock.fileno()
+
+    def send(self, frames: List[List[evdev.InputEvent]]) -> None:
+        message = []
+        for frame in frames:
+            data = pack_events(frame)
+            if message and sum(map(len, message)) + len(data) > BROKER_MAX_MESSAGE:
+                self.socket.send(b''.join(message))
+                message.clear()
+            message.append(data)
+        if message:
+            self.socket.send(b''.join(message))
+
+    def write_event(self, ev: evdev.InputEvent) -> None:
+        self.socket.send(pack_events([ev]))
+
+    def close(self):
+        self.socket.close()
+
+    def __str__(self) -> str:
+        return f'broker connection fd {self.fd}'
+
+
+class BrokerUinput(SyncedUinput):
+    """SyncedUinput that sends the frames to uinput-broker.py, which owns the actual uinput devices.
+
+    The connection is a SOCK_SEQPACKET Unix-domain socket. The first message is a JSON hello, and each
+    following message is one or more frames of packed struct input_event. The broker merges the key states
+    of all the clients (a key is released when the last client holding it releases it) and releases the keys
+    a client holds when it disconnects.
+    """
+    def __init__(self, path: str, client_name: str, events: Optional[Dict[int, Iterable[int]]] = None,
+                 **kwargs):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        try:
+            sock.connect(path)
+            sock.send(json.dumps({'client': client_name, 'pid': os.getpid()}).encode())
+        except OSError:
+            sock.close()
+            raise
+        super().__init__(_BrokerConnection(sock), events, **kwargs)
+
+    def _emit(self, frames: List[List[evdev.InputEvent]]) -> None:
+        if self.queue_policy:
+            super()._emit(frames)  # The writer thread sends the batches to the broker socket.
+            return
+        self.wrapped.send(frames)
+
+    def _write_batch(self, frames: List[List[evdev.InputEvent]]):
+        self.wrapped.send(frames)
+        self.batches_written += 1
+
+
+OBSERVE_INPUT = 1  # An input event, as read from the device.
+OBSERVE_OUTPUT = 2  # An event written to a uinput device.
+OBSERVE_STATE = 3  # A state change; the text is "name=value".
+
+ObserverRecord = collections.namedtuple('ObserverRecord', 'seq time_ns kind type code value text')
+
+
+def observer_ring_path(name: str) -> str:
+    """Return the path of the observer ring of a remapper."""
+    base = '/dev/shm' if os.path.isdir('/dev/shm') else os.path.dirname(runtime_socket_path(name))
+    return os.path.join(base, f'key-remapper-{name}.ring')
+
+
+class ObserverRing:
+    """Ring buffer in a shared memory file that a remapper publishes its input, output and states to.
+
+    Readers mmap the file and follow along with ObserverReader; the writer never makes a syscall or waits
+    for them. Slow readers just miss records, and can tell from the sequence numbers.
+
+    Layout (little endian):
+        Header (64 bytes): magic "KRRING01", version, header size, record size, capacity, and the sequence
+            number of the latest record (u64, at offset 24).
+        Records (64 bytes each): seq (u64), time_ns (u64), kind (u8), type (u16), code (u16), value (i32),
+            text (36 bytes, NUL padded). Record `seq` is at index seq % capacity. Its seq field is 0 while
+            it's being written, and is set last.
+    """
+    MAGIC = b'KRRING01'
+    VERSION = 1
+    HEADER = struct.Struct('<8sIIIIQ')
+    HEADER_SIZE = 64
+    RECORD = struct.Struct('<QQBxHHxxi36s')
+    SEQ = struct.Struct('<Q')
+    WRITE_SEQ_OFFSET = 24
+
+    def __init__(self, path: str, capacity=4096):
+        self.path = path
+        self.capacity = capacity
+        self.__lock = threading.Lock()  # Serializes the writers (e.g. device lanes); readers don't take it.
+        self.__seq = 0
+        size = self.HEADER_SIZE + capacity * self.RECORD.size
+        fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o600)
+        try:
+            os.ftruncate(fd, size)
+            self.__map = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+        self.HEADER.pack_into(self.__map, 0, self.MAGIC, self.VERSION, self.HEADER_SIZE, self.RECORD.size,
+                              capacity, 0)
+
+    def __put(self, time_ns: int, kind: int, type: int, code: int, value: int, text: bytes) -> None:
+        seq = self.__seq + 1
+        offset = self.HEADER_SIZE + (seq % self.capacity) * self.RECORD.size
+        self.SEQ.pack_into(self.__map, offset, 0)
+        self.RECORD.pack_into(self.__map, offset, 0, time_ns, kind, type, code, value, text)
+        self.SEQ.pack_into(self.__map, offset, seq)
+        self.SEQ.pack_into(self.__map, self.WRITE_SEQ_OFFSET, seq)
+        self.__seq = seq
+
+    def publish_events(self, kind: int, events: Iterable[evdev.InputEvent]) -> None:
+        with self.__lock:
+            if self.__map.closed:
+                return
+            for ev in events:
+                t = ev.sec * 1_000_000_000 + ev.usec * 1000 if ev.sec else time.time_ns()
+                self.__put(t, kind, ev.type, ev.code, ev.value, b'')
+
+    def publish_state(self, name: str, value) -> None:
+        with self.__lock:
+            if self.__map.closed:
+                return
+            self.__put(time.time_ns(), OBSERVE_STATE, 0, 0, 0, f'{name}={value}'.encode()[:36])
+
+    def close(self):
+        with self.__lock:
+            self.__map.close()
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+
+class ObserverReader:
+    """Follows an ObserverRing from another process."""
+    def __init__(self, path: str):
+        with open(path, 'rb') as f:
+            self.__map = mmap.mmap(f.fileno(), 0, prot=mmap.PROT_READ)
+        magic, version, header_size, record_size, capacity, seq = ObserverRing.HEADER.unpack_from(self.__map)
+        if magic != ObserverRing.MAGIC or version != ObserverRing.VERSION:
+            raise ValueError(f'{path} is not an observer ring')
+        self.header_size = header_size
+        self.record_size = record_size
+        self.capacity = capacity
+        self.next_seq = seq + 1  # Start from the records written after opening.
+        self.lost_count = 0
+
+    def latest_seq(self) -> int:
+        return ObserverRing.SEQ.unpack_from(self.__map, ObserverRing.WRITE_SEQ_OFFSET)[0]
+
+    def read(self) -> List[ObserverRecord]:
+        """Return the records written since the last call. Overwritten ones are counted in lost_count."""
+        head = self.latest_seq()
+        if head - self.next_seq + 1 > self.capacity - 1:
+            # Too far behind; the oldest ones may be being overwritten.
+            skip_to = head - self.capacity + 2
+            self.lost_count += skip_to - self.next_seq
+            self.next_seq = skip_to
+        records = []
+        for seq in range(self.next_seq, head + 1):
+            offset = self.header_size + (seq % self.capacity) * self.record_size
+            rec = ObserverRecord(*ObserverRing.RECORD.unpack_from(self.__map, offset))
+            # The writer may have overwritten it while we were copying it.
+            if rec.seq != seq or ObserverRing.SEQ.unpack_from(self.__map, offset)[0] != seq:
+                self.lost_count += 1
+                continue
+            records.append(rec._replace(text=rec.text.rstrip(b'\0').decode(errors='replace')))
+        self.next_seq = max(self.next_seq, head + 1)
+        return records
+
+    def close(self):
+        self.__map.close()
+
+
+StallReport = collections.namedtuple('StallReport', 'time elapsed_ms thread handling stack')
+
+
+class StallWatchdog:
+    """Detects when the main loop, or a thread handling input, makes no progress for longer than a budget.
+
+    The main loop updates a heartbeat from a GLib timeout, and input handlers mark themselves busy with
+    begin() / end(). A background thread checks them every half budget, and when one is late, captures
+    the stalled thread's Python stack (sys._current_frames()) and what it was handling, and passes a
+    StallReport to `on_stall`, on the watchdog thread. Each stall is reported once.
+    """
+    def __init__(self, budget_ms: float, on_stall: Callable[[StallReport], None]):
+        self.budget = budget_ms / 1000
+        self.interval = self.budget / 2
+        self.on_stall = on_stall
+        self.stall_count = 0
+        self.max_stall_ms = 0.0
+        self.__last_beat = get_clock().monotonic()
+        self.__busy: Dict[int, Tuple[float, object]] = {}  # thread ident -> (start, what it's handling)
+        self.__reported: Dict[int, float] = {}  # thread ident -> start of the stall already reported
+        self.__main_ident = threading.main_thread().ident
+        self.__thread = threading.Thread(name='watchdog-thread', target=self.__run, daemon=True)
+
+    def start(self):
+        get_clock().call_later(max(1, int(self.interval * 1000)), self.__beat, priority=glib.PRIORITY_HIGH)
+        self.__thread.start()
+
+    def __beat(self):
+        self.__last_beat = get_clock().monotonic()
+        return True
+
+    def begin(self, what: object) -> None:
+        """Mark the current thread busy handling `what`, which is passed to the StallReport if it stalls."""
+        self.__busy[threading.get_ident()] = (get_clock().monotonic(), what)
+
+    def end(self) -> None:
+        self.__busy.pop(threading.get_ident(), None)
+
+    def __run(self):
+        while True:
+            get_clock().sleep(self.interval)
+            try:
+                self.__check()
+            except:
+                traceback.print_exc()
+
+    def __check(self):
+        now = get_clock().monotonic()
+        stalled: Dict[int, Tuple[float, object]] = {}
+        for ident, (start, what) in list(self.__busy.items()):
+            if now - start > self.budget:
+                stalled[ident] = (start, what)
+        beat = self.__last_beat
+        if self.__main_ident not in stalled and now - beat > self.budget + self.interval:
+            stalled[self.__main_ident] = (beat + self.interval, None)  # When the next beat was due.
+
+        frames = None
+        for ident, (start, what) in stalled.items():
+            if self.__reported.get(ident) == start:
+                continue
+            self.__reported[ident] = start
+            self.stall_count += 1
+            if frames is None:
+                frames = sys._current_frames()
+            frame = frames.get(ident)
+            thread = next((t.name for t in threading.enumerate() if t.ident == ident), str(ident))
+            self.on_stall(StallReport(
+                time=get_clock().time(),
+                elapsed_ms=(now - start) * 1000,
+                thread=thread,
+                handling=what,
+                stack=''.join(traceback.format_stack(frame)) if frame else ''))
+
+        # Record how long the finished stalls took. (Accurate to the check interval.)
+        for ident, start in list(self.__reported.items()):
+            if stalled.get(ident, (None,))[0] != start:
+                del self.__reported[ident]
+                self.max_stall_ms = max(self.max_stall_ms, (now - start) * 1000)
+
+
+class KeymapError(ValueError):
+    pass
+
+
+class Keymap:
+    """A keymap file compiled into lookup tables.
+
+    File format:
+      # Comment
+      [section]
+      SOURCE = TARGET [| TARGET ...] ["label"]
+
+    SOURCE and TARGET are evdev key names (e.g. KEY_A, BTN_LEFT), integers, or names defined in
+    `constants`. Multiple TARGETs are OR'ed together (e.g. "KEY_F20 | HALF_TOGGLE").
+
+    Each section compiles into an OrderedDict of {source_code: [target_code, label]}, which is the
+    same shape as the Python tables the sample remappers use.
+    """
+    CACHE_VERSION = 1
+
+    path: str
+    sections: Dict[str, Dict[int, List]]
+
+    def __init__(self, path: str, sections: Dict[str, Dict[int, List]]):
+        self.path = path
+        self.sections = sections
+
+    def __getitem__(self, section: str) -> Dict[int, List]:
+        return self.sections[section]
+
+    def __contains__(self, section: str) -> bool:
+        return section in self.sections
+
+    def target_codes(self) -> List[int]:
+        """Return all the target codes used in this keymap."""
+        return sorted({v[0] for section in self.sections.values() for v in section.values()})
+
+    @staticmethod
+    def __resolve(token: str, constants: Dict[str, int], path: str, line_no: int) -> int:
+        token = token.strip()
+        if token in constants:
+            return constants[token]
+        if token in ecodes.ecodes:
+            return ecodes.ecodes[token]
+        try:
+            return int(token, 0)
+        except ValueError:
+            raise KeymapError(f'{path}:{line_no}: Unknown key "{token}"')
+
+    @classmethod
+    def compile(cls, path: str, constants: Optional[Dict[str, int]] = None) -> 'Keymap':
+        """Parse a keymap file without using the cache."""
+        if constants is None:
+            constants = {}
+        line_matcher = re.compile(r'''^\s*([^=\s]+)\s*=\s*([^"#]+?)\s*(?:"([^"]*)")?\s*(?:#.*)?$''')
+        section_matcher = re.compile(r'''^\s*\[([^\]]+)\]\s*(?:#.*)?$''')
+
+        sections = collections.OrderedDict()
+        current = None
+        with open(path) as f:
+            for line_no, line in enumerate(f, 1):
+                if not line.strip() or line.lstrip().startswith('#'):
+                    continue
+
+                m = section_matcher.match(line)
+                if m:
+                    current = sections.setdefault(m.group(1).strip(), collections.OrderedDict())
+                    continue
+
+                m = line_matcher.match(line)
+                if not m:
+                    raise KeymapError(f'{path}:{line_no}: Syntax error: {line.strip()}')
+                if current is None:
+                    raise KeymapError(f'{path}:{line_no}: Mapping outside of a [section]')
+
+                source = cls.__resolve(m.group(1), constants, path, line_no)
+                target = 0
+                for token in m.group(2).split('|'):
+                    target |= cls.__resolve(token, constants, path, line_no)
+                current[source] = [target, m.group(3) or '']
+
+        return Keymap(path, sections)
+
+    @staticmethod
+    def __cache_file(path: str) -> str:
+        cache_dir = os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache'))
+        digest = hashlib.sha1(os.path.abspath(path).encode()).hexdigest()
+        return os.path.join(cache_dir, 'key-remapper', f'{os.path.basename(path)}-{digest}.pickle')
+
+    @classmethod
+    def load(cls, path: str, constants: Optional[Dict[str, int]] = None) -> 'Keymap':
+        """Load a keymap file, using the precompiled cache if it's up to date."""
+        st = os.stat(path)
+        cache_key = (cls.CACHE_VERSION, st.st_mtime_ns, st.st_size, sorted((constants or {}).items()))
+        cache_file = cls.__cache_file(path)
+        try:
+            with open(cache_file, 'rb') as f:
+                key, sections = pickle.load(f)
+            if key == cache_key:
+                if debug: print(f'# Using keymap cache {cache_file}')
+                return Keymap(path, sections)
+        except Exception:
+            pass  # No cache or a broken one. Just recompile.
+
+        keymap = cls.compile(path, constants)
+        try:
+            os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+            temp = f'{cache_file}.{os.getpid()}.tmp'
+            with open(temp, 'wb') as f:
+                pickle.dump((cache_key, keymap.sections), f)
+            os.replace(temp, cache_file)
+        except OSError:
+            if debug: traceback.print_exc()
+        return keymap
+
+
+class FileWatcher:
+    """Calls a callback on the main loop when a file is modified, using inotify.
+
+    Watches the containing directory rather than the file, so that editors replacing the file
+    (write to a temp file + rename) are detected too. Multiple events within `delay_ms` are merged.
+    """
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_NONBLOCK = 0o4000
+    IN_CLOEXEC = 0o2000000
+
+    def __init__(self, path: str, callback: Callable[[], None], delay_ms=50):
+        self.path = os.path.abspath(path)
+        self.callback = callback
+        self.delay_ms = delay_ms
+        self.__scheduled = False
+
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.__fd = libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+        if self.__fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        wd = libc.inotify_add_watch(self.__fd, os.path.dirname(self.path).encode(),
+                                    self.IN_CLOSE_WRITE | self.IN_MOVED_TO | self.IN_CREATE)
+        if wd < 0:
+            os.close(self.__fd)
+            raise OSError(ctypes.get_errno(), f'inotify_add_watch failed for {self.path}')
+
+        self.__tag = glib.io_add_watch(self.__fd, glib.IO_IN, self.__on_inotify)
+
+    def __on_inotify(self, fd, condition):
+        name = os.path.basename(self.path).encode()
+        changed = False
+        while True:
+            try:
+                data = os.read(self.__fd, 4096)
+            except BlockingIOError:
+                break
+            if not data:
+                break
+            pos = 0
+            while pos < len(data):
+                # struct inotify_event { int wd; uint32_t mask; uint32_t cookie; uint32_t len; char name[]; }
+                _, _, _, name_len = struct.unpack_from('iIII', data, pos)
+                pos += 16
+                if data[pos:pos + name_len].rstrip(b'\0') == name:
+                    changed = True
+                pos += name_len
+
+        if changed and not self.__scheduled:
+            self.__scheduled = True
+
+            def fire():
+                self.__scheduled = False
+                self.callback()
+                return False
+
+            get_clock().call_later(self.delay_ms, fire)
+        return True
+
+    def close(self):
+        if self.__fd >= 0:
+            glib.source_remove(self.__tag)
+            os.close(self.__fd)
+            self.__fd = -1
+
+
+class _InheritedUInput(UInput):
+    """UInput for a uinput fd inherited from the previous process image. See BaseRemapper.restart().
+    """
+    def __init__(self, name: str, fd: int):
+        # Don't call super().__init__(), which would create a new device.
+        self.name = name
+        self.fd = fd
+        self.device = None
+
+    def __str__(self) -> str:
+        return f'name "{self.name}" (inherited fd {self.fd})'
+
+
+class _DeviceLane:
+    """Reads and handles events from one device on a dedicated thread. See `dispatch_lanes` in BaseRemapper.
+    """
+    def __init__(self, device: evdev.InputDevice, handler: Callable, on_start: Optional[Callable[[], None]] = None):
+        self.device = device
+        self.native_id: Optional[int] = None
+        self.__handler = handler
+        self.__on_start = on_start
+        self.__stop_r, self.__stop_w = os.pipe()
+        self.__thread = threading.Thread(name=f'lane-{os.path.basename(device.path)}', target=self.__run)
+        self.__thread.setDaemon(True)
+
+    def start(self):
+        self.__thread.start()
+
+    def __run(self):
+        self.native_id = threading.get_native_id()
+        if self.__on_start:
+            self.__on_start()
+
+        poller = select.poll()
+        poller.register(self.device.fd, select.POLLIN)
+        poller.register(self.__stop_r, select.POLLIN)
+        try:
+            while True:
+                for fd, flags in poller.poll():
+                    if fd == self.__stop_r:
+                        return
+                    if flags & (select.POLLHUP | select.POLLERR | select.POLLNVAL):
+                        return  # Device lost. The udev monitor will refresh the devices.
+                    self.__handler(self.device, flags)
+        except OSError:
+            if debug: traceback.print_exc()
+        except SystemExit as ex:
+            # exit() was called on this thread; exit the process from the main loop instead.
+            glib.idle_add(lambda: exit(ex.code))
+
+    def stop(self):
+        os.write(self.__stop_w, b'x')
+        if threading.current_thread() is not self.__thread:
+            self.__thread.join(1)
+        os.close(self.__stop_r)
+        os.close(self.__stop_w)
+
+
+EVIOCSMASK = 0x40104593  # _IOW('E', 0x93, struct input_mask)
+
+
+def _mask_bits(codes: Optional[Iterable[int]]) -> ctypes.Array:
+    """Return a kernel bitmap (an array of longs) with the bits for `codes` set. None sets all the bits."""
+    bits = ctypes.sizeof(ctypes.c_ulong) * 8
+    if codes is None:
+        count = 1024 // bits  # More than KEY_CNT; the kernel copies only what it needs.
+        return (ctypes.c_ulong * count)(*([(1 << bits) - 1] * count))
+    codes = list(codes)
+    words = (ctypes.c_ulong * (max(codes, default=0) // bits + 1))()
+    for code in codes:
+        words[code // bits] |= 1 << (code % bits)
+    return words
+
+
+def set_event_mask(device: evdev.InputDevice, events: Dict[int, Optional[Iterable[int]]]) -> None:
+    """Program the kernel event mask (EVIOCSMASK) of a device's fd, so that only the given event types are
+    delivered, and for the types with a code list, only those codes. EV_SYN is always delivered, and the kernel
+    drops the frames that become empty.
+
+    Raises OSError when the kernel doesn't support it (before 4.4).
+    """
+    def set_mask(type: int, codes: Optional[Iterable[int]]):
+        words = _mask_bits(codes)
+        fcntl.ioctl(device.fd, EVIOCSMASK,
+                    struct.pack('IIQ', type, ctypes.sizeof(words), ctypes.addressof(words)))
+
+    for type, codes in events.items():
+        set_mask(type, codes)
+    set_mask(0, events.keys())  # Type 0 is the mask of the event types.
+
+
+def _is_pointer_device(device: evdev.InputDevice) -> bool:
+    caps = device.capabilities()
+    return e.EV_REL in caps or e.EV_ABS in caps
+
+
+def _events_signature(uinput_events: Optional[Dict[int, Iterable[int]]]) -> str:
+    """Return a string identifying the capabilities of a uinput device."""
+    if uinput_events is None:
+        return 'default'
+    return json.dumps(sorted([t, sorted(codes)] for t, codes in uinput_events.items()))
+
+
+# Modifier keys press_key() may send.
+PRESS_KEY_MODIFIERS = (ecodes.KEY_LEFTALT, ecodes.KEY_LEFTCTRL, ecodes.KEY_LEFTSHIFT, ecodes.KEY_LEFTMETA)
+
+
+def key_events_for(*keys: Iterable[int], modifiers=True) -> Dict[int, List[int]]:
+    """Return a minimal uinput event dictionary that can send the given keys.
+
+    Non-positive values are ignored, so tables with special values can be passed as-is.
+    If modifiers is true, the modifier keys press_key() uses are added too.
+    """
+    codes = {k for iterable in keys for k in iterable if k > 0}
+    if modifiers:
+        codes.update(PRESS_KEY_MODIFIERS)
+    return {ecodes.EV_KEY: sorted(codes)}
+
+
+def _is_own_uinput(device: pyudev.Device, own_sys_paths: set) -> bool:
+    """Return whether a udev device is (a child of) a key-remapper uinput device.
+
+    own_sys_paths remembers the sys paths of such devices, because children (e.g. eventN) don't have
+    the name, and their parent may already be gone when they're removed.
+    """
+    name = device.properties.get('NAME', '').strip('"')
+    if name.startswith(UINPUT_DEVICE_NAME):
+        own_sys_paths.add(device.sys_path)
+        return True
+    return any(device.sys_path.startswith(p + '/') for p in own_sys_paths)
+
+
+def _take_handoff() -> Optional[dict]:
+    """Return the handoff from the previous process image, if any, and remove it from the environment.
+    """
+    data = os.environ.pop(HANDOFF_ENV, None)
+    if not data:
+        return None
+    try:
+        return json.loads(data)
+    except ValueError:
+        if not quiet: print(f'Ignoring broken {HANDOFF_ENV}', file=sys.stderr)
+        return None
+
+
 class TaskTrayIcon:
     def __init__(self, name, icon_path):
         self.name = name
@@ -203,7 +1843,8 @@ def die_on_exception(func):
 
 
 class RemapperTrayIcon(TaskTrayIcon):
-    def __init__(self, name, icon_path):
+    def __init__(self, name, icon_path, restart_handler: Optional[Callable[[], None]] = None):
+        self.restart_handler = restart_handler
         super().__init__(name, icon_path)
 
     def _add_menu_items(self, menu):
@@ -214,10 +1855,53 @@ class RemapperTrayIcon(TaskTrayIcon):
         super()._add_menu_items(menu)
 
     def restart(self, source):
+        if self.restart_handler:
+            self.restart_handler()
+            return
         call_at_exists()
         os.execv(sys.argv[0], sys.argv)
 
 
+class AppLayer:
+    """Key bindings that are active only while a matching window has the focus. See BaseRemapper.add_app_layer().
+
+    A window matches when all the given conditions match:
+      class_group: The class group name. e.g. "Google-chrome".
+      class_instance: The class instance name.
+      title: A regex searched in the window title.
+    (See get_active_window() for how to find them.)
+    """
+    def __init__(self, name: str, *, class_group: Optional[str] = None, class_instance: Optional[str] = None,
+                 title: Optional[str] = None):
+        self.name = name
+        self.class_group = class_group
+        self.class_instance = class_instance
+        self.title = re.compile(title) if title else None
+        self.bindings: Dict[Tuple[int, int], Tuple[Optional[str], Union[int, Tuple[int, str], Callable]]] = {}
+
+    def matches(self, title: str, class_group_name: str, class_instance_name: str) -> bool:
+        if self.class_group is not None and self.class_group != class_group_name:
+            return False
+        if self.class_instance is not None and self.class_instance != class_instance_name:
+            return False
+        if self.title and not self.title.search(title):
+            return False
+        return True
+
+    def bind(self, key: int, action: Union[int, Tuple[int, str], Callable[[evdev.InputEvent], None]], *,
+             values: Iterable[int] = (1,), modifiers: Optional[str] = None) -> 'AppLayer':
+        """Bind a key.
+
+        action: A key to press with press_key(), a (key, modifiers) tuple for press_key(), or a callable
+            taking the event.
+        values: The event values to handle. Defaults to key presses only.
+        modifiers: If not None, the modifiers that must be pressed, as in check_modifiers().
+        """
+        for value in values:
+            self.bindings[(key, value)] = (modifiers, action)
+        return self
+
+
 class DoneEvent(Exception):
     pass
 
@@ -239,10 +1923,70 @@ class BaseRemapper():
                  grab_devices=True,
                  write_to_uinput=True,
                  uinput_events: Optional[Dict[int, Iterable[int]]] = None,
+                 input_events: Optional[Dict[int, Optional[Iterable[int]]]] = None,
                  global_lock_name: str = MAIN_FILE_NANE,
                  uinput_device_name_suffix: str = "-" + MAIN_FILE_NANE,
+                 dispatch_lanes: str = 'main',
+                 rel_coalesce_lag_ms: float = 0,
+                 control_socket=False,
+                 synthesize_msc_timestamp=False,
+                 headless=False,
+                 output_queue: Optional[str] = None,
+                 output_queue_size=256,
+                 use_broker=False,
+                 observer_ring=False,
+                 stall_budget_ms: float = 0,
+                 inject_socket=False,
+                 latency_budget_ms: float = 0,
+                 latency_budget_overruns=3,
+                 passthrough_cooldown_s: float = 10,
                  enable_debug=False,
                  force_quiet=False):
+        """
+        input_events: The event types, and optionally codes, the remapper consumes, e.g.
+            {EV_KEY: None} for all keys but no MSC_SCAN. The kernel doesn't deliver the other events
+            (see set_event_mask()), so they never wake us up. None delivers everything.
+        dispatch_lanes: How input devices are serviced.
+            'main': All devices are handled on the main loop, in arrival order.
+            'priority': Pointer devices (ones with EV_REL or EV_ABS) are drained before the other devices
+                on the main loop.
+            'threads': Each pointer device is handled on its own thread, so slow keyboard handlers
+                (e.g. get_active_window()) don't delay pointer motion. Keyboards stay on the main loop.
+                Key states are protected by the remapper's lock, and each uinput device serializes
+                its writes, so the output order from each device is preserved.
+                on_preprocess_events(), on_handle_events() (and so on_handle_event() / on_handle_frame()),
+                on_resync() and sequence actions are then called on the lane thread for pointer devices,
+                at the same time as the main loop handles the keyboards. The handling of each device,
+                including its combo and sequence timeouts (run on the main loop), is serialized by a
+                per-device lock, so they never run at the same time for the same device. All the other
+                hooks run on the main loop.
+        rel_coalesce_lag_ms: When events are handled more than this late (measured against the kernel timestamps),
+            relative motion and wheel events written by the handler are merged (see coalesce_rel_events())
+            until it catches up. 0 (the default) disables it.
+        control_socket: Serve metrics, states and commands on a Unix-domain socket. See __handle_control_command().
+        synthesize_msc_timestamp: Add MSC_TIMESTAMP, derived from the source frame's timestamp, to frames written
+            by on_handle_frame() that don't have one, if the uinput device supports it. Note the kernel
+            re-stamps events injected via uinput, so MSC_TIMESTAMP is the only way to tell downstream
+            (e.g. libinput) when the original sample was taken.
+        headless: Don't show the tray icon or desktop notifications; notifications are printed to stderr instead.
+            Useful for running without a desktop session, e.g. from benchmarks.
+        output_queue: If set, the uinput devices are written by writer threads, in batches, and this is
+            the policy when `output_queue_size` frames are pending: 'block', 'drop-coalesce' or 'error'.
+            See SyncedUinput.
+        use_broker: Send the output to uinput-broker.py instead of creating uinput devices, if it's running.
+            See BrokerUinput.
+        observer_ring: Publish the input and output events, and publish_state(), to a shared memory ring buffer
+            that other processes (e.g. on-screen displays) can follow. See ObserverRing.
+        stall_budget_ms: Report when the main loop, or an input handler, is stuck for longer than this, with the
+            Python stack of the stuck thread. See StallWatchdog. 0 disables it.
+        inject_socket: Accept keys and events to send on a Unix-domain socket, so other programs don't need to
+            spawn xdotool and the like. See __handle_inject_command().
+        latency_budget_ms: When handling a device's input takes longer than this `latency_budget_overruns` times
+            within `passthrough_cooldown_s`, or a handler raises an exception, stop remapping the device and ungrab
+            it for `passthrough_cooldown_s`, so typing keeps working whatever the handlers do and whatever the
+            uinput device supports. It's grabbed again once no keys are held on it. 0 (the default) disables
+            it, and exceptions then end the process.
+        """
         self.remapper_name = remapper_name
         self.remapper_icon = remapper_icon
 
@@ -252,26 +1996,108 @@ class BaseRemapper():
         self.grab_devices = grab_devices
         self.write_to_uinput = write_to_uinput
         self.uinput_events = uinput_events
+        self.input_events = input_events
         self.global_lock_name = global_lock_name
         self.uinput_device_name_suffix = uinput_device_name_suffix
+        self.dispatch_lanes = dispatch_lanes
+        self.rel_coalesce_lag_ms = rel_coalesce_lag_ms
+        self.control_socket = control_socket
+        self.synthesize_msc_timestamp = synthesize_msc_timestamp
+        self.headless = headless
+        self.output_queue = output_queue
+        self.output_queue_size = output_queue_size
+        self.broker_path: Optional[str] = broker_socket_path() if use_broker else None
+        self.observer_ring = observer_ring
+        self.observer: Optional[ObserverRing] = None
+        self.published_state: Dict[str, object] = {}
+        self.stall_budget_ms = stall_budget_ms
+        self.latency_budget_ms = latency_budget_ms
+        self.latency_budget_overruns = latency_budget_overruns
+        self.passthrough_cooldown_s = passthrough_cooldown_s
+        self.watchdog: Optional[StallWatchdog] = None
+        self.stalls: collections.deque = collections.deque(maxlen=16)  # Recent StallReports.
         self.enable_debug = enable_debug
         self.force_quiet = force_quiet
 
-        self.__notification = notify2.Notification(remapper_name, '')
-        self.__notification.set_urgency(notify2.URGENCY_NORMAL)
-        self.__devices = {}
-        self.tray_icon = RemapperTrayIcon(self.remapper_name, self.remapper_icon)
+        self.notifications = NotificationDispatcher(remapper_name)
+        self.__devices = {}  # path -> [device, glib source id or None, _DeviceLane or None]
+        self.__frame_assemblers: Dict[str, _FrameAssembler] = {}
+        self.__handles_frames = type(self).on_handle_frame is not BaseRemapper.on_handle_frame
+        self.tray_icon: Optional[RemapperTrayIcon] = None  # Created in main() unless headless.
+        self.keymap: Optional[Keymap] = None
+        self.keymap_path: Optional[str] = None
+        self.keymap_constants: Dict[str, int] = {}
+        self.__keymap_watcher: Optional[FileWatcher] = None
+        self.__handoff: Optional[dict] = None
+        self.__uinputs: Dict[str, Tuple[SyncedUinput, str]] = {}  # name -> (uinput, events signature)
         self.__refresh_scheduled = False
         self.__modifier_char_validator = re.compile('''[^ascw]''')
         self.__extended_modifier_char_validator = re.compile('''[^ascwes]''')
 
         self.__lock = threading.RLock()
 
+        # Time from the kernel timestamp of the first event in a read to the start of its handling.
+        self.input_latency = LatencyHistogram('Input latency')
+        # Time spent in on_handle_events().
+        self.handler_latency = LatencyHistogram('Handler time')
+        # How long combo candidates were held back before being resolved. See add_combo().
+        self.combo_latency = LatencyHistogram('Combo delay')
+        self.__combos: List[Combo] = []
+        self.__combo_engines: Dict[str, ComboEngine] = {}  # device path -> engine
+        self.__sequences: List[Sequence] = []
+        self.__sequence_matchers: Dict[str, SequenceMatcher] = {}  # device path -> matcher
+        self.__expiry_timers: Dict[object, int] = {}  # ComboEngine or SequenceMatcher -> glib source id
+        # device path -> lock held while handling its input, on the main loop or its lane.
+        self.__device_locks: Dict[str, threading.RLock] = {}
+        self.realtime = False
+        self.__realtime_args = None
+        self.__realtime_report: List[str] = []
+        self.__rt_scheduler: Optional[Tuple[int, os.sched_param]] = None
+        self.__original_affinity: Optional[set] = None
+        self.__last_input_time = 0.0
+
+        # Output written by the current thread's handler that's held back to be written at once.
+        self.__output_buffer = threading.local()
+        # The timestamp of the input being handled by the current thread, as (sec, usec). See new_event().
+        self.__source_time = threading.local()
+        self.__msc_timestamp_base: Optional[int] = None
+        self.backlogged_read_count = 0  # Reads handled later than rel_coalesce_lag_ms.
+        self.coalesced_rel_count = 0  # REL events saved by merging.
+
+        # Counters for collect_metrics(). They're updated without locking and read the same way.
+        self.events_in: Dict[str, int] = collections.defaultdict(int)  # device path -> count
+        self.rule_hit_count = 0  # matches_key() calls that matched.
+        self.hotplug_rescan_count = 0
+        self.resync_count = 0  # Key state resyncs after SYN_DROPPED.
+        self.passthrough_count = 0  # Times a device was switched to passthrough.
+        # Guards events_in, __overruns, __passthrough_until and __expiry_timers, which lanes update too.
+        self.__stats_lock = threading.Lock()
+        self.__overruns: Dict[str, Deque[float]] = {}  # device path -> monotonic times of recent overruns
+        self.__passthrough_until: Dict[str, float] = {}  # device path -> monotonic time to resume remapping
+        self.led_states: Dict[str, List[int]] = {}  # device path -> lit LEDs, as of the last resync.
+        # Recent input events, for the "trace" command.
+        self.trace: collections.deque = collections.deque(maxlen=256)
+        self.control_socket_path: Optional[str] = None
+        self.inject_socket_path: Optional[str] = None
+        self.inject_socket = inject_socket
+        self.injected_event_count = 0
+        self.profiler: Optional[RuleProfiler] = None
+
+        self.__app_layers: List[AppLayer] = []
+        # The merged bindings of the layers matching the active window; replaced when the focus changes.
+        self.__active_app_table: Dict[Tuple[int, int], Tuple] = {}
+        self.active_app_layers: List[str] = []
+        self.__app_layer_cache: Dict[Tuple, Tuple[Dict, List[str]]] = {}  # Memoized per window and title.
+        self.__window_name_handler = None
+        self.__control_server: Optional[UnixCommandServer] = None
+        self.__inject_server: Optional[UnixCommandServer] = None
+
     def show_notification(self, message: str, timeout_ms=3000) -> None:
+        if self.headless:
+            if not self.force_quiet: print(message, file=sys.stderr)
+            return
         if self.enable_debug: print(message)
-        self.__notification.update(self.remapper_name, message)
-        self.__notification.set_timeout(timeout_ms)
-        self.__notification.show()
+        self.notifications.post(message, timeout_ms)
 
     def uinput_events_add_all_keys_events(self, uinput_events:Optional[Dict[int, Iterable[int]]]=None) \
             -> Dict[int, Iterable[int]]:
@@ -286,6 +2112,67 @@ class BaseRemapper():
     def on_initialize(self):
         pass
 
+    def get_uinput_events(self) -> Optional[Dict[int, Iterable[int]]]:
+        """Return the capabilities of the main uinput device. Defaults to `uinput_events`.
+
+        Override to derive a minimal set from the keymaps (see key_events_for()), so that the device
+        doesn't register every KEY_* and BTN_* code. Called after the keymap file is loaded.
+        """
+        return self.uinput_events
+
+    def get_input_events(self) -> Optional[Dict[int, Optional[Iterable[int]]]]:
+        """Return the events to receive from the input devices. Defaults to `input_events`.
+
+        Override to derive it from the keymaps. Re-applied when the keymap file is reloaded.
+        """
+        return self.input_events
+
+    def on_save_state(self) -> dict:
+        """Return the remapper's state (e.g. the current mode) to carry over restart().
+
+        The result must be JSON-serializable.
+        """
+        return {}
+
+    def on_restore_state(self, state: dict) -> None:
+        """Restore the state saved by on_save_state() in the previous process image."""
+        pass
+
+    def on_keymap_loaded(self, keymap: Keymap):
+        """Called when the keymap file given with --keymap is loaded or reloaded.
+
+        Subclasses should replace their lookup tables here. Devices and uinput devices are
+        kept as-is.
+        """
+        pass
+
+    def __load_keymap(self) -> bool:
+        start = time.perf_counter()
+        try:
+            keymap = Keymap.load(self.keymap_path, self.keymap_constants)
+            # Subclasses swap in the new tables all at once here.
+            self.on_keymap_loaded(keymap)
+        except (KeymapError, OSError, KeyError, ValueError) as ex:
+            if not quiet: print(f'Unable to load keymap: {ex!r}', file=sys.stderr)
+            self.show_notification(f'Unable to load keymap:\n{ex!r}')
+            return False
+
+        self.keymap = keymap
+        if self.write_to_uinput and self.__uinputs:
+            name = UINPUT_DEVICE_NAME + self.uinput_device_name_suffix
+            if name in self.__uinputs and self.__uinputs[name][1] != _events_signature(self.get_uinput_events()):
+                # Don't re-create the device here; restart() does it and keeps the grabs.
+                self.show_notification('The keymap uses keys the uinput device was not created with.\n'
+                                       'Restart to apply.')
+        if debug: print(f'# Keymap loaded in {(time.perf_counter() - start) * 1000:.2f} ms: {self.keymap_path}')
+        return True
+
+    def __reload_keymap(self):
+        if self.__load_keymap():
+            for device, _, _ in self.__devices.values():
+                self.__apply_event_mask(device)
+            self.show_notification(f'Keymap reloaded:\n{self.keymap_path}')
+
     def on_device_detected(self, devices: List[evdev.InputDevice]):
         self.show_notification('Device connected:\n'
                                + '\n'.join('- ' + d.name for d in devices))
@@ -316,6 +2203,90 @@ class BaseRemapper():
 
         return (w.get_name(), w.get_class_group_name(), w.get_class_instance_name())
 
+    def add_app_layer(self, layer: AppLayer) -> AppLayer:
+        """Add per-application key bindings. Use handle_app_layers() in the handler to apply them.
+
+        The layers matching the active window are selected and merged once when the focus (or the window
+        title) changes, so handling an event is a single dictionary lookup. When multiple layers bind
+        the same key, the one added first wins.
+        """
+        self.__app_layers.append(layer)
+        return layer
+
+    def handle_app_layers(self, ev: evdev.InputEvent) -> bool:
+        """Run the binding for `ev` in the active app layers, if any. Returns True if handled."""
+        binding = self.__active_app_table.get((ev.code, ev.value))
+        if binding is None:
+            return False
+        modifiers, action = binding
+        if modifiers is not None and not self.check_modifiers(modifiers):
+            return False
+
+        self.rule_hit_count += 1
+        self.__run_action(action, ev)
+        return True
+
+    def __run_action(self, action: Union[int, Tuple[int, str], Callable[[evdev.InputEvent], None]],
+                     ev: evdev.InputEvent) -> None:
+        if callable(action):
+            action(ev)
+        elif isinstance(action, tuple):
+            self.press_key(*action)
+        else:
+            self.press_key(action)
+
+    def __select_app_layers(self, window) -> None:
+        if window is None:
+            key = (0, '', '', '')
+        else:
+            key = (window.get_xid(), window.get_name(), window.get_class_group_name(),
+                   window.get_class_instance_name())
+
+        cached = self.__app_layer_cache.get(key)
+        if cached is None:
+            table = {}
+            names = []
+            for layer in self.__app_layers:
+                if layer.matches(*key[1:]):
+                    names.append(layer.name)
+                    for k, v in layer.bindings.items():
+                        table.setdefault(k, v)
+            if len(self.__app_layer_cache) > 256:
+                self.__app_layer_cache.clear()
+            cached = self.__app_layer_cache[key] = (table, names)
+
+        if self.active_app_layers != cached[1]:
+            self.publish_state('app_layers', ','.join(cached[1]))
+        self.__active_app_table, self.active_app_layers = cached
+        if debug: print(f'# Active app layers: {self.active_app_layers}')
+
+    def __start_app_layer_tracking(self):
+        screen = None if self.headless else wnck.Screen.get_default()
+        if screen is None:
+            # No X11 display (e.g. Wayland), or headless.
+            if not quiet: print('Unable to track the active window; app layers are disabled.', file=sys.stderr)
+            return
+
+        def on_name_changed(window):
+            self.__select_app_layers(window)
+
+        def on_active_window_changed(screen, previous_window):
+            if self.__window_name_handler:
+                old_window, handler_id = self.__window_name_handler
+                self.__window_name_handler = None
+                try:
+                    old_window.disconnect(handler_id)
+                except Exception:
+                    pass  # The window is already gone.
+            window = screen.get_active_window()
+            if window:
+                self.__window_name_handler = (window, window.connect('name-changed', on_name_changed))
+            self.__select_app_layers(window)
+
+        screen.connect('active-window-changed', on_active_window_changed)
+        screen.force_update()
+        on_active_window_changed(screen, None)
+
     def __start_udev_monitor(self):
         pr, pw = os.pipe()
         os.set_blocking(pr, False)
@@ -329,9 +2300,17 @@ class BaseRemapper():
                 monitor.filter_by(subsystem='input')
                 if debug: print('Device monitor started.')
 
+                own_sys_paths = set()
                 for action, device in monitor:
+                    # Ignore uinput devices created by key-remapper instances, including ourselves,
+                    # so they don't make all the instances re-scan devices.
+                    if _is_own_uinput(device, own_sys_paths):
+                        if action == 'remove':
+                            own_sys_paths.discard(device.sys_path)
+                        if debug: print(f'udev: ignoring action={action} {device}')
+                        continue
                     if debug: print(f'udev: action={action} {device}')
-                    writer.writelines(action)
+                    writer.write(action + '\n')
                     writer.flush()
             except:
                 traceback.print_exc()
@@ -349,7 +2328,10 @@ class BaseRemapper():
         if debug: print('# Releasing devices...')
         for path, t in self.__devices.items():
             if debug: print(f'  Releasing {path}')
-            glib.source_remove(t[1])
+            if t[1] is not None:
+                glib.source_remove(t[1])
+            if t[2] is not None:
+                t[2].stop()
             try:
                 t[0].ungrab()
             except IOError:
@@ -358,6 +2340,16 @@ class BaseRemapper():
                 t[0].close()
             except IOError:
                 pass  # ignore
+        self.__devices.clear()
+        self.__frame_assemblers.clear()
+        with self.__stats_lock:
+            for tag in self.__expiry_timers.values():
+                get_clock().cancel(tag)
+            self.__expiry_timers.clear()
+            self.__overruns.clear()
+            self.__passthrough_until.clear()
+        for engine in itertools.chain(self.__combo_engines.values(), self.__sequence_matchers.values()):
+            engine.reset()
 
     def __open_devices(self):
         self.__release_devices()
@@ -394,14 +2386,31 @@ class BaseRemapper():
                     if c == e.EV_KEY:
                         add = True
 
-            if add and self.grab_devices:
+            inherited_fd = self.__handoff['devices'].pop(device.path, None) if self.__handoff else None
+            if add and inherited_fd is not None:
+                # Take over the fd from the previous process image, which is still grabbed.
+                os.dup2(inherited_fd, device.fd, inheritable=False)
+                os.close(inherited_fd)
+                if debug: print(f'  Inherited grabbed fd for {device.path}')
+            elif inherited_fd is not None:
+                os.close(inherited_fd)
+            elif add and self.grab_devices:
                 try:
                     device.grab()
                 except IOError:
                     if not quiet: print(f'Unable to grab {device.path}', file=sys.stderr)
+                # Keys held while grabbing won't send presses to us; take them from the kernel.
+                try:
+                    held = device.active_keys()
+                except OSError:
+                    held = []
+                with self.__lock:
+                    for key in held:
+                        self.__orig_key_states[key] = 1
 
             if add:
                 if debug: print(f"Using device: {device}")
+                self.__apply_event_mask(device)
             else:
                 try:
                     device.close()
@@ -409,8 +2418,17 @@ class BaseRemapper():
                     pass
                 continue
 
-            tag = glib.io_add_watch(device, glib.IO_IN, self.__on_input_event)
-            self.__devices[device.path] = [device, tag]
+            is_pointer = _is_pointer_device(device)
+            if self.dispatch_lanes == 'threads' and is_pointer:
+                lane = _DeviceLane(device, self.__on_input_event, self.__on_lane_started)
+                lane.start()
+                self.__devices[device.path] = [device, None, lane]
+            else:
+                priority = glib.PRIORITY_DEFAULT
+                if self.dispatch_lanes == 'priority' and is_pointer:
+                    priority = glib.PRIORITY_HIGH
+                tag = glib.io_add_watch(device, priority, glib.IO_IN, self.__on_input_event)
+                self.__devices[device.path] = [device, tag, None]
 
         # We just opened the devices, so drain all udev monitor events.
         if self.__udev_monitor:
@@ -421,6 +2439,28 @@ class BaseRemapper():
         else:
             self.on_device_not_found()
 
+    def __apply_event_mask(self, device: evdev.InputDevice):
+        events = self.get_input_events()
+        if events is None:
+            return
+        try:
+            set_event_mask(device, events)
+        except OSError as ex:
+            if debug: print(f'  Unable to set the event mask of {device.path}: {ex!r}')
+
+    def __on_lane_started(self):
+        # Lanes get the real-time priority (see __setup_realtime()) but not the CPU pinning of the main loop.
+        if self.__original_affinity:
+            try:
+                os.sched_setaffinity(0, self.__original_affinity)
+            except OSError:
+                pass
+        if self.__rt_scheduler:
+            try:
+                os.sched_setscheduler(0, *self.__rt_scheduler)
+            except OSError:
+                pass
+
     def __schedule_refresh_devices(self):
         if self.__refresh_scheduled:
             return
@@ -428,6 +2468,7 @@ class BaseRemapper():
 
         def call_refresh():
             self.__refresh_scheduled = False
+            self.hotplug_rescan_count += 1
             self.on_device_lost()
             self.__open_devices()
             return False
@@ -435,12 +2476,12 @@ class BaseRemapper():
         # Re-open the devices, but before that, wait a bit because udev sends multiple add events in a row.
         # Also randomize the delay to avoid multiple instances of keymapper
         # clients don't race.
-        glib.timeout_add(random.uniform(1, 2) * 1000, call_refresh)
+        get_clock().call_later(random.uniform(1, 2) * 1000, call_refresh)
 
     def __on_udev_event(self, udev_monitor: TextIO, condition):
         refresh_devices = False
         for event in udev_monitor.readlines():  # drain all the events
-            if event in ['add', 'remove']:
+            if event.strip() in ['add', 'remove']:
                 if debug:
                     print('# Udev device change detected.')
                     sys.stdout.flush()
@@ -452,44 +2493,399 @@ class BaseRemapper():
 
         return True
 
+    def __device_lock(self, device: evdev.InputDevice) -> threading.RLock:
+        lock = self.__device_locks.get(device.path)
+        if lock is None:
+            lock = self.__device_locks.setdefault(device.path, threading.RLock())
+        return lock
+
     def __on_input_event(self, device: evdev.InputDevice, condition):
-        events = []
-        for ev in device.read():
-            events.append(ev)
+        # Called on the main loop, or on the device's lane (see dispatch_lanes).
+        with self.__device_lock(device):
+            return self.__handle_input(device, condition)
+
+    def __handle_input(self, device: evdev.InputDevice, condition):
+        assembler = self.__frame_assemblers.get(device.path)
+        if not assembler:
+            assembler = self.__frame_assemblers[device.path] = _FrameAssembler()
+        events = assembler.feed(device.read())
+        if self.watchdog:
+            self.watchdog.begin((device.path, events))
+        delta = []
+        if assembler.resync_needed:
+            assembler.resync_needed = False
+            delta = self.__resync(device)
+            if device.path in self.__combo_engines:
+                self.__combo_engines[device.path].reset()
+            if device.path in self.__sequence_matchers:
+                self.__sequence_matchers[device.path].reset()
+
+        now = get_clock().time()
+        start = time.perf_counter()
+        self.__last_input_time = now
+        lag = 0
+        if events:
+            lag = now - events[0].timestamp()
+            self.input_latency.record(lag)
+        backlogged = self.rel_coalesce_lag_ms and lag * 1000 > self.rel_coalesce_lag_ms
+
+        if self.__passthrough_until and self.__is_passing_through(device):
+            with self.__stats_lock:
+                self.events_in[device.path] += len(events)
+            try:
+                self.__pass_through(events)
+                if delta:
+                    # __resync() has updated the key states; let the remapper reset what depends on them.
+                    try:
+                        self.on_resync(device)
+                    except Exception:
+                        traceback.print_exc()
+            finally:
+                if self.watchdog:
+                    self.watchdog.end()
+            return True
 
         events = self.on_preprocess_events(device, events)
 
+        with self.__stats_lock:
+            self.events_in[device.path] += len(events)
+        if self.__combos:
+            events = self.__feed_combos(device, events)
+        try:
+            self.__dispatch(device, events, delta, backlogged)
+        finally:
+            if self.profiler:
+                self.profiler.end_handler()
+            if self.watchdog:
+                self.watchdog.end()
+
+        elapsed = time.perf_counter() - start
+        self.handler_latency.record(elapsed)
+        if self.latency_budget_ms and elapsed * 1000 > self.latency_budget_ms:
+            self.__on_overrun(device, elapsed)
+        return True
+
+    def __on_overrun(self, device: evdev.InputDevice, elapsed: float) -> None:
+        now = get_clock().monotonic()
+        with self.__stats_lock:
+            overruns = self.__overruns.get(device.path)
+            if overruns is None:
+                overruns = self.__overruns[device.path] = collections.deque(maxlen=self.latency_budget_overruns)
+            overruns.append(now)
+            exceeded = len(overruns) == overruns.maxlen and now - overruns[0] <= self.passthrough_cooldown_s
+        if debug: print(f'# Handling {device.path} took {elapsed * 1000:.1f} ms')
+        if exceeded:
+            self.__start_passthrough(device, f'handling took over {self.latency_budget_ms:g} ms '
+                                             f'{len(overruns)} times')
+
+    def __on_handler_error(self, device: evdev.InputDevice, events: List[evdev.InputEvent]) -> None:
+        traceback.print_exc()
+        if not self.latency_budget_ms:
+            exit(1)
+        # The events that made it fail are dropped; the ones after them go to the device directly.
+        self.__start_passthrough(device, 'the handler raised an exception')
+        self.__pass_through(events)
+
+    def __start_passthrough(self, device: evdev.InputDevice, reason: str) -> None:
+        with self.__stats_lock:
+            if device.path in self.__passthrough_until:
+                return
+            self.__passthrough_until[device.path] = get_clock().monotonic() + self.passthrough_cooldown_s
+        self.passthrough_count += 1
+        for engines in (self.__combo_engines, self.__sequence_matchers):
+            if device.path in engines:
+                engines[device.path].reset()
+
+        # Let the kernel deliver the device's events directly; our uinput device may not support all of them.
+        # What we pressed on the uinput device would get stuck, so release it.
+        if self.write_to_uinput:
+            self.reset_all_keys()
+        if self.grab_devices:
+            try:
+                device.ungrab()
+            except IOError:
+                pass
+
+        self.show_notification(f'{reason}; passing {device.name} through unchanged '
+                               f'for {self.passthrough_cooldown_s:g} seconds')
+
+    def __is_passing_through(self, device: evdev.InputDevice) -> bool:
+        until = self.__passthrough_until.get(device.path)
+        if until is None:
+            return False
+        if get_clock().monotonic() < until:
+            return True
+        try:
+            if device.active_keys():
+                return True  # Wait until the keys are released, or the compositor would never see their releases.
+        except OSError:
+            pass
+        if not quiet: print(f'# Resuming remapping {device.path}', file=sys.stderr)
+        if self.grab_devices:
+            try:
+                device.grab()
+            except IOError:
+                if not quiet: print(f'Unable to grab {device.path}', file=sys.stderr)
+        with self.__stats_lock:
+            del self.__passthrough_until[device.path]
+            self.__overruns.pop(device.path, None)
+        self.on_resync(device)
+        return False
+
+    def __pass_through(self, events: List[evdev.InputEvent]) -> None:
+        # The device isn't grabbed, so the kernel has delivered them already; just track the key states.
+        with self.__lock:
+            for ev in events:
+                if ev.type == ecodes.EV_KEY:
+                    self.__orig_key_states[ev.code] = ev.value
+
+    def __dispatch(self, device: evdev.InputDevice, events: List[evdev.InputEvent],
+                   delta: List[evdev.InputEvent] = (), backlogged=False) -> None:
+        if self.observer:
+            self.observer.publish_events(OBSERVE_INPUT, events)
+        with self.__lock:
+            for ev in events:
+                if ev.type == ecodes.EV_KEY:
+                    self.__orig_key_states[ev.code] = ev.value
         for ev in events:
-            with self.__lock:
-                self.__orig_key_states[ev.code] = ev.value
+            if ev.type != ecodes.EV_SYN:
+                self.trace.append((ev.timestamp(), device.path, ev.type, ev.code, ev.value))
 
         if debug:
             for ev in events:
                 print(f'-> Event: {ev}')
 
         try:
-            self.on_handle_events(device, events)
+            if delta:
+                # Replay what we missed as one frame, then release what's still stuck.
+                self.__begin_output_buffer()
+                try:
+                    self.on_handle_events(device, delta)
+                finally:
+                    self.__flush_output_buffer()
+                self.__release_orphaned_keys()
+                self.on_resync(device)
+            if backlogged:
+                # We're behind; merge the relative motion in this read into as few frames as possible.
+                self.backlogged_read_count += 1
+                self.__begin_output_buffer()
+                try:
+                    self.__handle_events(device, events)
+                finally:
+                    self.__flush_output_buffer(coalesce_rel=True)
+            else:
+                self.__handle_events(device, events)
+        except Exception:
+            self.__on_handler_error(device, events)
         except:
             traceback.print_exc()
             exit(1)
 
-        return True
+    def __handle_events(self, device: evdev.InputDevice, events: List[evdev.InputEvent]) -> None:
+        if not self.__sequences:
+            self.on_handle_events(device, events)
+            return
+        matcher = self.__sequence_matchers.get(device.path)
+        if not matcher:
+            matcher = self.__sequence_matchers[device.path] = SequenceMatcher(self.__sequences)
+        self.__run_sequences(device, matcher.feed(events, get_clock().monotonic()))
+        self.__schedule_expiry(device, matcher, lambda resolved: self.__run_sequences(device, resolved))
+
+    def __run_sequences(self, device: evdev.InputDevice,
+                        resolved: List[Tuple[Optional[Sequence], List[evdev.InputEvent]]]) -> None:
+        for sequence, events in resolved:
+            if sequence is None:
+                self.on_handle_events(device, events)
+                continue
+            if debug: print(f'# Sequence matched: {events}')
+            self.rule_hit_count += 1
+            with self.source_timestamp(events[-1]):
+                try:
+                    self.__run_action(sequence.action, events[-1])
+                except DoneEvent:
+                    pass
+
+    def add_combo(self, keys: Iterable[int], output: int, window_ms: float = 30) -> None:
+        """Make pressing all of `keys` within `window_ms` act as pressing `output`, until one of them is released.
+
+        The handlers see the output key instead of the keys, e.g. add_combo((KEY_J, KEY_K), KEY_ESC) makes
+        J+K act as ESC, including as a modifier. Presses that may start a combo are delayed until it's
+        decided, at most `window_ms`. See ComboEngine.
+        """
+        self.__combos.append(Combo(frozenset(keys), output, window_ms / 1000))
+        for engine in self.__combo_engines.values():
+            engine.reset()
+        self.__combo_engines.clear()
+
+    def add_sequence(self, events: Iterable[Tuple[int, int, int]],
+                     action: Union[int, Tuple[int, str], Callable[[evdev.InputEvent], None]],
+                     timeout_ms: float = 1000) -> None:
+        """Run `action` when the (type, code, value) `events` come in this order within `timeout_ms`.
+
+        e.g. add_sequence([(EV_KEY, KEY_ESC, 1), (EV_KEY, KEY_ESC, 0), (EV_KEY, KEY_G, 1)], ...) for a leader key.
+        The matched events are not passed to the handlers. `action` is as in AppLayer.bind(), and gets the last
+        event. See SequenceMatcher.
+        """
+        self.__sequences.append(Sequence(tuple(tuple(e) for e in events), action, timeout_ms / 1000))
+        for matcher in self.__sequence_matchers.values():
+            matcher.reset()
+        self.__sequence_matchers.clear()
+
+    def __feed_combos(self, device: evdev.InputDevice, events: List[evdev.InputEvent]) -> List[evdev.InputEvent]:
+        engine = self.__combo_engines.get(device.path)
+        if not engine:
+            engine = self.__combo_engines[device.path] = ComboEngine(self.__combos, self.combo_latency)
+        events = engine.feed(events, get_clock().monotonic())
+        self.__schedule_expiry(device, engine, lambda expired: self.__dispatch(device, expired))
+        return events
+
+    def __schedule_expiry(self, device: evdev.InputDevice, engine: Union[ComboEngine, SequenceMatcher],
+                          handle: Callable[[list], None]) -> None:
+        """Call engine.expire() at engine.deadline, and pass what it returns, if anything, to `handle`.
+        Called with the device lock held."""
+        if engine.deadline is None:
+            return
+
+        def expire():
+            # Runs on the main loop; the device may be handled on its lane at the same time.
+            with self.__device_lock(device):
+                with self.__stats_lock:
+                    self.__expiry_timers.pop(engine, None)
+                resolved = engine.expire(get_clock().monotonic())
+                if resolved:
+                    if debug: print(f'# {type(engine).__name__} timed out')
+                    try:
+                        handle(resolved)
+                    except Exception:
+                        self.__on_handler_error(device, [])
+                    except:
+                        traceback.print_exc()
+                        exit(1)
+                    finally:
+                        if self.profiler:
+                            self.profiler.end_handler()
+                self.__schedule_expiry(device, engine, handle)
+            return False
+
+        with self.__stats_lock:
+            if engine in self.__expiry_timers:
+                return
+            delay_ms = max(1, math.ceil((engine.deadline - get_clock().monotonic()) * 1000))
+            self.__expiry_timers[engine] = get_clock().call_later(delay_ms, expire, priority=glib.PRIORITY_HIGH)
+
+    def __resync(self, device: evdev.InputDevice) -> List[evdev.InputEvent]:
+        """Called after SYN_DROPPED. Compares the key states with the kernel's (EVIOCGKEY), and returns
+        a frame with the key transitions we missed.
+        """
+        self.resync_count += 1
+        try:
+            active = set(device.active_keys())
+            self.led_states[device.path] = device.leds()
+        except OSError:
+            return []
+        supported = set(device.capabilities().get(ecodes.EV_KEY, ()))
+        with self.__lock:
+            released = [k for k, v in self.__orig_key_states.items() if v > 0 and k in supported and k not in active]
+            pressed = [k for k in active if self.__orig_key_states[k] == 0]
+            for k in released:
+                self.__orig_key_states[k] = 0
+            for k in pressed:
+                self.__orig_key_states[k] = 1
+        if debug: print(f'# Resync {device.path}: released {released}, pressed {pressed}')
+        if not released and not pressed:
+            return []
+        sec, usec = divmod(int(get_clock().time() * 1_000_000), 1_000_000)
+        delta = [evdev.InputEvent(sec, usec, ecodes.EV_KEY, k, 0) for k in released]
+        delta += [evdev.InputEvent(sec, usec, ecodes.EV_KEY, k, 1) for k in pressed]
+        delta.append(evdev.InputEvent(sec, usec, ecodes.EV_SYN, ecodes.SYN_REPORT, 0))
+        return delta
+
+    def __release_orphaned_keys(self):
+        # If no keys are held on the input side, nothing should be held on the output side either.
+        if not self.write_to_uinput:
+            return
+        with self.__lock:
+            if any(v > 0 for v in self.__orig_key_states.values()):
+                return
+        stuck = self.uinput.get_key_states()
+        if stuck:
+            self.__write(*[evdev.InputEvent(0, 0, ecodes.EV_KEY, k, 0) for k in stuck])
+
+    def on_resync(self, device: evdev.InputDevice) -> None:
+        """Called after the key states are resynced following SYN_DROPPED, i.e. when events were lost (also while
+        passing the device through), and when remapping resumes after passing it through (see latency_budget_ms).
+        Override to reset the remapper's own state that depends on the event sequence.
+        """
+        pass
+
+    def __begin_output_buffer(self):
+        self.__output_buffer.events = []
+
+    def __flush_output_buffer(self, *, coalesce_rel=False):
+        """Write the events held by __begin_output_buffer() and stop buffering."""
+        events = getattr(self.__output_buffer, 'events', None)
+        self.__output_buffer.events = None
+        if not events:
+            return
+        if coalesce_rel:
+            before = sum(1 for ev in events if ev.type == ecodes.EV_REL)
+            events = coalesce_rel_events(events)
+            self.coalesced_rel_count += before - sum(1 for ev in events if ev.type == ecodes.EV_REL)
+        with self.__lock:
+            self.uinput.write(*events)
+
+    def __write(self, *events: evdev.InputEvent) -> None:
+        buffer = getattr(self.__output_buffer, 'events', None)
+        if buffer is not None:
+            buffer.extend(events)
+            return
+        with self.__lock:
+            self.uinput.write(*events)
+
+    def __sync_output(self) -> None:
+        """Write out buffered events before accessing the uinput device directly."""
+        if getattr(self.__output_buffer, 'events', None):
+            events = self.__output_buffer.events
+            self.__output_buffer.events = []
+            with self.__lock:
+                self.uinput.write(*events)
+
+    def set_source_timestamp(self, sec: int, usec: int) -> None:
+        """Set the timestamp that events sent from the current thread carry. The framework sets it to the
+        timestamp of the input being handled, so only synthesized events from other threads need this.
+        """
+        self.__source_time.value = (sec, usec)
+
+    @contextlib.contextmanager
+    def source_timestamp(self, ev: evdev.InputEvent):
+        """Context manager to send events with `ev`'s timestamp."""
+        saved = getattr(self.__source_time, 'value', None)
+        self.__source_time.value = (ev.sec, ev.usec)
+        try:
+            yield
+        finally:
+            self.__source_time.value = saved
+
+    def new_event(self, type: int, code: int, value: int) -> evdev.InputEvent:
+        """Create an event carrying the source timestamp of the current thread, if any."""
+        t = getattr(self.__source_time, 'value', None)
+        if t is None:
+            return evdev.InputEvent(0, 0, type, code, value)
+        return evdev.InputEvent(t[0], t[1], type, code, value)
 
     def send_ievent(self, event: evdev.InputEvent) -> None:
         self.send_event(event.type, event.code, event.value)
 
     def send_event(self, type: int, key: int, value: int) -> None:
-        with self.__lock:
-            self.uinput.write(evdev.InputEvent(0, 0, type, key, value))
+        self.__write(self.new_event(type, key, value))
 
     def send_key_event(self, key: int, value: int) -> None:
-        with self.__lock:
-            self.uinput.write(evdev.InputEvent(0, 0, ecodes.EV_KEY, key, value))
+        self.__write(self.new_event(ecodes.EV_KEY, key, value))
 
     def send_key_events(self, *keys: Tuple[int, int]) -> None:
         with self.__lock:
             for k in keys:
-                self.uinput.write(evdev.InputEvent(0, 0, ecodes.EV_KEY, k[0], k[1]))
+                self.__write(self.new_event(ecodes.EV_KEY, k[0], k[1]))
 
     def press_key(self, key: int, modifiers:str=None, *, reset_all_keys=True, done=False) -> None:
         with self.__lock:
@@ -530,9 +2926,11 @@ class BaseRemapper():
                 raise DoneEvent()
 
     def reset_all_keys(self) -> None:
+        self.__sync_output()
         self.uinput.reset()
 
     def get_out_key_state(self, key: int) -> int:
+        self.__sync_output()
         return self.uinput.get_key_state(key)
 
     def get_in_key_state(self, key: int) -> int:
@@ -608,6 +3006,19 @@ class BaseRemapper():
                     expected_modifiers: Optional[str] = None,
                     predecate: Callable[[], bool] = None,
                     *, ignore_other_modifiers=False) -> bool:
+        if self.profiler:
+            return self.profiler.profile(sys._getframe(1), self.__matches_key, ev, expected_keys, expected_values,
+                                         expected_modifiers, predecate, ignore_other_modifiers)
+        return self.__matches_key(ev, expected_keys, expected_values, expected_modifiers, predecate,
+                                  ignore_other_modifiers=ignore_other_modifiers)
+
+    def __matches_key(self,
+                      ev: evdev.InputEvent,
+                      expected_keys: Union[int, Iterable[int]],
+                      expected_values: Union[int, Iterable[int]],
+                      expected_modifiers: Optional[str] = None,
+                      predecate: Callable[[], bool] = None,
+                      *, ignore_other_modifiers=False) -> bool:
         with self.__lock:
             if isinstance(expected_keys, int):
                 if ev.code != expected_keys:
@@ -635,6 +3046,7 @@ class BaseRemapper():
             if predecate and not predecate():
                 return False
 
+            self.rule_hit_count += 1
             return True
 
     def on_preprocess_events(self, device: evdev.InputDevice, events: List[evdev.InputEvent]) -> List[evdev.InputEvent]:
@@ -645,8 +3057,13 @@ class BaseRemapper():
         return events
 
     def on_handle_events(self, device: evdev.InputDevice, events: List[evdev.InputEvent]) -> None:
+        if self.__handles_frames:
+            for frame in split_frames(events):
+                self.__handle_frame(device, frame)
+            return
         try:
             for event in events:
+                self.__source_time.value = (event.sec, event.usec)
                 try:
                     self.on_handle_event(device, event)
                 except DoneEvent:
@@ -657,6 +3074,61 @@ class BaseRemapper():
     def on_handle_event(self, device: evdev.InputDevice, event: evdev.InputEvent) -> None:
         pass
 
+    def __handle_frame(self, device: evdev.InputDevice, frame: List[evdev.InputEvent]) -> None:
+        if frame:
+            self.__source_time.value = (frame[0].sec, frame[0].usec)
+
+        if getattr(self.__output_buffer, 'events', None) is not None:
+            # Already buffering the whole read (see rel_coalesce_lag_ms); just mark the frame boundary.
+            buffer = self.__output_buffer.events
+            start = len(buffer)
+            try:
+                self.on_handle_frame(device, frame)
+            except DoneEvent:
+                pass
+            if self.__output_buffer.events is not buffer:
+                start = 0  # Written out by __sync_output(); the new buffer has only this frame's events.
+            if self.synthesize_msc_timestamp and frame:
+                self.__add_msc_timestamp(frame[0], start)
+            sec, usec = (frame[0].sec, frame[0].usec) if frame else (0, 0)
+            self.__output_buffer.events.append(evdev.InputEvent(sec, usec, ecodes.EV_SYN, ecodes.SYN_REPORT, 0))
+            return
+
+        self.__begin_output_buffer()
+        try:
+            self.on_handle_frame(device, frame)
+        except DoneEvent:
+            pass
+        finally:
+            if self.synthesize_msc_timestamp and frame:
+                self.__add_msc_timestamp(frame[0])
+            self.__flush_output_buffer()
+
+    def __add_msc_timestamp(self, source: evdev.InputEvent, start=0) -> None:
+        """Add MSC_TIMESTAMP to the frame in the output buffer from `start`."""
+        events = self.__output_buffer.events
+        if len(events) <= start or not self.uinput.supports(ecodes.EV_MSC, ecodes.MSC_TIMESTAMP):
+            return
+        if any(ev.type == ecodes.EV_MSC and ev.code == ecodes.MSC_TIMESTAMP for ev in events[start:]):
+            return  # Passed through from the device.
+        us = source.sec * 1_000_000 + source.usec
+        if self.__msc_timestamp_base is None:
+            self.__msc_timestamp_base = us
+        value = (us - self.__msc_timestamp_base) & 0xffffffff
+        if value >= 0x80000000:
+            value -= 0x100000000  # The kernel field is a signed 32 bit int.
+        events.append(evdev.InputEvent(source.sec, source.usec, ecodes.EV_MSC, ecodes.MSC_TIMESTAMP, value))
+
+    def on_handle_frame(self, device: evdev.InputDevice, frame: List[evdev.InputEvent]) -> None:
+        """Override to handle input one kernel frame at a time, instead of on_handle_events() / on_handle_event().
+
+        `frame` has the events between two SYN_REPORTs, without the SYN_REPORT. Events sent with send_event()
+        and the like carry the frame's timestamp, and are buffered and written as a single frame (except when
+        the same key changes twice, which needs two frames), so e.g. REL_X and REL_Y stay in one frame.
+        Frames interrupted by SYN_DROPPED are never passed.
+        """
+        pass
+
     def __parse_args(self, args):
         parser = argparse.ArgumentParser(description=self.remapper_name)
         parser.add_argument('-m', '--match-device-name', metavar='D', default=self.device_name_regex,
@@ -665,6 +3137,55 @@ class BaseRemapper():
                             help='Select by vendor/product ID, in "vXXXX pXXXX" format, using this regex')
         parser.add_argument('-d', '--debug', action='store_true', help='Enable debug output')
         parser.add_argument('-q', '--quiet', action='store_true', help='Quiet mode')
+        parser.add_argument('-k', '--keymap', metavar='FILE',
+                            help='Load mappings from this keymap file, and reload it when it changes')
+        parser.add_argument('--realtime', action='store_true',
+                            help='Run the input loop with real-time priority, locked memory and deferred GC')
+        parser.add_argument('--rt-policy', choices=['fifo', 'rr'], default='fifo',
+                            help='Scheduling policy for --realtime')
+        parser.add_argument('--rt-priority', type=int, default=10, metavar='P',
+                            help='Real-time priority for --realtime (1-99)')
+        parser.add_argument('--rt-nice', type=int, default=-10, metavar='N',
+                            help='Nice level to use for --realtime when real-time scheduling is not allowed')
+        parser.add_argument('--cpu', type=int, metavar='N', help='Pin the input loop to this CPU')
+        parser.add_argument('--coalesce-lag-ms', type=float, default=self.rel_coalesce_lag_ms, metavar='MS',
+                            help='Merge relative motion events while handling is this much behind (0 to disable)')
+        parser.add_argument('--control-socket', nargs='?', const='', metavar='PATH',
+                            default='' if self.control_socket else None,
+                            help='Serve metrics, states and commands on a Unix-domain socket '
+                                 '(default: $XDG_RUNTIME_DIR/key-remapper/NAME.sock)')
+        parser.add_argument('--inject-socket', nargs='?', const='', metavar='PATH',
+                            default='' if self.inject_socket else None,
+                            help='Accept keys and events to send on a Unix-domain socket '
+                                 '(default: $XDG_RUNTIME_DIR/key-remapper/NAME-inject.sock)')
+        parser.add_argument('--profile', action='store_true',
+                            help='Profile matches_key() rules; the report is printed on exit and on SIGUSR1')
+        parser.add_argument('--output-queue', choices=SyncedUinput.QUEUE_POLICIES, default=self.output_queue,
+                            help='Write to the uinput devices from writer threads, with this policy for when '
+                                 'the queue is full')
+        parser.add_argument('--output-queue-size', type=int, default=self.output_queue_size, metavar='N',
+                            help='Maximum pending frames per uinput device for --output-queue')
+        parser.add_argument('--broker', nargs='?', const='', metavar='PATH',
+                            default='' if self.broker_path is not None else None,
+                            help='Send the output to uinput-broker.py instead of creating uinput devices '
+                                 '(default: $XDG_RUNTIME_DIR/key-remapper/uinput-broker.sock)')
+        parser.add_argument('--observe', action='store_true', default=self.observer_ring,
+                            help='Publish events and states to /dev/shm/key-remapper-NAME.ring '
+                                 '(see key-remapper-observe.py)')
+        parser.add_argument('--stall-budget-ms', type=float, default=self.stall_budget_ms, metavar='MS',
+                            help='Report main loop / handler stalls longer than this, with the stack (0 to disable)')
+        parser.add_argument('--latency-budget-ms', type=float, default=self.latency_budget_ms, metavar='MS',
+                            help=f'Pass a device through unchanged for {self.passthrough_cooldown_s:g} seconds when '
+                                 f'handling it takes longer than this {self.latency_budget_overruns} times, or '
+                                 f'a handler raises (default: 0, disabled; exit on exceptions)')
+        parser.add_argument('--headless', action='store_true', default=self.headless,
+                            help='No tray icon or desktop notifications; print notifications to stderr')
+        parser.add_argument('--instance', metavar='NAME',
+                            help='Use this name for the lock file and the uinput devices, '
+                                 'to run another instance of the same remapper')
+        parser.add_argument('--lanes', choices=['main', 'priority', 'threads'], default=self.dispatch_lanes,
+                            help='How to service devices: all on the main loop, pointer devices first, '
+                                 'or pointer devices on their own threads')
 
         self.on_init_arguments(parser)
 
@@ -674,6 +3195,30 @@ class BaseRemapper():
         self.id_regex = args.match_id
         self.enable_debug = args.debug
         self.force_quiet = args.quiet
+        self.keymap_path = args.keymap
+        self.realtime = args.realtime
+        self.dispatch_lanes = args.lanes
+        self.rel_coalesce_lag_ms = args.coalesce_lag_ms
+        self.headless = args.headless
+        self.output_queue = args.output_queue
+        self.output_queue_size = args.output_queue_size
+        self.observer_ring = args.observe
+        self.stall_budget_ms = args.stall_budget_ms
+        self.latency_budget_ms = args.latency_budget_ms
+        if args.broker is not None:
+            self.broker_path = args.broker or broker_socket_path()
+        if args.instance:
+            self.global_lock_name = args.instance
+            self.uinput_device_name_suffix = '-' + args.instance
+        if args.profile:
+            self.profiler = RuleProfiler()
+        if args.control_socket is not None:
+            self.control_socket = True
+            self.control_socket_path = args.control_socket or runtime_socket_path(self.global_lock_name)
+        if args.inject_socket is not None:
+            self.inject_socket = True
+            self.inject_socket_path = args.inject_socket or inject_socket_path(self.global_lock_name)
+        self.__realtime_args = args
 
         global debug, quiet
         debug = self.enable_debug
@@ -690,9 +3235,38 @@ class BaseRemapper():
     def new_uintput(self, name_suffix: str, uinput_events=Optional[Dict[int, Iterable[int]]]) -> SyncedUinput:
         # Create a new uinput device with arbitrary events.
         uinput_name = UINPUT_DEVICE_NAME + self.uinput_device_name_suffix + name_suffix
-        uinput = UInput(name=uinput_name, events=uinput_events)
-        if debug: print(f'# New uinput device name: {uinput_name}')
-        uinput = SyncedUinput(uinput)
+        signature = _events_signature(uinput_events)
+
+        broker_uinput = None
+        if self.broker_path is not None:
+            try:
+                broker_uinput = BrokerUinput(self.broker_path, uinput_name, uinput_events,
+                                             queue_policy=self.output_queue, queue_size=self.output_queue_size)
+            except OSError as ex:
+                if not quiet: print(f'Unable to connect to the uinput broker: {ex!r}; using a uinput device',
+                                    file=sys.stderr)
+
+        inherited = self.__handoff['uinputs'].pop(uinput_name, None) if self.__handoff else None
+        if broker_uinput:
+            if inherited:
+                os.close(inherited['fd'])
+            uinput = broker_uinput
+            if debug: print(f'# Sending to the uinput broker: {uinput_name}')
+        elif inherited and inherited['events'] == signature:
+            # Reuse the device created by the previous process image.
+            uinput = SyncedUinput(_InheritedUInput(uinput_name, inherited['fd']), uinput_events,
+                                  queue_policy=self.output_queue, queue_size=self.output_queue_size)
+            uinput.restore_key_states({int(k): v for k, v in inherited['key_states'].items()})
+            if debug: print(f'# Inherited uinput device: {uinput_name}')
+        else:
+            if inherited:
+                os.close(inherited['fd'])  # The capabilities have changed; destroy it.
+            uinput = UInput(name=uinput_name, events=uinput_events)
+            if debug: print(f'# New uinput device name: {uinput_name}')
+            uinput = SyncedUinput(uinput, uinput_events,
+                                  queue_policy=self.output_queue, queue_size=self.output_queue_size)
+        uinput.observer = self.observer
+        self.__uinputs[uinput_name] = (uinput, signature)
         add_at_exit(uinput.close)
         return uinput
 
@@ -711,23 +3285,438 @@ class BaseRemapper():
                                  )
         return self.new_uintput(name_suffix, events)
 
+    def collect_metrics(self) -> List[Tuple[str, str, Dict[str, str], float]]:
+        """Return the metrics as (name, type, labels, value). Reads the counters without any locking.
+
+        Subclasses may append their own metrics in on_collect_metrics().
+        """
+        m = []
+        for path, count in list(self.events_in.items()):
+            m.append(('key_remapper_events_in_total', 'counter', {'device': path}, count))
+        for name, (uinput, _) in list(self.__uinputs.items()):
+            m.append(('key_remapper_events_out_total', 'counter', {'uinput': name}, uinput.events_written))
+        for name, (uinput, _) in list(self.__uinputs.items()):
+            m.append(('key_remapper_frames_written_total', 'counter', {'uinput': name}, uinput.frames_written))
+        queued = [(name, uinput) for name, (uinput, _) in list(self.__uinputs.items()) if uinput.queue_policy]
+        for metric, type, get in (
+                ('key_remapper_output_queue_depth', 'gauge', lambda u: u.queue_depth()),
+                ('key_remapper_output_queue_max_depth', 'gauge', lambda u: u.queue_max_depth),
+                ('key_remapper_output_queue_dropped_total', 'counter', lambda u: u.queue_dropped_count),
+                ('key_remapper_output_queue_coalesced_total', 'counter', lambda u: u.queue_coalesced_count),
+                ('key_remapper_output_batches_total', 'counter', lambda u: u.batches_written)):
+            for name, uinput in queued:
+                m.append((metric, type, {'uinput': name}, get(uinput)))
+        m.append(('key_remapper_rules_hit_total', 'counter', {}, self.rule_hit_count))
+        m.append(('key_remapper_hotplug_rescans_total', 'counter', {}, self.hotplug_rescan_count))
+        for path, assembler in list(self.__frame_assemblers.items()):
+            m.append(('key_remapper_syn_dropped_total', 'counter', {'device': path}, assembler.dropped_count))
+        m.append(('key_remapper_resyncs_total', 'counter', {}, self.resync_count))
+        m.append(('key_remapper_passthrough_total', 'counter', {}, self.passthrough_count))
+        m.append(('key_remapper_injected_events_total', 'counter', {}, self.injected_event_count))
+        m.append(('key_remapper_passthrough_devices', 'gauge', {}, len(self.__passthrough_until)))
+        engines = list(self.__combo_engines.values())
+        for result, attr in (('fired', 'fired_count'), ('replayed', 'replayed_count'), ('expired', 'timeout_count')):
+            m.append(('key_remapper_combos_total', 'counter', {'result': result},
+                      sum(getattr(e, attr) for e in engines)))
+        matchers = list(self.__sequence_matchers.values())
+        for result, attr in (('matched', 'matched_count'), ('replayed', 'replayed_count'),
+                             ('expired', 'timeout_count')):
+            m.append(('key_remapper_sequences_total', 'counter', {'result': result},
+                      sum(getattr(s, attr) for s in matchers)))
+        m.append(('key_remapper_devices', 'gauge', {}, len(self.__devices)))
+        m.append(('key_remapper_backlogged_reads_total', 'counter', {}, self.backlogged_read_count))
+        m.append(('key_remapper_coalesced_rel_events_total', 'counter', {}, self.coalesced_rel_count))
+        m.append(('key_remapper_notification_queue_depth', 'gauge', {}, self.notifications.queue_depth()))
+        m.append(('key_remapper_notifications_coalesced_total', 'counter', {}, self.notifications.coalesced_count))
+        m.append(('key_remapper_notifications_dropped_total', 'counter', {}, self.notifications.dropped_count))
+        if self.watchdog:
+            m.append(('key_remapper_stalls_total', 'counter', {}, self.watchdog.stall_count))
+            m.append(('key_remapper_max_stall_milliseconds', 'gauge', {}, self.watchdog.max_stall_ms))
+        for metric_name, histogram in (('key_remapper_input_latency_seconds', self.input_latency),
+                                       ('key_remapper_handler_seconds', self.handler_latency),
+                                       ('key_remapper_combo_delay_seconds', self.combo_latency)):
+            cumulative = 0
+            for i, n in enumerate(list(histogram.buckets)):
+                cumulative += n
+                m.append((metric_name + '_bucket', 'histogram', {'le': (1 << (i + 1)) / 1_000_000}, cumulative))
+            m.append((metric_name + '_bucket', 'histogram', {'le': '+Inf'}, histogram.count))
+            m.append((metric_name + '_sum', 'histogram', {}, histogram.total))
+            m.append((metric_name + '_count', 'histogram', {}, histogram.count))
+        self.on_collect_metrics(m)
+        return m
+
+    def on_collect_metrics(self, metrics: List[Tuple[str, str, Dict[str, str], float]]) -> None:
+        pass
+
+    def get_state(self) -> dict:
+        """Return the current key states, for the "state" command. Call it on the main loop, as on_save_state()
+        reads the remapper's own state, which the main loop changes."""
+        with self.__lock:
+            in_keys = [k for k, v in self.__orig_key_states.items() if v > 0]
+        return {
+            'in_keys': [ecodes.KEY.get(k, ecodes.BTN.get(k, k)) for k in in_keys],
+            'out_keys': {name: [ecodes.KEY.get(k, ecodes.BTN.get(k, k)) for k in uinput.get_key_states()]
+                         for name, (uinput, _) in list(self.__uinputs.items())},
+            'modifiers': ''.join(c for c, pressed in (
+                ('a', self.is_alt_pressed()), ('c', self.is_ctrl_pressed()), ('s', self.is_shift_pressed()),
+                ('w', self.is_win_pressed()), ('e', self.is_esc_pressed()), ('p', self.is_caps_pressed()),
+            ) if pressed),
+            'app_layers': self.active_app_layers,
+            'remapper': self.on_save_state(),
+            'published': self.published_state,
+            'passthrough': list(self.__passthrough_until),
+        }
+
+    def publish_state(self, name: str, value) -> None:
+        """Publish a state, such as the current mode, to the observers (see ObserverRing) and the "state"
+        command. Thread safe. `name=value` is truncated to 36 bytes in the ring.
+        """
+        self.published_state[name] = value
+        if self.observer:
+            self.observer.publish_state(name, value)
+
+    def on_control_command(self, command: str, args: List[str]) -> str:
+        """Handle a remapper-specific "cmd" command from the control socket. Called on the main loop."""
+        raise ValueError(f'Unknown command: {command}')
+
+    def __run_on_main_loop(self, func: Callable[[], str], timeout=2.0) -> str:
+        done = threading.Event()
+        result = []
+
+        def run():
+            try:
+                result.append(func())
+            except Exception as ex:
+                result.append(f'error: {ex!r}')
+            done.set()
+            return False
+
+        glib.idle_add(run)
+        if not done.wait(timeout):
+            return 'error: timed out'
+        return result[0]
+
+    def __handle_control_command(self, line: str) -> str:
+        """Handle a command from the control socket. Commands:
+          metrics             Counters in the Prometheus text format.
+          state               Current key/modifier states and the remapper state, in JSON.
+          debug [on|off]      Toggle / set debug output (key_remapper.debug, which the scripts read too).
+          trace               Dump recent input events and stalls.
+          stalls              Recent stalls with the stacks (with --stall-budget-ms).
+          profile [reset]     Rule profile (with --profile).
+          cmd NAME [ARGS...]  Remapper-specific command. See on_control_command().
+        """
+        words = line.split()
+        command, args = words[0], words[1:]
+        if command == 'metrics':
+            return format_prometheus(self.collect_metrics())
+        if command == 'state':
+            return self.__run_on_main_loop(lambda: json.dumps(self.get_state()))
+        if command == 'debug':
+            global debug
+            debug = (args[0] == 'on') if args else not debug
+            self.enable_debug = debug
+            return f'debug {"on" if debug else "off"}'
+        if command == 'trace':
+            return '\n'.join(f'{t:.6f} {path}' if type is None else  # A stall; see __on_stall().
+                             f'{t:.6f} {path} {ecodes.EV.get(type, type)} {code} {value}'
+                             for t, path, type, code, value in list(self.trace)) or '(empty)'
+        if command == 'stalls':
+            if not self.watchdog:
+                return 'error: not watching. Start with --stall-budget-ms'
+            return '\n'.join(self.format_stall(r) for r in list(self.stalls)) or '(none)'
+        if command == 'cmd' and args:
+            return self.__run_on_main_loop(lambda: self.on_control_command(args[0], args[1:]) or 'ok')
+        if command == 'profile':
+            if not self.profiler:
+                return 'error: not profiling. Start with --profile'
+            if args == ['reset']:
+                self.profiler.reset()
+                return 'ok'
+            return self.profiler.report()
+        if command == 'help':
+            return self.__handle_control_command.__doc__
+        raise ValueError(f'Unknown command: {line}')
+
+    def __handle_inject_command(self, line: str) -> str:
+        """Handle a line from the injection socket, on the connection's thread. Replies "ok N", N being the
+        number of events given, once they're written. Commands:
+          keys KEY...           Press and release keys in turn. Each is a key name (KEY_A, or just A), optionally
+                                with modifiers as in press_key(), e.g. "cs+T" for ctrl+shift+T.
+          frame TYPE:CODE:VALUE...
+                                Send the events as one frame, e.g. "frame EV_KEY:KEY_LEFTSHIFT:1". Names or
+                                numbers.
+        The events go through the same key state filtering as the remapper's own output.
+        """
+        words = line.split()
+        command, args = words[0], words[1:]
+        if command == 'keys':
+            events = []
+            for token in args:
+                modifiers, _, name = token.rpartition('+')
+                if self.__modifier_char_validator.search(modifiers):
+                    raise ValueError(f'Unexpected modifiers in "{token}". Expected a, c, s and w.')
+                key = _event_code(name, 'KEY_')
+                mods = [code for c, code in (('a', ecodes.KEY_LEFTALT), ('c', ecodes.KEY_LEFTCTRL),
+                                             ('s', ecodes.KEY_LEFTSHIFT), ('w', ecodes.KEY_LEFTMETA)) if c in modifiers]
+                events += [evdev.InputEvent(0, 0, ecodes.EV_KEY, code, 1) for code in mods + [key]]
+                events.append(evdev.InputEvent(0, 0, ecodes.EV_SYN, ecodes.SYN_REPORT, 0))
+                events += [evdev.InputEvent(0, 0, ecodes.EV_KEY, code, 0) for code in [key] + mods[::-1]]
+                events.append(evdev.InputEvent(0, 0, ecodes.EV_SYN, ecodes.SYN_REPORT, 0))
+        elif command == 'frame':
+            events = []
+            for token in args:
+                parts = token.split(':')
+                if len(parts) != 3:
+                    raise ValueError(f'Expected TYPE:CODE:VALUE, got "{token}"')
+                events.append(evdev.InputEvent(0, 0, _event_code(parts[0]), _event_code(parts[1]), int(parts[2])))
+        elif command == 'help':
+            return self.__handle_inject_command.__doc__
+        else:
+            raise ValueError(f'Unknown command: {line}')
+
+        for ev in events:
+            if ev.type != ecodes.EV_SYN and not self.uinput.supports(ev.type, ev.code):
+                raise ValueError(f'Not supported by the uinput device: {ev.type}:{ev.code}')
+        if events:
+            with self.__lock:
+                self.uinput.write(*events)
+            self.uinput.flush()
+        count = sum(1 for ev in events if ev.type != ecodes.EV_SYN)
+        self.injected_event_count += count
+        return f'ok {count}'
+
+    @staticmethod
+    def format_stall(report: StallReport) -> str:
+        handling = 'no input'
+        if report.handling:
+            path, events = report.handling
+            handling = path + ': ' + ' '.join(f'{ecodes.EV.get(ev.type, ev.type)}:{ev.code}:{ev.value}'
+                                              for ev in events if ev.type != ecodes.EV_SYN)
+        timestamp = time.strftime('%H:%M:%S', time.localtime(report.time))
+        return (f'{timestamp} Stalled for {report.elapsed_ms:.0f} ms on {report.thread}, handling {handling}\n'
+                + report.stack)
+
+    def __on_stall(self, report: StallReport):
+        # Called on the watchdog thread.
+        self.stalls.append(report)
+        self.trace.append((report.time, f'STALL {report.elapsed_ms:.0f} ms on {report.thread}', None, None, None))
+        if not quiet: print(self.format_stall(report), file=sys.stderr)
+
+    def __handle_control_http(self, path: str) -> Tuple[int, str]:
+        if path == '/metrics':
+            return 200, format_prometheus(self.collect_metrics())
+        return 404, 'Not found\n'
+
+    def restart(self) -> None:
+        """Re-execute the script without releasing the devices.
+
+        The grabbed device fds, the uinput fds and the states (both the framework's and the one from
+        on_save_state()) are passed to the new process image, which picks them up instead of ungrabbing
+        and re-creating everything. Because the devices stay grabbed, no key leaks to other clients
+        in between; events that arrive during the restart are read by the new process.
+
+        Also used to upgrade the scripts in place: send SIGHUP after updating them.
+        """
+        try:
+            handoff = {
+                'devices': {},
+                'uinputs': {},
+                'in_key_states': {k: v for k, v in self.__orig_key_states.items() if v > 0},
+                'state': self.on_save_state(),
+            }
+            for path, t in self.__devices.items():
+                os.set_inheritable(t[0].fd, True)
+                handoff['devices'][path] = t[0].fd
+            for name, (uinput, signature) in self.__uinputs.items():
+                if not uinput.wrapped or isinstance(uinput, BrokerUinput):
+                    continue  # Broker connections are re-established; the broker releases their keys.
+                uinput.flush()
+                os.set_inheritable(uinput.wrapped.fd, True)
+                handoff['uinputs'][name] = {
+                    'fd': uinput.wrapped.fd,
+                    'events': signature,
+                    'key_states': uinput.get_key_states(),
+                }
+            os.environ[HANDOFF_ENV] = json.dumps(handoff)
+        except:
+            # Fall back to a regular restart.
+            traceback.print_exc()
+            os.environ.pop(HANDOFF_ENV, None)
+            call_at_exists()
+
+        if debug: print('# Restarting...')
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os.execv(sys.argv[0], sys.argv)
+
+    def __setup_realtime(self):
+        """Apply --realtime and --cpu to the input loop thread. Called after all the other threads are started,
+        so they keep the normal priority. Failures are reported but not fatal.
+        """
+        args = self.__realtime_args
+        report = self.__realtime_report
+
+        def attempt(label, func):
+            try:
+                func()
+                report.append(f'{label}: ok')
+                return True
+            except (OSError, ValueError) as ex:
+                report.append(f'{label}: failed ({ex})')
+                return False
+
+        lanes = [t[2] for t in self.__devices.values() if t[2] is not None]
+
+        if args.cpu is not None:
+            # On Linux, pid 0 means the calling thread.
+            self.__original_affinity = os.sched_getaffinity(0)
+            attempt(f'Pin to CPU {args.cpu}', lambda: os.sched_setaffinity(0, {args.cpu}))
+
+        if self.realtime:
+            policy = os.SCHED_FIFO if args.rt_policy == 'fifo' else os.SCHED_RR
+            param = os.sched_param(args.rt_priority)
+
+            def set_scheduler():
+                os.sched_setscheduler(0, policy, param)
+                self.__rt_scheduler = (policy, param)
+                for lane in lanes:
+                    if lane.native_id:
+                        os.sched_setscheduler(lane.native_id, policy, param)
+            if not attempt(f'SCHED_{args.rt_policy.upper()} priority {args.rt_priority}', set_scheduler):
+                attempt(f'Nice {args.rt_nice}',
+                        lambda: os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), args.rt_nice))
+
+            def lock_memory():
+                # Only lock future allocations when there's no limit, otherwise they'd start failing.
+                flags = 1  # MCL_CURRENT
+                if resource.getrlimit(resource.RLIMIT_MEMLOCK)[0] == resource.RLIM_INFINITY:
+                    flags |= 2  # MCL_FUTURE
+                libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+                if libc.mlockall(flags) != 0:
+                    errno = ctypes.get_errno()
+                    raise OSError(errno, os.strerror(errno))
+            attempt('mlockall', lock_memory)
+
+            # Move everything allocated so far out of the GC's reach, and only collect while idle.
+            gc.collect()
+            gc.freeze()
+            gc.disable()
+            report.append(f'GC: frozen {gc.get_freeze_count()} objects, collecting only when idle')
+            get_clock().call_later(500, self.__collect_garbage_when_idle, priority=glib.PRIORITY_LOW)
+
+            # Compare against the histograms from a run without --realtime.
+            self.input_latency.reset()
+            self.handler_latency.reset()
+
+        if report:
+            message = 'Real-time mode:\n' + '\n'.join('- ' + r for r in report)
+            if not quiet: print(message)
+            self.show_notification(message)
+
+    def __collect_garbage_when_idle(self):
+        if get_clock().time() - self.__last_input_time > 0.5 and gc.get_count()[0] > 0:
+            start = time.perf_counter()
+            # Each gen-1 pass adds one to the gen-2 count; do a full pass as often as the default thresholds
+            # would, or cycles that get into gen 2 are never freed. Frozen objects aren't traversed.
+            full = gc.get_count()[2] >= gc.get_threshold()[2]
+            gc.collect(2 if full else 1)
+            if debug: print(f'# Idle GC (gen {2 if full else 1}) took {(time.perf_counter() - start) * 1000:.3f} ms')
+        return True
+
+    def print_latency_report(self, file=sys.stderr):
+        for line in self.__realtime_report:
+            print(f'# {line}', file=file)
+        print(self.input_latency.format(), file=file)
+        print(self.handler_latency.format(), file=file)
+        if self.__combos:
+            print(self.combo_latency.format(), file=file)
+
+    def __finish_handoff(self):
+        if not self.__handoff:
+            return
+        # Close whatever the new image didn't take over (e.g. devices that were removed).
+        for fd in self.__handoff['devices'].values():
+            os.close(fd)
+        for inherited in self.__handoff['uinputs'].values():
+            os.close(inherited['fd'])
+        self.__handoff = None
+
     def main(self, args):
-        ensure_singleton(self.global_lock_name)
-        notify2.init(self.remapper_name)
+        self.__handoff = _take_handoff()
 
         self.__parse_args(args)
 
+        ensure_singleton(self.global_lock_name)
+        if self.observer_ring:
+            self.observer = ObserverRing(observer_ring_path(self.global_lock_name))
+            add_at_exit(self.observer.close)
+        if not self.headless:
+            notify2.init(self.remapper_name)
+            self.notifications.start()
+            self.tray_icon = RemapperTrayIcon(self.remapper_name, self.remapper_icon, self.restart)
+
+        # Load the keymap first, so that get_uinput_events() can use it.
+        if self.keymap_path and not self.__load_keymap():
+            raise SystemExit(f'Unable to load keymap {self.keymap_path}')
+
         if self.write_to_uinput:
             # Create our /dev/uinput device.
-            self.uinput = self.new_uintput("", self.uinput_events)
+            self.uinput = self.new_uintput("", self.get_uinput_events())
         self.__start_udev_monitor()
         glib.io_add_watch(self.__udev_monitor, glib.IO_IN, self.__on_udev_event)
 
+        if self.__handoff:
+            with self.__lock:
+                for key, value in self.__handoff['in_key_states'].items():
+                    self.__orig_key_states[int(key)] = value
+            self.on_restore_state(self.__handoff['state'])
+
         self.on_initialize()
 
+        if self.__app_layers:
+            self.__start_app_layer_tracking()
+
+        if self.keymap_path:
+            self.__keymap_watcher = FileWatcher(self.keymap_path, self.__reload_keymap)
+
         self.__open_devices()
+        self.__finish_handoff()
         add_at_exit(self.__release_devices)
 
+        def on_sighup():
+            self.restart()
+            return True
+        glib.unix_signal_add(glib.PRIORITY_HIGH, signal.SIGHUP, on_sighup)
+
+        if self.profiler:
+            def print_profile():
+                print(self.profiler.report(), file=sys.stderr)
+                return True
+            add_at_exit(print_profile)
+            glib.unix_signal_add(glib.PRIORITY_DEFAULT, signal.SIGUSR1, print_profile)
+
+        if self.control_socket:
+            self.__control_server = UnixCommandServer(self.control_socket_path, self.__handle_control_command,
+                                                      self.__handle_control_http)
+            add_at_exit(self.__control_server.close)
+            if debug: print(f'# Control socket: {self.control_socket_path}')
+
+        if self.inject_socket:
+            if not self.inject_socket_path:
+                self.inject_socket_path = inject_socket_path(self.global_lock_name)
+            self.__inject_server = UnixCommandServer(self.inject_socket_path, self.__handle_inject_command)
+            add_at_exit(self.__inject_server.close)
+            if debug: print(f'# Injection socket: {self.inject_socket_path}')
+
+        if self.stall_budget_ms > 0:
+            self.watchdog = StallWatchdog(self.stall_budget_ms, self.__on_stall)
+            self.watchdog.start()
+
+        self.__setup_realtime()
+        if self.realtime or debug:
+            add_at_exit(self.print_latency_report)
+
         try:
             gtk.main()
         finally:
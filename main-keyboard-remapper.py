@@ -5,7 +5,6 @@
 import os
 import sys
 import threading
-import time
 
 import evdev
 from evdev import ecodes as ec
@@ -21,8 +20,6 @@ ICON = os.path.join(SCRIPT_PATH, 'res/keyboard.png')
 # P. I. Engineering XK-16 HID  -> An external 8-key keyboard
 DEFAULT_DEVICE_NAME = "^(AT Translated Set 2 keyboard|Topre Corporation Realforce|P. I. Engineering XK-16 HID)"
 
-debug = False
-
 # ESC + These keys will generate SHIFT+ALT+CTRL+META+[THE KEY]. I launch apps using them -- e.g. ESC+ENTER to launch
 # Chrome.
 VERSATILE_KEYS = (
@@ -116,7 +113,7 @@ class Wheeler:
 
             if vspeed == 0 and hspeed == 0:
                 consecutive_event_count = 0
-                self.__event.wait()
+                key_remapper.get_clock().wait(self.__event)
                 self.__event.clear()
             else:
                 consecutive_event_count += 1
@@ -124,19 +121,19 @@ class Wheeler:
             delay = self.wheel_repeat_delay_normal_ms
             if consecutive_event_count > self.wheel_make_fast_after_this_many_events:
                 delay = self.wheel_repeat_delay_fast_ms
-            time.sleep(delay)
+            key_remapper.get_clock().sleep(delay)
 
     def start(self):
         self.__wheel_thread.start()
 
     def set_vwheel(self, speed: int):
-        if debug: print(f'# vwheel: {speed}')
+        if key_remapper.debug: print(f'# vwheel: {speed}')
         with self.__lock:
             self.__vwheel_speed = speed
         self.__event.set()
 
     def set_hwheel(self, speed: int):
-        if debug: print(f'# hwheel: {speed}')
+        if key_remapper.debug: print(f'# hwheel: {speed}')
         with self.__lock:
             self.__hwheel_speed = speed
         self.__event.set()
@@ -147,9 +144,26 @@ class Wheeler:
 
 class Remapper(key_remapper.BaseRemapper):
     def __init__(self):
-        super().__init__(NAME, ICON, DEFAULT_DEVICE_NAME)
+        super().__init__(NAME, ICON, DEFAULT_DEVICE_NAME,
+                         input_events={ec.EV_KEY: None})  # We only handle keys; don't wake up for MSC_SCAN.
         self.pending_esc_press = False
 
+        # For chrome: -----------------------------------------------------------------------------------
+        #  F5 -> back
+        #  F6 -> forward
+        self.add_app_layer(key_remapper.AppLayer('Chrome', class_group='Google-chrome')) \
+            .bind(ec.KEY_F5, ec.KEY_BACK) \
+            .bind(ec.KEY_F6, ec.KEY_FORWARD)
+
+    def on_init_arguments(self, parser):
+        parser.add_argument('--jk-esc', action='store_true', help='Pressing J and K together acts as ESC')
+        parser.add_argument('--combo-window-ms', type=float, default=30, metavar='MS',
+                            help='How close together the keys of a combo (e.g. --jk-esc) must be pressed')
+
+    def on_arguments_parsed(self, args):
+        if args.jk_esc:
+            self.add_combo((ec.KEY_J, ec.KEY_K), ec.KEY_ESC, window_ms=args.combo_window_ms)
+
     def on_initialize(self):
         super().on_initialize()
         self.wheeler = Wheeler(self.new_mouse_uinput("_wheel"))
@@ -159,9 +173,20 @@ class Remapper(key_remapper.BaseRemapper):
         super().on_device_lost()
         self.wheeler.stop()
 
+    def on_resync(self, device: evdev.InputDevice):
+        # Events were lost; we don't know if ESC was tapped alone or the wheel keys are still held.
+        self.pending_esc_press = False
+        self.wheeler.set_vwheel(0)
+        self.wheeler.set_hwheel(0)
+
+    def on_save_state(self) -> dict:
+        return {'pending_esc_press': self.pending_esc_press}
+
+    def on_restore_state(self, state: dict) -> None:
+        self.pending_esc_press = state.get('pending_esc_press', False)
+
     def is_chrome(self):
-        title, class_group_name, class_instance_name = self.get_active_window()
-        return class_group_name == "Google-chrome"
+        return 'Chrome' in self.active_app_layers
 
     def on_handle_event(self, device: evdev.InputDevice, ev: evdev.InputEvent):
         if ev.type != ec.EV_KEY:
@@ -205,6 +230,8 @@ class Remapper(key_remapper.BaseRemapper):
         # any keys are pressed between the down and up.
         # This allows to make "ESC + BACKSPACE" act as a DEL press without sending ESC.
         if ev.code == ec.KEY_ESC:
+            if ev.value in (0, 1):
+                self.publish_state('esc_layer', ev.value)  # For OSDs; see key-remapper-observe.py
             if ev.value == 1:
                 self.pending_esc_press = True
             if ev.value in (1, 2):
@@ -230,11 +257,8 @@ class Remapper(key_remapper.BaseRemapper):
         if self.matches_key(ev, ec.KEY_BACKSPACE, (1, 2), 'e'): self.press_key(ec.KEY_DELETE, done=True)
         if self.matches_key(ev, ec.KEY_BACKSPACE, (1, 2), 's'): self.press_key(ec.KEY_DELETE, done=True)
 
-        # For chrome: -----------------------------------------------------------------------------------
-        #  F5 -> back
-        #  F6 -> forward
-        if self.matches_key(ev, ec.KEY_F5, 1, '', self.is_chrome): self.press_key(ec.KEY_BACK, done=True)
-        if self.matches_key(ev, ec.KEY_F6, 1, '', self.is_chrome): self.press_key(ec.KEY_FORWARD, done=True)
+        # App-specific keys. (See __init__)
+        if self.handle_app_layers(ev): return
 
         # Global keys -----------------------------------------------------------------------------------
 
@@ -28,13 +28,28 @@ MAP = {
 class Remapper(key_remapper.BaseRemapper):
     def __init__(self):
         super().__init__(NAME, ICON, DEFAULT_DEVICE_NAME, match_non_keyboards=True)
+        self.map = MAP
+
+    def get_uinput_events(self):
+        # Only register the keys we send.
+        return key_remapper.key_events_for(self.map.values(), modifiers=False)
+
+    def get_input_events(self):
+        # Only receive the keys we map; the kernel drops the rest.
+        return {ecodes.EV_KEY: self.map.keys()}
+
+    def on_keymap_loaded(self, keymap: key_remapper.Keymap):
+        # See keymaps/satechi.keymap
+        self.map = {source: target[0] for source, target in keymap['map'].items()}
 
     def on_handle_events(self, device: evdev.InputDevice, events: List[evdev.InputEvent]):
         for ev in events:
             if ev.type != ecodes.EV_KEY:
                 continue
 
-            key = MAP[ev.code]
+            key = self.map.get(ev.code)
+            if key is None:
+                continue  # Not mapped; only reaches us on kernels without EVIOCSMASK.
             self.send_key_event(key, ev.value)
 
 
@@ -18,8 +18,6 @@ ICON = os.path.join(SCRIPT_PATH, 'res/10key.png')
 
 DEFAULT_DEVICE_NAME = "^UGEE TABLET TABLET KT01"
 
-debug = False
-
 KEY_LABELS = [
     "1",
     "2",
@@ -95,15 +93,41 @@ SCROLL_MODE = collections.OrderedDict([
 
 ALL_MODES = [CURSOR_MODE, VOLUME_MODE, SCROLL_MODE]
 
+# Names usable in keymap files. (See keymaps/shortcut-remote.keymap)
+KEYMAP_CONSTANTS = {
+    'HALF_TOGGLE': HALF_TOGGLE,
+    'MODE_1': MODE_1[0],
+    'MODE_2': MODE_2[0],
+    'MODE_3': MODE_3[0],
+}
+
 
 class Remapper(key_remapper.BaseRemapper):
     def __init__(self):
-        super().__init__(NAME, ICON, DEFAULT_DEVICE_NAME)
+        super().__init__(NAME, ICON, DEFAULT_DEVICE_NAME,
+                         input_events={ecodes.EV_KEY: None})  # Don't wake up for MSC_SCAN.
+        self.keymap_constants = KEYMAP_CONSTANTS
+        self.__modes = ALL_MODES
 
     def get_current_mode(self):
-        return ALL_MODES[self.__mode]
+        return self.__modes[self.__mode]
+
+    def get_uinput_events(self):
+        # Only register the keys we send.
+        return key_remapper.key_events_for(
+            [v[0] & ~HALF_TOGGLE for mode in self.__modes for v in mode.values()], modifiers=False)
+
+    def on_keymap_loaded(self, keymap: key_remapper.Keymap):
+        # Each section is a mode.
+        modes = list(keymap.sections.values())
+        if not modes:
+            raise ValueError(f'No modes defined in {keymap.path}')
+        self.__modes = modes
+        if self.keymap is not None and self.__mode >= len(modes):
+            self.__mode = 0  # Reloaded with fewer modes. (--mode is checked in on_initialize().)
 
     def show_help(self):
+        self.publish_state('mode', self.__mode)  # For OSDs; see key-remapper-observe.py
         descs = [v[1] for v in self.get_current_mode().values()]
 
         help = NAME + "\n" + "\n".join(f'[{v[0]}] {v[1]}' for v in zip(KEY_LABELS, descs))
@@ -119,7 +143,7 @@ class Remapper(key_remapper.BaseRemapper):
         if ev.code == ecodes.KEY_LEFTCTRL:
             return  # There's a key that sends CTRL+Z. We just ignore the CTRL press and use 'z' only.
 
-        key = self.get_current_mode()[ev.code][0]
+        key = self.get_current_mode().get(ev.code, [0])[0]
 
         if key == 0:
             self.show_help() # show help upon unassigned key presses.
@@ -147,13 +171,35 @@ class Remapper(key_remapper.BaseRemapper):
     def on_device_detected(self, devices: List[evdev.InputDevice]):
         self.show_help()
 
+    def on_control_command(self, command: str, args: List[str]) -> str:
+        # e.g. echo "cmd mode 1" | nc -U $XDG_RUNTIME_DIR/key-remapper/shortcut-remote-remapper.sock
+        if command == 'mode' and len(args) == 1:
+            mode = int(args[0])
+            if not 0 <= mode < len(self.__modes):
+                raise ValueError(f'Invalid mode {mode}. Must be 0 <= mode < {len(self.__modes)}')
+            self.__mode = mode
+            self.show_help()
+            return f'mode {mode}'
+        return super().on_control_command(command, args)
+
+    def on_save_state(self) -> dict:
+        return {'mode': self.__mode}
+
+    def on_restore_state(self, state: dict) -> None:
+        mode = state.get('mode', self.__mode)
+        self.__mode = mode if 0 <= mode < len(self.__modes) else 0
+
     def on_init_arguments(self, parser):
-        parser.add_argument('--mode', type=int, default=0, help='Specify the initial mode (0-2)')
+        parser.add_argument('--mode', type=int, default=0,
+                            help='Specify the initial mode (0-2, or the section number in the keymap)')
 
     def on_arguments_parsed(self, args):
         self.__mode = args.mode
-        if self.__mode < 0 or self.__mode >= len(ALL_MODES):
-            raise ValueError(f'Invalid mode {self.__mode}. Must be 0 <= mode < {len(ALL_MODES)}')
+
+    def on_initialize(self):
+        # The modes come from the keymap, which is loaded after the arguments are parsed.
+        if not 0 <= self.__mode < len(self.__modes):
+            raise ValueError(f'Invalid mode {self.__mode}. Must be 0 <= mode < {len(self.__modes)}')
 
 
 def main(args):
@@ -3,7 +3,6 @@ import math
 import os
 import sys
 import threading
-import time
 from typing import List
 
 import evdev
@@ -29,7 +28,12 @@ def get_next_key_mode(mode: int) -> int:
 
 class Remapper(key_remapper.BaseRemapper):
     def __init__(self):
-        super().__init__(NAME, ICON, DEFAULT_DEVICE_NAME)
+        super().__init__(NAME, ICON, DEFAULT_DEVICE_NAME,
+                         uinput_events=key_remapper.key_events_for(
+                             [m[0] for m in KEY_MODES], [m[1] for m in KEY_MODES],
+                             [ecodes.KEY_SPACE, ecodes.KEY_F, ecodes.KEY_F11, ecodes.KEY_MUTE],
+                             modifiers=False),
+                         input_events={ecodes.EV_KEY: None, ecodes.EV_REL: (ecodes.REL_WHEEL, ecodes.REL_DIAL)})
         self.__lock = threading.RLock()
         self.__wheel_pos = 0
         self.__wheel_thread = threading.Thread(name='wheel-thread', target=self.__handle_wheel)
@@ -69,11 +73,32 @@ class Remapper(key_remapper.BaseRemapper):
         with self.__lock:
             self.__wheel_mode = get_next_key_mode(self.__wheel_mode)
 
+    def on_save_state(self) -> dict:
+        with self.__lock:
+            return {
+                'jog_mode': self.__jog_mode,
+                'wheel_mode': self.__wheel_mode,
+                'button1_pressed': self.__button1_pressed,
+                'last_dial': self.__last_dial,
+            }
+
+    def on_restore_state(self, state: dict) -> None:
+        with self.__lock:
+            self.__jog_mode = state.get('jog_mode', self.__jog_mode)
+            self.__wheel_mode = state.get('wheel_mode', self.__wheel_mode)
+            self.__button1_pressed = state.get('button1_pressed', self.__button1_pressed)
+            self.__last_dial = state.get('last_dial', self.__last_dial)
+
     def on_initialize(self):
         self.__wheel_thread.start()
         self.show_help()
 
     def show_help(self):
+        # For OSDs; see key-remapper-observe.py
+        self.publish_state('jog', self.__get_jog_mode()[2])
+        self.publish_state('dial', self.__get_wheel_mode()[2])
+        self.publish_state('button1', int(self.__button1_pressed))
+
         key4 = 'KEY_F' if self.__button1_pressed else 'KEY_F11'
         key2 = 'Toggle Dial' if self.__button1_pressed else 'Toggle Jog'
 
@@ -141,7 +166,7 @@ class Remapper(key_remapper.BaseRemapper):
         sleep_duration = 0.1
 
         while True:
-            time.sleep(sleep_duration)
+            key_remapper.get_clock().sleep(sleep_duration)
             sleep_duration = 0.1
 
             current_wheel = self.__get_wheel_pos()
@@ -150,7 +175,7 @@ class Remapper(key_remapper.BaseRemapper):
             if -1 <= current_wheel <= 1:
                 continue
 
-            # if debug: print(f'Wheel={current_wheel}')
+            # if key_remapper.debug: print(f'Wheel={current_wheel}')
 
             key = 0
             count = 0
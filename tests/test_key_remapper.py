@@ -0,0 +1,258 @@
+#!/usr/bin/python3
+#
+# Tests for key_remapper.py. They need the same modules as the remappers (evdev, PyGObject, ...), but no
+# devices or display.
+#
+# Usage: python3 -m pytest tests  (or python3 -m unittest discover tests)
+#
+import os
+import sys
+import unittest
+from unittest import mock
+
+REPO_PATH = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, REPO_PATH)
+
+from evdev import ecodes, InputEvent
+
+import key_remapper
+
+
+class FakeUInput:
+    """Stands in for evdev.UInput, and keeps the events."""
+    fd = -1
+
+    def __init__(self):
+        self.events = []
+
+    def write_event(self, ev) -> None:
+        self.events.append(ev)
+
+    def syn(self) -> None:
+        pass
+
+    def close(self) -> None:
+        pass
+
+
+def frame(t: int, *events):
+    """A frame at time t (in ms), from (type, code, value) tuples."""
+    return [InputEvent(0, t * 1000, type, code, value) for type, code, value in events] \
+        + [InputEvent(0, t * 1000, ecodes.EV_SYN, ecodes.SYN_REPORT, 0)]
+
+
+def values(events):
+    return [(ev.usec // 1000, ev.type, ev.code, ev.value) for ev in events]
+
+
+REL, MSC, ABS, KEY, SYN = ecodes.EV_REL, ecodes.EV_MSC, ecodes.EV_ABS, ecodes.EV_KEY, ecodes.EV_SYN
+
+
+class CoalesceRelEventsTest(unittest.TestCase):
+    def test_merges_motion(self):
+        events = frame(1, (REL, ecodes.REL_X, 1), (REL, ecodes.REL_Y, 2)) + frame(2, (REL, ecodes.REL_X, 3)) \
+            + frame(3, (REL, ecodes.REL_Y, -2))
+        self.assertEqual(values(key_remapper.coalesce_rel_events(events)),
+                         [(3, REL, ecodes.REL_X, 4), (3, SYN, 0, 0)])
+
+    def test_keys_split_motion(self):
+        events = frame(1, (REL, ecodes.REL_X, 1)) + frame(2, (KEY, ecodes.BTN_LEFT, 1)) \
+            + frame(3, (REL, ecodes.REL_X, 2)) + frame(4, (REL, ecodes.REL_X, 3))
+        self.assertEqual(values(key_remapper.coalesce_rel_events(events)),
+                         [(1, REL, ecodes.REL_X, 1), (1, SYN, 0, 0),
+                          (2, KEY, ecodes.BTN_LEFT, 1), (2, SYN, 0, 0),
+                          (4, REL, ecodes.REL_X, 5), (4, SYN, 0, 0)])
+
+    def test_msc_timestamp_stays_with_its_motion(self):
+        events = frame(1, (REL, ecodes.REL_X, 1), (MSC, ecodes.MSC_TIMESTAMP, 1000)) \
+            + frame(2, (REL, ecodes.REL_X, 2), (MSC, ecodes.MSC_TIMESTAMP, 2000)) \
+            + frame(3, (KEY, ecodes.BTN_LEFT, 1), (MSC, ecodes.MSC_TIMESTAMP, 3000))
+        self.assertEqual(values(key_remapper.coalesce_rel_events(events)),
+                         [(2, REL, ecodes.REL_X, 3), (2, MSC, ecodes.MSC_TIMESTAMP, 2000), (2, SYN, 0, 0),
+                          (3, KEY, ecodes.BTN_LEFT, 1), (3, MSC, ecodes.MSC_TIMESTAMP, 3000), (3, SYN, 0, 0)])
+
+    def test_other_msc_frames_are_kept(self):
+        events = frame(1, (MSC, ecodes.MSC_SCAN, 0x70004), (KEY, ecodes.KEY_A, 1)) \
+            + frame(2, (REL, ecodes.REL_X, 1)) + frame(3, (MSC, ecodes.MSC_SCAN, 0x70004)) \
+            + frame(4, (REL, ecodes.REL_X, 1))
+        self.assertEqual(values(key_remapper.coalesce_rel_events(events)),
+                         [(1, MSC, ecodes.MSC_SCAN, 0x70004), (1, KEY, ecodes.KEY_A, 1), (1, SYN, 0, 0),
+                          (2, REL, ecodes.REL_X, 1), (2, SYN, 0, 0),
+                          (3, MSC, ecodes.MSC_SCAN, 0x70004), (3, SYN, 0, 0),
+                          (4, REL, ecodes.REL_X, 1), (4, SYN, 0, 0)])
+
+    def test_abs_frames_are_not_merged(self):
+        events = frame(1, (ABS, ecodes.ABS_X, 10), (ABS, ecodes.ABS_Y, 20)) \
+            + frame(2, (ABS, ecodes.ABS_X, 11)) + frame(3, (REL, ecodes.REL_WHEEL, 1))
+        self.assertEqual(values(key_remapper.coalesce_rel_events(events)),
+                         [(1, ABS, ecodes.ABS_X, 10), (1, ABS, ecodes.ABS_Y, 20), (1, SYN, 0, 0),
+                          (2, ABS, ecodes.ABS_X, 11), (2, SYN, 0, 0),
+                          (3, REL, ecodes.REL_WHEEL, 1), (3, SYN, 0, 0)])
+
+    def test_unterminated_frame(self):
+        events = frame(1, (REL, ecodes.REL_X, 1)) + [InputEvent(0, 2000, REL, ecodes.REL_X, 1)]
+        self.assertEqual(values(key_remapper.coalesce_rel_events(events)),
+                         [(2, REL, ecodes.REL_X, 2), (2, SYN, 0, 0)])
+
+
+class FakeDevice:
+    """Stands in for evdev.InputDevice. read() returns the given events once."""
+    path = '/dev/input/test'
+    name = 'test'
+
+    def __init__(self, events):
+        self.events = events
+
+    def read(self):
+        events, self.events = self.events, []
+        return events
+
+
+class PointerRemapper(key_remapper.BaseRemapper):
+    """Passes the motion through, frame by frame."""
+    def __init__(self, **kwargs):
+        super().__init__('key-remapper-test', '', '', match_non_keyboards=True,
+                         uinput_events={ecodes.EV_REL: (ecodes.REL_X,), ecodes.EV_MSC: (ecodes.MSC_TIMESTAMP,)},
+                         synthesize_msc_timestamp=True, headless=True, **kwargs)
+        self.output = FakeUInput()
+        self.uinput = key_remapper.SyncedUinput(self.output, self.uinput_events)
+
+    def on_handle_frame(self, device, frame):
+        for ev in frame:
+            if ev.type == ecodes.EV_REL:
+                self.send_event(ev.type, ev.code, ev.value)
+
+    def handle(self, events):
+        self._BaseRemapper__on_input_event(FakeDevice(events), None)
+
+
+class MscTimestampTest(unittest.TestCase):
+    def test_synthesized_per_frame(self):
+        remapper = PointerRemapper()
+        remapper.handle(frame(1, (REL, ecodes.REL_X, 1)) + frame(2, (REL, ecodes.REL_X, 2)))
+        self.assertEqual(values(remapper.output.events),
+                         [(1, REL, ecodes.REL_X, 1), (1, MSC, ecodes.MSC_TIMESTAMP, 0), (1, SYN, 0, 0),
+                          (2, REL, ecodes.REL_X, 2), (2, MSC, ecodes.MSC_TIMESTAMP, 1000), (2, SYN, 0, 0)])
+
+    def test_synthesized_when_backlogged(self):
+        # The events are from 1970, so they're handled late, and the motion is merged.
+        remapper = PointerRemapper(rel_coalesce_lag_ms=10)
+        remapper.handle(frame(1, (REL, ecodes.REL_X, 1)) + frame(2, (REL, ecodes.REL_X, 2)))
+        self.assertEqual(remapper.backlogged_read_count, 1)
+        self.assertEqual(values(remapper.output.events),
+                         [(2, REL, ecodes.REL_X, 3), (2, MSC, ecodes.MSC_TIMESTAMP, 1000), (2, SYN, 0, 0)])
+
+
+class KeyDevice(FakeDevice):
+    """A keyboard whose held keys (as the kernel reports them) are `held`."""
+    def __init__(self):
+        super().__init__([])
+        self.held = []
+        self.grabbed = True
+
+    def active_keys(self):
+        return self.held
+
+    def leds(self):
+        return []
+
+    def capabilities(self):
+        return {ecodes.EV_KEY: [ecodes.KEY_A, ecodes.KEY_B]}
+
+    def grab(self):
+        self.grabbed = True
+
+    def ungrab(self):
+        self.grabbed = False
+
+
+class FailingRemapper(key_remapper.BaseRemapper):
+    """Raises on KEY_B; passes the other keys through."""
+    def __init__(self, **kwargs):
+        super().__init__('key-remapper-test', '', '', headless=True, **kwargs)
+        self.output = FakeUInput()
+        self.uinput = key_remapper.SyncedUinput(self.output)
+        self.resyncs = 0
+
+    def on_handle_event(self, device, ev):
+        if ev.type == ecodes.EV_KEY and ev.code == ecodes.KEY_B:
+            raise ValueError('test')
+        self.send_ievent(ev)
+
+    def on_resync(self, device):
+        self.resyncs += 1
+
+    def handle(self, device, events):
+        device.events = events
+        self._BaseRemapper__on_input_event(device, None)
+
+
+class PassthroughTest(unittest.TestCase):
+    def test_exceptions_exit_by_default(self):
+        remapper = FailingRemapper()
+        with self.assertRaises(SystemExit), mock.patch('traceback.print_exc'):
+            remapper.handle(KeyDevice(), frame(1, (KEY, ecodes.KEY_B, 1)))
+
+    def test_resync_while_passing_through(self):
+        remapper = FailingRemapper(latency_budget_ms=100)
+        device = KeyDevice()
+        with mock.patch('traceback.print_exc'):
+            remapper.handle(device, frame(1, (KEY, ecodes.KEY_B, 1)))
+        self.assertFalse(device.grabbed)
+        self.assertEqual(remapper.passthrough_count, 1)
+
+        # Events were lost, and the kernel says A is held now.
+        device.held = [ecodes.KEY_A]
+        remapper.handle(device, frame(2, (KEY, ecodes.KEY_B, 0)) + frame(3, (SYN, ecodes.SYN_DROPPED, 0))
+                        + frame(4, (KEY, ecodes.KEY_A, 2)))
+        self.assertEqual(remapper.resyncs, 1)
+        self.assertTrue(remapper.is_key_pressed(ecodes.KEY_A))
+        self.assertEqual(remapper.output.events, [])  # The kernel delivers the events directly.
+
+
+class AppLayerRemapper(key_remapper.BaseRemapper):
+    def __init__(self, **kwargs):
+        super().__init__('key-remapper-test', '', '', **kwargs)
+        self.add_app_layer(key_remapper.AppLayer('Chrome', class_group='Google-chrome')) \
+            .bind(ecodes.KEY_F1, ecodes.KEY_F2)
+
+
+class MainWithoutDisplayTest(unittest.TestCase):
+    """main() must come up without an X11 display (e.g. on Wayland), with the app layers off."""
+
+    def run_main(self, remapper: key_remapper.BaseRemapper, args):
+        base = key_remapper.BaseRemapper
+        with mock.patch.object(key_remapper.wnck.Screen, 'get_default', return_value=None) as get_default, \
+                mock.patch.object(key_remapper, 'ensure_singleton'), \
+                mock.patch.object(key_remapper, 'notify2'), \
+                mock.patch.object(key_remapper, 'RemapperTrayIcon'), \
+                mock.patch.object(key_remapper, 'glib'), \
+                mock.patch.object(key_remapper, 'gtk'), \
+                mock.patch.object(remapper.notifications, 'start'), \
+                mock.patch.object(remapper, 'new_uintput',
+                                  side_effect=lambda *a, **kw: key_remapper.SyncedUinput(FakeUInput())), \
+                mock.patch.object(base, '_BaseRemapper__start_udev_monitor',
+                                  side_effect=lambda: setattr(remapper, '_BaseRemapper__udev_monitor', None)), \
+                mock.patch.object(base, '_BaseRemapper__open_devices'), \
+                mock.patch.object(base, '_BaseRemapper__release_devices'), \
+                mock.patch.object(base, '_BaseRemapper__setup_realtime'):
+            with self.assertRaises(SystemExit) as cm:
+                remapper.main(args)
+        self.assertEqual(cm.exception.code, 0)
+        return get_default
+
+    def test_no_display(self):
+        remapper = AppLayerRemapper()
+        get_default = self.run_main(remapper, ['-q'])
+        get_default.assert_called()
+        self.assertEqual(remapper.active_app_layers, [])
+
+    def test_headless(self):
+        remapper = AppLayerRemapper()
+        get_default = self.run_main(remapper, ['-q', '--headless'])
+        get_default.assert_not_called()
+        self.assertEqual(remapper.active_app_layers, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -5,6 +5,7 @@
 import math
 import os
 import sys
+from typing import List
 
 import evdev
 from evdev import ecodes, InputEvent
@@ -40,6 +41,16 @@ class Remapper(key_remapper.BaseRemapper):
                          uinput_events={
                              ecodes.EV_KEY: (ecodes.BTN_LEFT, ecodes.BTN_RIGHT, ecodes.BTN_MIDDLE),
                              ecodes.EV_REL: (ecodes.REL_X, ecodes.REL_Y),
+                             # So libinput can see when the motion actually happened.
+                             ecodes.EV_MSC: (ecodes.MSC_TIMESTAMP,),
+                         },
+                         synthesize_msc_timestamp=True,
+                         # Merge the motion when we fall behind, instead of replaying it late.
+                         rel_coalesce_lag_ms=10,
+                         input_events={
+                             ecodes.EV_KEY: None,
+                             ecodes.EV_REL: None,
+                             ecodes.EV_MSC: (ecodes.MSC_TIMESTAMP,),
                          })
         self.threshold = 0
         self.add = 0
@@ -57,25 +68,30 @@ class Remapper(key_remapper.BaseRemapper):
         self.power = args.power
         self.scale = args.scale
 
-    def on_handle_event(self, device: evdev.InputDevice, ev: evdev.InputEvent):
-        if ev.type == ecodes.EV_REL:
-            value = math.fabs(ev.value) - self.threshold
-            if value < 1:
-                value = ev.value
-            else:
-                value = (value + self.add) / self.scale
-                value = (math.pow(1 + value, self.power) - 1) * self.scale
-                value = value + self.threshold
+    def speed_up(self, value: int) -> int:
+        v = math.fabs(value) - self.threshold
+        if v < 1:
+            return value
 
-                if ev.value < 0:
-                    value = -value
+        v = (v + self.add) / self.scale
+        v = (math.pow(1 + v, self.power) - 1) * self.scale
+        v = v + self.threshold
 
-            if self.enable_debug:
-                print(f'{ev.code}: {ev.value} -> {value}')
+        if value < 0:
+            v = -v
+        return int(v)
 
-            ev.value = int(value)
+    def on_handle_frame(self, device: evdev.InputDevice, frame: List[InputEvent]):
+        # Handle a whole frame at once, so REL_X and REL_Y go out in a single frame.
+        for ev in frame:
+            value = ev.value
+            if ev.type == ecodes.EV_REL:
+                value = self.speed_up(ev.value)
 
-        self.send_event(ev.type, ev.code, ev.value)
+                if self.enable_debug:
+                    print(f'{ev.code}: {ev.value} -> {value}')
+
+            self.send_event(ev.type, ev.code, value)
 
 
 def main(args):
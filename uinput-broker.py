@@ -0,0 +1,207 @@
+#!/usr/bin/python3
+#
+# Owns one virtual keyboard and one virtual pointer, and writes the output of all the remappers started with
+# --broker to them. (See key_remapper.BrokerUinput for the protocol.)
+#
+# - The compositor sees two uinput devices instead of one or more per remapper.
+# - Key states are merged across the remappers: a key (e.g. a modifier) pressed by two remappers is released
+#   only when both have released it, and the keys a remapper holds are released when it disconnects.
+# - Frames that arrive together are written with a single write() per device.
+#
+import argparse
+import collections
+import json
+import os
+import select
+import signal
+import socket
+import struct
+import sys
+from typing import Dict, List, Optional, Set
+
+import evdev
+from evdev import ecodes, UInput
+
+import key_remapper
+
+NAME = 'uinput-broker'
+
+POINTER_EVENTS = {
+    ecodes.EV_KEY: (ecodes.BTN_LEFT, ecodes.BTN_RIGHT, ecodes.BTN_MIDDLE, ecodes.BTN_SIDE,
+                    ecodes.BTN_EXTRA, ecodes.BTN_FORWARD, ecodes.BTN_BACK, ecodes.BTN_TASK),
+    ecodes.EV_REL: (ecodes.REL_X, ecodes.REL_Y,
+                    ecodes.REL_WHEEL, ecodes.REL_HWHEEL,
+                    ecodes.REL_WHEEL_HI_RES, ecodes.REL_HWHEEL_HI_RES),
+    ecodes.EV_MSC: (ecodes.MSC_TIMESTAMP,),
+}
+
+debug = False
+
+
+def is_pointer_event(ev: evdev.InputEvent) -> bool:
+    if ev.type == ecodes.EV_KEY:
+        return ecodes.BTN_MOUSE <= ev.code < ecodes.BTN_JOYSTICK
+    return ev.type in (ecodes.EV_REL, ecodes.EV_MSC)
+
+
+class Client:
+    def __init__(self, sock: socket.socket):
+        self.socket = sock
+        self.name: Optional[str] = None  # Set by the hello message.
+        self.pressed: Set[int] = set()
+
+
+class Broker:
+    def __init__(self, path: str):
+        self.keyboard = UInput(name=key_remapper.UINPUT_DEVICE_NAME + '-broker-keyboard')
+        self.pointer = UInput(name=key_remapper.UINPUT_DEVICE_NAME + '-broker-pointer', events=POINTER_EVENTS)
+        self.key_refs: Dict[int, int] = collections.defaultdict(int)  # key -> number of clients holding it
+        self.clients: Dict[int, Client] = {}  # fd -> client
+        self.frames_in = 0
+        self.writes = 0
+
+        os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+        if os.path.exists(path):
+            os.unlink(path)  # We hold the singleton lock, so it must be stale.
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        self.server.bind(path)
+        os.chmod(path, 0o600)
+        self.server.listen(16)
+        self.path = path
+
+    def close(self):
+        self.server.close()
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+        # Destroying the devices releases all the keys.
+        self.keyboard.close()
+        self.pointer.close()
+
+    def serve(self):
+        while True:
+            fds = [self.server.fileno()] + list(self.clients.keys())
+            readable = select.select(fds, [], [])[0]
+
+            # Collect the frames from all the readable clients, then write them at once.
+            out: Dict[UInput, List[evdev.InputEvent]] = {self.keyboard: [], self.pointer: []}
+            for fd in readable:
+                if fd == self.server.fileno():
+                    sock, _ = self.server.accept()
+                    self.clients[sock.fileno()] = Client(sock)
+                    continue
+                self.__read_client(self.clients[fd], out)
+            self.__write(out)
+
+    def __read_client(self, client: Client, out: Dict[UInput, List[evdev.InputEvent]]):
+        size = bytearray(1)
+        while True:
+            try:
+                # Peek at the size of the next message first; SOCK_SEQPACKET truncates what doesn't fit.
+                length = client.socket.recv_into(size, 1, socket.MSG_PEEK | socket.MSG_TRUNC | socket.MSG_DONTWAIT)
+                data = client.socket.recv(max(length, 1), socket.MSG_DONTWAIT)
+            except BlockingIOError:
+                return
+            except OSError:
+                data = b''
+            if not data:
+                self.__disconnect(client, out)
+                return
+            try:
+                if client.name is None:
+                    hello = json.loads(data.decode())
+                    client.name = str(hello.get('client', '?'))
+                    if debug: print(f'# Connected: {client.name}')
+                    continue
+                events = key_remapper.unpack_events(data)
+            except (ValueError, AttributeError, struct.error) as e:
+                print(f'Malformed message from {client.name or "a new client"}: {e}', file=sys.stderr)
+                self.__disconnect(client, out)
+                return
+            self.__handle_events(client, events, out)
+
+    def __handle_events(self, client: Client, events: List[evdev.InputEvent],
+                        out: Dict[UInput, List[evdev.InputEvent]]):
+        frame: Dict[UInput, List[evdev.InputEvent]] = {self.keyboard: [], self.pointer: []}
+        for ev in events:
+            if key_remapper.is_syn(ev):
+                # Split the frame between the devices, and end each part with its own SYN_REPORT.
+                for device, device_events in frame.items():
+                    if device_events:
+                        out[device].extend(device_events)
+                        out[device].append(ev)
+                        device_events.clear()
+                self.frames_in += 1
+                continue
+            if ev.type == ecodes.EV_KEY and not self.__merge_key(client, ev):
+                continue
+            frame[self.pointer if is_pointer_event(ev) else self.keyboard].append(ev)
+
+    def __merge_key(self, client: Client, ev: evdev.InputEvent) -> bool:
+        """Update the global key states. Returns whether to write the event."""
+        if ev.value == 1:
+            if ev.code in client.pressed:
+                return False
+            client.pressed.add(ev.code)
+            self.key_refs[ev.code] += 1
+            return self.key_refs[ev.code] == 1
+        if ev.value == 0:
+            if ev.code not in client.pressed:
+                return False
+            client.pressed.discard(ev.code)
+            self.key_refs[ev.code] -= 1
+            return self.key_refs[ev.code] == 0
+        return ev.code in client.pressed  # Auto-repeat.
+
+    def __disconnect(self, client: Client, out: Dict[UInput, List[evdev.InputEvent]]):
+        if debug: print(f'# Disconnected: {client.name}')
+        del self.clients[client.socket.fileno()]
+        client.socket.close()
+
+        # Release the keys only this client was holding.
+        releases = [evdev.InputEvent(0, 0, ecodes.EV_KEY, key, 0) for key in sorted(client.pressed)]
+        client.pressed.clear()
+        for ev in releases:
+            self.key_refs[ev.code] -= 1
+            if self.key_refs[ev.code] == 0:
+                device = self.pointer if is_pointer_event(ev) else self.keyboard
+                out[device].append(ev)
+                out[device].append(evdev.InputEvent(0, 0, ecodes.EV_SYN, ecodes.SYN_REPORT, 0))
+
+    def __write(self, out: Dict[UInput, List[evdev.InputEvent]]):
+        for device, events in out.items():
+            if not events:
+                continue
+            if debug:
+                for ev in events:
+                    print(f'<- {device.name}: {ev}')
+            data = memoryview(key_remapper.pack_events(events))
+            while data:
+                data = data[os.write(device.fd, data):]
+            self.writes += 1
+
+
+def main(args):
+    parser = argparse.ArgumentParser(description='Shares one set of uinput devices between remappers')
+    parser.add_argument('--socket', metavar='PATH', default=key_remapper.broker_socket_path(),
+                        help='Socket path (default: $XDG_RUNTIME_DIR/key-remapper/uinput-broker.sock)')
+    parser.add_argument('-d', '--debug', action='store_true', help='Enable debug output')
+    args = parser.parse_args(args)
+
+    global debug
+    debug = args.debug
+
+    key_remapper.ensure_singleton(NAME)
+    broker = Broker(args.socket)
+    key_remapper.add_at_exit(broker.close)
+    signal.signal(signal.SIGTERM, lambda signum, frame: key_remapper.exit(0))
+    if debug: print(f'# Listening on {args.socket}')
+    try:
+        broker.serve()
+    except KeyboardInterrupt:
+        key_remapper.exit(0)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])